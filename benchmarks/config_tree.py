@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic configuration repository, to benchmark the loading,
+rendering and validation of large configurations.
+
+The configuration lives at the bottom of a hierarchy of directories,
+each of them with a global_templates directory, and loads local
+templates from nested directories and global templates from every level.
+The actions make heavy use of Jinja loops, filters and conditions.
+
+    python -m benchmarks.config_tree /tmp/tree --depth 5 --templates 100
+"""
+
+import argparse
+import os
+
+import yaml
+
+VARIABLES = {
+    "packages": [f"tool-{number}" for number in range(20)],
+    "user": "ubuntu",
+    "prefix": "bench",
+    "snap_track": "latest",
+    "platform": "pc",
+    "codename": "noble",
+    "services": {"enabled": True, "timeout": 30},
+}
+
+COMMAND = """{% for package in packages %}
+echo "{{ package | upper }} for {{ user | default('root') }}"
+{% endfor %}
+{% if services.enabled %}systemctl list-units --no-pager{% endif %}
+echo {{ prefix ~ '-' ~ NUMBER }} > /tmp/{{ prefix | replace('-', '_') }}
+"""
+
+SERVICE_RAW = """[Unit]
+Description={{ prefix | title }} service NUMBER
+
+[Service]
+ExecStart=/usr/bin/{{ prefix }}-NUMBER --timeout {{ services.timeout }}
+{% for package in packages[:5] %}Environment={{ package | upper }}=1
+{% endfor %}
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def _make_action(number, local):
+    kind = number % 6
+    if kind == 0:
+        action = {
+            "action": "ssh_command",
+            "command": COMMAND.replace("NUMBER", str(number)),
+        }
+    elif kind == 1:
+        action = {
+            "action": "install_debian",
+            "name": "{{ prefix }}-package-" + str(number),
+        }
+    elif kind == 2:
+        action = {
+            "action": "install_snap",
+            "name": f"snap-{number}",
+            "track": "{{ snap_track }}",
+            "risk": "stable",
+        }
+    elif kind == 3:
+        action = {
+            "action": "create_service",
+            "service_name": "{{ prefix }}-" + f"{number}.service",
+            "service_raw": SERVICE_RAW.replace("NUMBER", str(number)),
+        }
+    elif kind == 4:
+        action = {
+            "action": "add_apt_source",
+            "ppa_url": f"ppa:bench/ppa-{number}",
+            "ppa_name": "{{ prefix }}-ppa-" + str(number),
+            "suites": "{{ codename }}",
+        }
+    else:
+        action = {
+            "action": "scp_command",
+            "source": "files/{{ prefix }}-" + f"{number}.bin",
+            "destination": "/home/{{ user }}/" + f"{number}.bin",
+        }
+    # bypass conditions are not allowed in the global templates
+    if local and number % 4 == 0:
+        action["bypass_condition"] = (
+            "'{{ platform }}' in ['arm64', 'riscv64'] and "
+            "'{{ user }}' != 'root'"
+        )
+    return action
+
+
+def _write_template(path, first, count, local):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    actions = [
+        _make_action(number, local) for number in range(first, first + count)
+    ]
+    with open(path, "w") as fp:
+        yaml.safe_dump({"actions": actions}, fp)
+
+
+def generate_config_tree(root, depth=5, templates=100, actions=20):
+    """
+    Write a synthetic configuration repository below root
+
+    Args:
+        root (str): directory to create the repository in
+        depth (int): number of directory levels with a global_templates
+            directory above the configuration
+        templates (int): number of templates, half of them global ones
+            spread over the levels, the other half local ones
+        actions (int): number of actions of every template
+
+    Returns:
+        tuple: path of the configuration file and its variables
+    """
+    names = []
+    number = 0
+    level_dir = root
+    global_count = templates // 2
+    for level in range(depth):
+        template_dir = os.path.join(level_dir, "global_templates")
+        # common.yaml is defined at every level, the closest one wins
+        _write_template(
+            os.path.join(template_dir, "common.yaml"), number, 1, False
+        )
+        for index in range(level, global_count, depth):
+            name = f"global-{index}.yaml"
+            _write_template(
+                os.path.join(template_dir, name), number, actions, False
+            )
+            names.append(name)
+            number += actions
+        level_dir = os.path.join(level_dir, f"level-{level}")
+
+    config_dir = os.path.join(level_dir, "project")
+    for index in range(templates - global_count):
+        name = f"local-{index}.yaml"
+        path = os.path.join(
+            config_dir, "templates", f"group-{index % 10}", name
+        )
+        _write_template(path, number, actions, True)
+        # some templates are looked up by their relative path
+        names.append(f"group-{index % 10}/{name}" if index % 3 else name)
+        number += actions
+    names.append("common.yaml")
+    names.append("group-0/local-1*.yaml")
+
+    config_file = os.path.join(config_dir, "env_setup.yaml")
+    contents = [{"action": "load_template", "name": name} for name in names]
+    contents.append(
+        {"action": "ssh_command", "command": "echo {{ packages | length }}"}
+    )
+    with open(config_file, "w") as fp:
+        yaml.safe_dump({"actions": contents}, fp)
+    return config_file, dict(VARIABLES)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic configuration repository"
+    )
+    parser.add_argument("root", help="directory to create")
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--templates", type=int, default=100)
+    parser.add_argument("--actions", type=int, default=20)
+    args = parser.parse_args()
+
+    config_file, variables = generate_config_tree(
+        args.root, args.depth, args.templates, args.actions
+    )
+    variables_file = os.path.join(os.path.dirname(config_file), "vars.yaml")
+    with open(variables_file, "w") as fp:
+        yaml.safe_dump(variables, fp)
+    print(config_file)
+    print(variables_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import collections
+import logging
+import os
+import select
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import paramiko
+
+FAKE_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_bin")
+RECV_SIZE = 32768
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, dut):
+        self._dut = dut
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != "session":
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self._dut.count("channels")
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_shell_request(self, channel):
+        return True
+
+    def check_channel_pty_request(self, channel, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._dut.count("commands")
+        threading.Thread(
+            target=self._dut.run_command,
+            args=(channel, command.decode()),
+            daemon=True,
+        ).start()
+        return True
+
+
+class FakeDut:
+    """
+    Local SSH server standing in for a DUT.
+
+    Every command runs in bash within a temporary home directory, with
+    fake snap, apt, dpkg-query, systemctl and sudo commands first in the
+    PATH. They keep their state below the home directory, so the same
+    configuration can be applied again and gets the same answers as on
+    a real DUT.
+    """
+
+    def __init__(self):
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._home = tempfile.mkdtemp(prefix="envicorn-fake-dut-")
+        self._root = os.path.join(self._home, "root")
+        self._sock = None
+        self._transports = []
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def start(self):
+        os.makedirs(self._root, exist_ok=True)
+        self._sock = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+        for transport in self._transports:
+            transport.close()
+        shutil.rmtree(self._home, ignore_errors=True)
+
+    def reset(self):
+        """
+        Forget the installed packages, snaps and services
+        """
+        shutil.rmtree(self._root, ignore_errors=True)
+        os.makedirs(self._root)
+        with self._lock:
+            self._stats.clear()
+
+    def count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                key: self._stats[key]
+                for key in ("connections", "channels", "commands")
+            }
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            self.count("connections")
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self._host_key)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=_ServerInterface(self))
+            except (paramiko.SSHException, EOFError) as e:
+                logging.debug("SSH negotiation failed: %s", e)
+
+    def run_command(self, channel, command):
+        env = dict(
+            os.environ,
+            PATH=f"{FAKE_BIN}:{os.environ['PATH']}",
+            HOME=self._home,
+            FAKE_ROOT=self._root,
+        )
+        process = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=self._home,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        threading.Thread(
+            target=_pipe_stdin, args=(channel, process), daemon=True
+        ).start()
+        stderr = threading.Thread(
+            target=_pipe_output,
+            args=(process.stderr, channel.sendall_stderr),
+        )
+        stderr.start()
+        _pipe_output(process.stdout, channel.sendall)
+        stderr.join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+def _pipe_stdin(channel, process):
+    try:
+        while data := channel.recv(RECV_SIZE):
+            process.stdin.write(data)
+            process.stdin.flush()
+    except (OSError, EOFError):
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+def _pipe_output(stream, send):
+    try:
+        while data := stream.read1(RECV_SIZE):
+            send(data)
+    except OSError:
+        pass
+
+
+class LinkEmulator:
+    """
+    TCP relay to a local port adding the latency and the bandwidth limit
+    of a network link, in both directions.
+
+    The data read from one side is released to the other one after the
+    time needed to send it over the link and the one-way delay, so every
+    round trip of the SSH protocol costs at least the round-trip time.
+    """
+
+    def __init__(self, target_port, rtt=0.0, bandwidth=None):
+        """
+        Args:
+            target_port (int): port of the loopback to relay to
+            rtt (float): round-trip time in seconds
+            bandwidth (float): bytes per second, None for no limit
+        """
+        self._target_port = target_port
+        self._delay = rtt / 2
+        self._bandwidth = bandwidth
+        self._sock = None
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def start(self):
+        self._sock = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            server = socket.create_connection(("127.0.0.1", self._target_port))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for src, dst in ((client, server), (server, client)):
+                _Direction(src, dst, self._delay, self._bandwidth).start()
+
+
+class _Direction:
+    """
+    One direction of an emulated link, the reader queues the data with
+    the time it reaches the other side and the writer sends it then
+    """
+
+    def __init__(self, src, dst, delay, bandwidth):
+        self._src = src
+        self._dst = dst
+        self._delay = delay
+        self._bandwidth = bandwidth
+        self._queue = collections.deque()
+        self._ready = threading.Condition()
+        # time at which the link is done sending the queued data
+        self._link_free = 0.0
+
+    def start(self):
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _read(self):
+        while True:
+            try:
+                select.select([self._src], [], [])
+                data = self._src.recv(RECV_SIZE)
+            except OSError:
+                data = b""
+
+            now = time.monotonic()
+            sent_at = max(now, self._link_free)
+            if self._bandwidth and data:
+                sent_at += len(data) / self._bandwidth
+            self._link_free = sent_at
+            with self._ready:
+                self._queue.append((sent_at + self._delay, data))
+                self._ready.notify()
+            if not data:
+                return
+
+    def _write(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                arrival, data = self._queue.popleft()
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if not data:
+                    self._dst.shutdown(socket.SHUT_WR)
+                    return
+                self._dst.sendall(data)
+            except OSError:
+                return
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Benchmark the local configuration pipeline on a synthetic configuration
+repository, see config_tree.py.
+
+Every stage of the pipeline is timed on its own, the template lookups,
+the validation of the files, the rendering, the validation of the
+rendered actions, the evaluation of the bypass conditions and the
+parsing and rendering helpers of the operators, then the validate, dump
+and plan modes end to end and the plan compiled by dump --plan. The
+caches filled by a run are cleared before every run of a stage which
+would use them.
+
+The best times are compared with a stored baseline, a benchmark slower
+than the baseline by more than --threshold is a regression and the exit
+code is then 1.
+
+    python -m benchmarks.pipeline_bench
+    python -m benchmarks.pipeline_bench --save-baseline
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from benchmarks.config_tree import generate_config_tree
+from test_env_setup_util.env_setup import (
+    SafeConditionEvaluator,
+    SetupOperator,
+)
+from test_env_setup_util.libs import common, renderer, template_index
+from test_env_setup_util.libs.common import validate_file_content
+from test_env_setup_util.libs.model import ACTIONS_ADAPTER
+from test_env_setup_util.libs.operator.debian import _render_deb822_source
+from test_env_setup_util.libs.operator.snap import parse_snap_list
+from test_env_setup_util.libs.plan import load_plan
+from test_env_setup_util.libs.renderer import render_variables
+from test_env_setup_util.libs.template_index import TemplateIndex
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "pipeline_baseline.json"
+)
+
+
+def _make_snap_list(count=40):
+    """
+    Return the output of which snap and snap list --all on a DUT with
+    count snaps, every other one with a disabled revision
+    """
+    lines = ["/usr/bin/snap", "Name  Version  Rev  Tracking  Publisher  Notes"]
+    for number in range(count):
+        lines.append(
+            f"snap-{number}  1.{number}  {1000 + number}  latest/stable  "
+            "canonical**  -"
+        )
+        if number % 2:
+            lines.append(
+                f"snap-{number}  1.{number - 1}  {900 + number}  "
+                "latest/stable  canonical**  disabled"
+            )
+    return "\n".join(lines) + "\n"
+
+
+SNAP_LIST = _make_snap_list()
+
+DEB822_SOURCE = {
+    "types": ["deb", "deb-src"],
+    "uris": ["http://archive.ubuntu.com/ubuntu"],
+    "suites": ["noble", "noble-updates"],
+    "components": ["main", "universe"],
+    "architectures": ["amd64"],
+    "signed_by": "/usr/share/keyrings/ubuntu-archive-keyring.gpg",
+    "trusted": None,
+    "enabled": None,
+}
+
+
+def _reset_caches():
+    """
+    Forget the validated files, the template indexes and the compiled
+    templates, as in a new process
+    """
+    common._validated_contents.clear()
+    template_index._indexes.clear()
+    renderer._compile.cache_clear()
+
+
+def _prepare(workdir, depth, templates, actions):
+    """
+    Generate the configuration repository and the inputs of the stages
+    """
+    config_file, variables = generate_config_tree(
+        workdir, depth, templates, actions
+    )
+    root_path = os.path.dirname(config_file)
+    files = sorted(
+        os.path.join(path, name)
+        for path, _, names in os.walk(workdir)
+        for name in names
+        if name.endswith(".yaml")
+    )
+    names = [
+        action["name"]
+        for action in validate_file_content(Path(config_file))["actions"]
+        if action["action"] == "load_template"
+    ]
+    raw_actions = [
+        action
+        for file in files
+        for action in validate_file_content(Path(file))["actions"]
+    ]
+    plan_file = os.path.join(workdir, "plan.json")
+    SetupOperator(root_path, config_file, variables=variables).compile_plan(
+        plan_file
+    )
+    rendered_actions = [
+        render_variables(action, variables)
+        for action in raw_actions
+        if action["action"] != "load_template"
+    ]
+    return {
+        "workdir": workdir,
+        "config_file": config_file,
+        "root_path": root_path,
+        "variables": variables,
+        "plan_file": plan_file,
+        "files": files,
+        "names": names,
+        "raw_actions": raw_actions,
+        "rendered_actions": rendered_actions,
+        "conditions": [
+            action["bypass_condition"]
+            for action in rendered_actions
+            if action["bypass_condition"]
+        ],
+    }
+
+
+def lookup(inputs):
+    index = TemplateIndex(inputs["root_path"])
+    for name in inputs["names"]:
+        index.lookup(name)
+
+
+def validate_files(inputs):
+    common._validated_contents.clear()
+    for file in inputs["files"]:
+        validate_file_content(Path(file))
+
+
+def render(inputs):
+    renderer._compile.cache_clear()
+    for action in inputs["raw_actions"]:
+        render_variables(action, inputs["variables"])
+
+
+def model_validate(inputs):
+    ACTIONS_ADAPTER.validate_python(inputs["rendered_actions"])
+
+
+def eval_conditions(inputs):
+    evaluator = SafeConditionEvaluator()
+    for condition in inputs["conditions"]:
+        evaluator.eval_condition(condition)
+
+
+def snap_list(inputs):
+    for _ in range(1000):
+        parse_snap_list(SNAP_LIST)
+
+
+def deb822_source(inputs):
+    for _ in range(1000):
+        _render_deb822_source(DEB822_SOURCE)
+
+
+def validate_mode(inputs):
+    _reset_caches()
+    validate_file_content(Path(inputs["config_file"]))
+
+
+def dump_mode(inputs):
+    _reset_caches()
+    SetupOperator(
+        inputs["root_path"],
+        inputs["config_file"],
+        variables=inputs["variables"],
+        dump_file=os.path.join(inputs["workdir"], "dump.yaml"),
+    ).dump()
+
+
+def plan(inputs):
+    _reset_caches()
+    SetupOperator(
+        inputs["root_path"],
+        inputs["config_file"],
+        variables=inputs["variables"],
+    ).build_plan()
+
+
+def compiled_plan(inputs):
+    _reset_caches()
+    SetupOperator(
+        inputs["root_path"],
+        inputs["config_file"],
+        variables=inputs["variables"],
+        compiled_plan=load_plan(inputs["plan_file"]),
+    ).build_plan()
+
+
+BENCHMARKS = {
+    "lookup": lookup,
+    "validate-files": validate_files,
+    "render": render,
+    "model-validate": model_validate,
+    "eval-conditions": eval_conditions,
+    "snap-list-1000": snap_list,
+    "deb822-source-1000": deb822_source,
+    "validate": validate_mode,
+    "dump": dump_mode,
+    "plan": plan,
+    "compiled-plan": compiled_plan,
+}
+
+
+def run_benchmark(name, inputs, repeat=5):
+    """
+    Run a benchmark repeat times
+
+    Returns:
+        dict: the best and the median times in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        BENCHMARKS[name](inputs)
+        times.append(time.perf_counter() - start)
+    return {
+        "benchmark": name,
+        "best": round(min(times), 6),
+        "median": round(statistics.median(times), 6),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the best times with the baseline ones
+
+    Returns:
+        list: names of the benchmarks slower than the baseline by more
+            than threshold
+    """
+    regressions = []
+    for result in results:
+        reference = baseline.get(result["benchmark"])
+        if not reference:
+            result["ratio"] = None
+            continue
+        result["ratio"] = result["best"] / reference
+        if result["ratio"] > 1 + threshold:
+            regressions.append(result["benchmark"])
+    return regressions
+
+
+def _print_results(results, regressions):
+    header = (
+        f"{'benchmark':<20} {'best (ms)':>10} {'median (ms)':>12} "
+        f"{'vs baseline':>12}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        ratio = result.get("ratio")
+        ratio = f"{ratio:.2f}x" if ratio else "-"
+        if result["benchmark"] in regressions:
+            ratio += " !"
+        print(
+            f"{result['benchmark']:<20} {result['best'] * 1000:>10.1f} "
+            f"{result['median'] * 1000:>12.1f} {ratio:>12}"
+        )
+
+
+def register_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the local configuration pipeline"
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        choices=list(BENCHMARKS),
+        help="benchmark to run, can be repeated, default all of them",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=5,
+        help="levels of global_templates above the configuration",
+    )
+    parser.add_argument(
+        "--templates", type=int, default=100, help="number of templates"
+    )
+    parser.add_argument(
+        "--actions",
+        type=int,
+        default=20,
+        help="number of actions of every template",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs of every benchmark, the fastest is compared",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=BASELINE_FILE,
+        help="baseline file, default pipeline_baseline.json",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="slowdown over the baseline reported as a regression, "
+        "0.25 for 25%%",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="JSON results file"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = register_arguments()
+    tree = {
+        "depth": args.depth,
+        "templates": args.templates,
+        "actions": args.actions,
+    }
+    with tempfile.TemporaryDirectory(prefix="envicorn-pipeline-") as workdir:
+        inputs = _prepare(workdir, **tree)
+        results = [
+            run_benchmark(name, inputs, args.repeat)
+            for name in args.benchmark or BENCHMARKS
+        ]
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            stored = json.load(fp)
+        if stored["tree"] == tree:
+            baseline = stored["results"]
+        else:
+            print(
+                f"The baseline was recorded on another tree {stored['tree']}"
+            )
+    regressions = compare(results, baseline, args.threshold)
+    _print_results(results, regressions)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"tree": tree, "results": results}, fp, indent=2)
+    if args.save_baseline:
+        baseline.update(
+            {result["benchmark"]: result["best"] for result in results}
+        )
+        with open(args.baseline, "w") as fp:
+            json.dump({"tree": tree, "results": baseline}, fp, indent=2)
+            fp.write("\n")
+        return 0
+
+    if regressions:
+        print(
+            f"Slower than the baseline by more than {args.threshold:.0%}: "
+            + ", ".join(regressions)
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
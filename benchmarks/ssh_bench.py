@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Benchmark envicorn against a local fake DUT, over a link emulating the
+latency and the bandwidth of a lab network.
+
+Every scenario generates a synthetic configuration, runs it with a new
+SSH session and reports the wall time, the SSH handshakes, the channels
+and commands seen by the server, which are the round trips of the run,
+and the bytes sent.
+
+    python -m benchmarks.ssh_bench --rtt 50 --bandwidth 100
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import yaml
+
+from benchmarks.fake_dut import FakeDut, LinkEmulator
+from test_env_setup_util.env_setup import SetupOperator, setup_dut
+from test_env_setup_util.libs.ssh_handler import RemoteSshSession
+
+SERVICE_RAW = """[Unit]
+Description=Benchmark service {number}
+
+[Service]
+Type=oneshot
+ExecStart=/bin/true
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def _write_config(workdir, actions, name="env_setup.yaml"):
+    path = os.path.join(workdir, name)
+    with open(path, "w") as fp:
+        yaml.safe_dump({"actions": actions}, fp)
+    return path
+
+
+def commands(workdir, count):
+    return _write_config(
+        workdir,
+        [
+            {"action": "ssh_command", "command": f"echo {number}"}
+            for number in range(count)
+        ],
+    )
+
+
+def debian_packages(workdir, count):
+    return _write_config(
+        workdir,
+        [
+            {"action": "install_debian", "name": f"package-{number}"}
+            for number in range(count)
+        ],
+    )
+
+
+def snaps(workdir, count):
+    return _write_config(
+        workdir,
+        [
+            {"action": "install_snap", "name": f"snap-{number}"}
+            for number in range(count)
+        ],
+    )
+
+
+def services(workdir, count):
+    return _write_config(
+        workdir,
+        [
+            {
+                "action": "create_service",
+                "service_name": f"bench-{number}.service",
+                "service_raw": SERVICE_RAW.format(number=number),
+            }
+            for number in range(count)
+        ],
+    )
+
+
+def large_upload(workdir, size):
+    source = os.path.join(workdir, "payload.bin")
+    with open(source, "wb") as fp:
+        for _ in range(size // (1024 * 1024)):
+            fp.write(os.urandom(1024 * 1024))
+    return _write_config(
+        workdir,
+        [
+            {
+                "action": "scp_command",
+                "source": source,
+                "destination": "payload.bin",
+            }
+        ],
+    )
+
+
+def file_tree(workdir, count):
+    tree = os.path.join(workdir, "tree")
+    for number in range(count):
+        directory = os.path.join(tree, f"dir-{number % 10}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file-{number}"), "wb") as fp:
+            fp.write(os.urandom(4096))
+    return _write_config(
+        workdir,
+        [{"action": "scp_command", "source": tree, "destination": "tree"}],
+    )
+
+
+def templates(workdir, count):
+    os.makedirs(os.path.join(workdir, "templates"))
+    for number in range(count):
+        _write_config(
+            workdir,
+            [
+                {
+                    "action": "ssh_command",
+                    "command": "echo {{ greeting }} " + str(number),
+                }
+            ],
+            os.path.join("templates", f"template-{number}.yaml"),
+        )
+    return _write_config(
+        workdir,
+        [
+            {"action": "load_template", "name": f"template-{number}.yaml"}
+            for number in range(count)
+        ],
+    )
+
+
+SCENARIOS = {
+    "commands-10": (commands, 10),
+    "commands-100": (commands, 100),
+    "commands-1000": (commands, 1000),
+    "debian-100": (debian_packages, 100),
+    "snaps-10": (snaps, 10),
+    "services-10": (services, 10),
+    "upload-64M": (large_upload, 64 * 1024 * 1024),
+    "upload-tree-1000": (file_tree, 1000),
+    "templates-100": (templates, 100),
+}
+
+
+def run_scenario(name, dut, port, jobs=1, repeat=1):
+    """
+    Run a scenario repeat times, the fake DUT is reset before every run
+
+    Returns:
+        dict: the results of the fastest run and the wall times
+    """
+    generate, size = SCENARIOS[name]
+    runs = []
+    with tempfile.TemporaryDirectory(prefix=f"envicorn-{name}-") as workdir:
+        config = generate(workdir, size)
+        for _ in range(repeat):
+            dut.reset()
+            session = RemoteSshSession(
+                "127.0.0.1", "bench", "bench", port=port
+            )
+            operator = SetupOperator(
+                workdir, config, session, {"greeting": "hello"}, jobs=jobs
+            )
+            start = time.monotonic()
+            exit_code = setup_dut(session, operator)
+            wall_time = time.monotonic() - start
+            report = operator.get_report(exit_code)
+            runs.append(
+                {
+                    "scenario": name,
+                    "result": report["result"],
+                    "wall_time": round(wall_time, 3),
+                    **dut.get_stats(),
+                    "bytes_sent": report["bytes_sent"],
+                    "phases": report["phases"],
+                }
+            )
+
+    result = min(runs, key=lambda run: run["wall_time"])
+    result["wall_times"] = [run["wall_time"] for run in runs]
+    result["median_wall_time"] = statistics.median(result["wall_times"])
+    return result
+
+
+def _print_results(results):
+    header = (
+        f"{'scenario':<18} {'result':<14} {'wall (s)':>9} {'median':>9} "
+        f"{'handshakes':>10} {'channels':>9} {'commands':>9} {'MB sent':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<18} {result['result']:<14} "
+            f"{result['wall_time']:>9.3f} {result['median_wall_time']:>9.3f} "
+            f"{result['connections']:>10} {result['channels']:>9} "
+            f"{result['commands']:>9} "
+            f"{result['bytes_sent'] / 1024 / 1024:>8.1f}"
+        )
+
+
+def register_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark envicorn against a local fake DUT"
+    )
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenario to run, can be repeated, default all of them",
+    )
+    parser.add_argument(
+        "--rtt",
+        type=float,
+        default=0,
+        help="round-trip time of the emulated link in milliseconds",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=None,
+        help="bandwidth of the emulated link in Mbit/s, default unlimited",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="envicorn --jobs"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs of every scenario, the fastest is reported",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="JSON results file"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = register_arguments()
+    # keep the checkpoints of the runs away from the user ones
+    state_home = tempfile.TemporaryDirectory(prefix="envicorn-bench-")
+    os.environ["XDG_STATE_HOME"] = state_home.name
+
+    dut = FakeDut()
+    link = LinkEmulator(
+        dut.start(),
+        rtt=args.rtt / 1000,
+        bandwidth=args.bandwidth * 1000 * 1000 / 8 if args.bandwidth else None,
+    )
+    port = link.start()
+    results = []
+    try:
+        for name in args.scenario or SCENARIOS:
+            results.append(
+                run_scenario(name, dut, port, args.jobs, args.repeat)
+            )
+    finally:
+        link.stop()
+        dut.stop()
+        state_home.cleanup()
+
+    _print_results(results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(
+                {
+                    "rtt": args.rtt,
+                    "bandwidth": args.bandwidth,
+                    "jobs": args.jobs,
+                    "results": results,
+                },
+                fp,
+                indent=2,
+            )
+    failed = [result for result in results if result["result"] != "Success"]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
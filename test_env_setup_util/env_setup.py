@@ -1,37 +1,84 @@
 #!/usr/bin/env python3
 import argparse
 import ast
-import glob
-import jinja2
+import datetime
+import json
 import logging
 import os
 import paramiko
 import sys
+import threading
+import time
 import paramiko.ssh_exception
 import yaml
 import operator as op
 
 from pathlib import Path
 from pydantic import ValidationError
+from test_env_setup_util.libs.apt_proxy import AptCacheProxy
+from test_env_setup_util.libs.checkpoint import Checkpoint, get_plan_hash
 from test_env_setup_util.libs.common import (
+    enable_cache,
+    get_cache_home,
     validate_file_content,
     _check_file,
     _load_file,
     _update_variables_with_env,
 )
 from test_env_setup_util.libs.exceptions import ExitCode
-from test_env_setup_util.libs.model import EnvSetup, SshCommandAction
+from test_env_setup_util.libs.fleet import (
+    HostLogFilter,
+    load_inventory,
+    run_fleet,
+)
+from test_env_setup_util.libs.journal import (
+    ActionJournal,
+    action_hash,
+    get_unchanged_actions,
+)
+from test_env_setup_util.libs.model import (
+    ACTIONS_ADAPTER,
+    SshCommandAction,
+)
 from test_env_setup_util.libs.operator.common import (
     ssh_command,
     scp_command,
+    check_system_service,
     create_system_service,
+    create_system_services,
 )
 from test_env_setup_util.libs.operator.debian import (
+    get_apt_update_command,
     install_debian,
+    install_debian_batch,
     add_apt_source,
+    set_apt_proxy,
+    unset_apt_proxy,
+)
+from test_env_setup_util.libs.operator.snap import (
+    SnapChangeTracker,
+    install_snap,
+    install_snap_from_cache,
+    run_post_commands,
 )
-from test_env_setup_util.libs.operator.snap import install_snap
+from test_env_setup_util.libs.plan import (
+    get_variables_hash,
+    load_plan,
+    write_plan,
+)
+from test_env_setup_util.libs.renderer import (
+    render_document,
+    render_variables,
+)
+from test_env_setup_util.libs.template_index import get_template_index
+from test_env_setup_util.libs.scheduler import (
+    build_action_graph,
+    group_chained_actions,
+    run_action_graph,
+)
+from test_env_setup_util.libs.snap_cache import get_snap_cache
 from test_env_setup_util.libs.ssh_handler import RemoteSshSession
+from test_env_setup_util.libs.timing import Timings
 
 
 class SafeConditionEvaluator:
@@ -90,78 +137,182 @@ class SafeConditionEvaluator:
         raise ValueError(f"Disallowed AST node: {type(node).__name__}")
 
 
-def _str_presenter(dumper, data):
-    """
-    Preserve multiline strings when dumping yaml.
-    https://github.com/yaml/pyyaml/issues/240
-    """
-    if "\n" in data:
-        # Remove trailing spaces messing out the output.
-        block = "\n".join([line.rstrip() for line in data.splitlines()])
-        if data.endswith("\n"):
-            block += "\n"
-        return dumper.represent_scalar(
-            "tag:yaml.org,2002:str", block, style="|"
-        )
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
-
-
-yaml.add_representer(str, _str_presenter)
-yaml.representer.SafeRepresenter.add_representer(str, _str_presenter)
+AUTO_GENERATED_SOURCE = "auto-generated"
+REPORT_VERSION = 1
 
 
 class SetupOperator:
     def __init__(
-        self, root_path, root_yaml, session=None, variables={}, dump_file=None
+        self,
+        root_path,
+        root_yaml,
+        session=None,
+        variables={},
+        dump_file=None,
+        jobs=1,
+        apt_max_age=3600,
+        force_apt_update=False,
+        parallel_snaps=False,
+        incremental=False,
+        resume=False,
+        from_action=None,
+        only=None,
+        snap_cache=None,
+        compiled_plan=None,
     ):
         self._ssh_session = session
         self._root_path = root_path
         self._root_yaml = root_yaml
         self._variables = variables
         self._dump_file = dump_file
+        self._jobs = jobs
+        self._apt_max_age = apt_max_age
+        self._force_apt_update = force_apt_update
+        self._parallel_snaps = parallel_snaps
+        self._incremental = incremental
+        self._resume = resume
+        self._from_action = from_action
+        self._only = only
+        self._snap_cache = snap_cache
+        self._compiled_plan = compiled_plan
+        # configuration and template files loaded, recorded in the plans
+        self._sources = []
+        # last action loaded, before rendering
+        self._last_action = None
+        self._timings = session.timings if session is not None else Timings()
+        # run details written by --report
+        self._report = {}
+        self._snap_changes = None
         self._condition_evaluator = SafeConditionEvaluator()
+        self._template_index = get_template_index(root_path)
+        # apt and dpkg hold an exclusive lock on the DUT
+        self._apt_lock = threading.Lock()
+        # size of the uploads skipped by skip_if_identical
+        self._skipped_uploads = []
+        # state of the services created by a batch, by service name
+        self._service_states = {}
 
-    def _create_service(self, data):
+    def _create_service(self, action):
         """
         create system service file
         """
-        create_system_service(self._ssh_session, data)
+        if action.service_name in self._service_states:
+            check_system_service(
+                self._ssh_session,
+                action,
+                self._service_states.pop(action.service_name),
+            )
+        else:
+            create_system_service(self._ssh_session, action)
+
+    def _create_service_batch(self, batch):
+        """
+        Create the services of consecutive create_service actions at once,
+        every action then checks its own service
+
+        Args:
+            batch (list): create_service actions
+        """
+        states = create_system_services(self._ssh_session, batch)
+        if states is not None:
+            self._service_states.update(states)
 
-    def _ssh_command(self, data):
-        ssh_command(self._ssh_session, data)
+    def _ssh_command(self, action):
+        ssh_command(self._ssh_session, action)
 
-    def _install_snap(self, data):
+    def _install_snap(self, action):
         """Install required snap packages listed in configuration files
 
         Args:
-            data (dict): snap data including name, track, risk and revision
+            action (InstallSnapAction): snap name, track, risk and revision
         """
-        logging.info("# Trying to install %s snap", data["name"])
-        install_snap(self._ssh_session, data)
+        logging.info("# Trying to install %s snap", action.name)
+        if self._snap_cache is not None:
+            install_snap_from_cache(
+                self._ssh_session, action, self._snap_cache
+            )
+        else:
+            install_snap(self._ssh_session, action)
+
+    def _wait_snap_change(self, number, action):
+        """Wait for the snapd change submitted for an install_snap action
 
-    def _install_debian(self, data):
+        Args:
+            number (int): action number the change was submitted for
+            action (InstallSnapAction): snap name and post commands
+        """
+        logging.info("# Waiting for the installation of %s snap", action.name)
+        self._snap_changes.wait(number)
+        run_post_commands(self._ssh_session, action)
+
+    def _install_debian(self, action):
         """
         Install required debian packages listed in configuration files
         """
-        logging.info("Trying to install %s debian package", data["name"])
-        install_debian(self._ssh_session, data)
+        logging.info("Trying to install %s debian package", action.name)
+        with self._apt_lock:
+            install_debian(self._ssh_session, action)
+
+    def _install_debian_batch(self, batch):
+        """
+        Install the debian packages of consecutive install_debian actions
+        within one apt transaction
+
+        Args:
+            batch (list): install_debian actions
+
+        Returns:
+            bool: False if the packages have to be installed one by one
+        """
+        with self._apt_lock:
+            return install_debian_batch(self._ssh_session, batch)
 
-    def _add_apt_source(self, data):
+    def _add_apt_source(self, action):
         """
         Add APT sources (PPAs) from Launchpad.
         Credentials read from environment variables.
         """
-        logging.info("Adding APT source: %s", data.get("ppa_url", ""))
-        add_apt_source(self._ssh_session, data)
+        logging.info("Adding APT source: %s", action.ppa_url or "")
+        with self._apt_lock:
+            add_apt_source(
+                self._ssh_session,
+                action,
+                force_update=self._force_apt_update,
+            )
 
-    def _scp_command(self, data):
+    def _scp_command(self, action):
         logging.info(
             "Upload %s file to %s:%s",
-            data["source"],
+            action.source,
             self._ssh_session._ip,
-            data["destination"],
+            action.destination,
         )
-        scp_command(self._ssh_session, data)
+        if not scp_command(self._ssh_session, action):
+            self._skipped_uploads.append(os.path.getsize(action.source))
+
+    def _get_deselected_actions(self, actions, prelude):
+        """
+        Return the indices of the actions left out by --from-action and
+        --only, the actions generated by envicorn are always selected
+        """
+        if self._from_action:
+            if self._from_action > len(actions):
+                raise ValueError(f"the plan only has {len(actions)} actions")
+            return set(range(prelude, self._from_action - 1))
+
+        if self._only:
+            ids = {action.id: idx for idx, action in enumerate(actions)}
+            selected = set()
+            for item in self._only:
+                if item.isdigit() and 0 < int(item) <= len(actions):
+                    selected.add(int(item) - 1)
+                elif item in ids:
+                    selected.add(ids[item])
+                else:
+                    raise ValueError(f"unknown action '{item}'")
+            return set(range(prelude, len(actions))) - selected
+
+        return set()
 
     def _lookup_template_file(self, file):
         # expand var first if there's a env variable been defined
@@ -169,24 +320,7 @@ class SetupOperator:
         if Path(file).is_absolute():
             return file
 
-        # looking for file from base directory
-        pattern = os.path.join(self._root_path, "**", file)
-        logging.debug("looking pattern string is %s", pattern)
-        files = glob.glob(pattern, recursive=True)
-        if files:
-            return files[0]
-
-        # looking for file from global_templates directory
-        lookup_path = self._root_path
-        while lookup_path:
-            pattern = os.path.join(lookup_path, "global_templates", file)
-            logging.debug("looking pattern string is %s", pattern)
-            files = glob.glob(pattern, recursive=True)
-            if files:
-                return files[0]
-            if lookup_path == "/":
-                break
-            lookup_path = os.path.dirname(lookup_path)
+        return self._template_index.lookup(file)
 
     def _load_template_file(self, file):
         template_file = self._lookup_template_file(file)
@@ -196,18 +330,25 @@ class SetupOperator:
         return self._load_env_setup_file(_check_file(template_file))
 
     def _load_env_setup_file(self, yaml_file):
-        contents = validate_file_content(Path(yaml_file))
+        self._sources.append(yaml_file)
+        with self._timings.span("load"):
+            contents = validate_file_content(Path(yaml_file))
         actions = []
         action_sources = []
         bypass_actions = []
 
         for action in contents["actions"]:
-            new_action = self._replace_variables(action)
+            with self._timings.span("render"):
+                new_action = self._replace_variables(action)
             if new_action.get("bypass_condition"):
                 if self._condition_evaluator.eval_condition(
                     new_action["bypass_condition"]
                 ):
-                    bypass_actions.append(new_action)
+                    # rendered on its own, as the whole action used to be
+                    with self._timings.span("render"):
+                        bypass_actions.append(
+                            render_document(action, self._variables)
+                        )
                     continue
 
             if new_action["action"] == "load_template":
@@ -217,92 +358,296 @@ class SetupOperator:
                 bypass_actions.extend(_bypass)
             else:
                 action_sources.append(yaml_file)
-                actions.append(action)
+                actions.append(new_action)
+                self._last_action = action
 
         return actions, action_sources, bypass_actions
 
+    def _load_actions(self):
+        """
+        Load and render the actions of the configuration file
+
+        The last action is rendered again with the whole plan as a single
+        YAML document, like the plans used to be rendered
+        """
+        self._template_index.refresh()
+        actions, actions_src, bypass_actions = self._load_env_setup_file(
+            self._root_yaml
+        )
+        if actions:
+            with self._timings.span("render"):
+                actions[-1] = render_document(
+                    [self._last_action], self._variables
+                )[0]
+        return actions, actions_src, bypass_actions
+
     def _replace_variables(self, contents):
         """
-        convert actions to yaml contents and replace variables
+        replace variables in the strings of the action contents
         """
-        yaml_contents = yaml.dump(contents)
-        logging.info("\n##### original yaml contents #####")
-        logging.info(yaml_contents)
-        env = jinja2.Environment()
-        renderer = env.from_string(yaml_contents)
-        content = renderer.render(self._variables)
-        logging.info("\n#### updated yaml contents ####")
-        logging.info(content)
-
-        new_contents = yaml.safe_load(content)
-        return new_contents
+        return render_variables(contents, self._variables)
 
     def dump(self):
-        raw_actions, _, _ = self._load_env_setup_file(self._root_yaml)
-        rendered_actions = self._replace_variables(raw_actions)
+        rendered_actions, _, _ = self._load_actions()
         dump_file = self._dump_file if self._dump_file else "dump.yaml"
         logging.info("Dumping final yaml to %s", dump_file)
         with open(dump_file, "w") as f:
             yaml.dump({"actions": rendered_actions}, f)
         return ExitCode.Success
 
-    def run(self):
-        exit_code = ExitCode.Success
-        results = {}
-        raw_actions, actions_src, bypass_actions = self._load_env_setup_file(
-            self._root_yaml
-        )
-
-        rendered_actions = self._replace_variables(raw_actions)
+    def compile_plan(self, plan_file):
+        """
+        Write the rendered actions of the configuration file to a plan
+        file, which setup --plan runs without loading the configuration
+        """
+        rendered_actions, actions_src, bypass_actions = self._load_actions()
         try:
-            if "install_debian" in [a["action"] for a in rendered_actions]:
-                rendered_actions.insert(
-                    0,
-                    SshCommandAction(
-                        action="ssh_command",
-                        command="sudo apt update",
-                    ).model_dump(),
-                )
-                actions_src.insert(0, "auto-generated: sudo apt update")
-                logging.info(
-                    (
-                        "install_debian action detected, automatically "
-                        "prepend 'sudo apt update' command to "
-                        "ensure package lists are up to date"
-                    )
-                )
-            # Re-validate after replacing variables to ensure correctness
-            updated_actions = {"actions": rendered_actions}
-            validated_data = EnvSetup.model_validate(updated_actions)
-            actions = validated_data.actions
+            ACTIONS_ADAPTER.validate_python(rendered_actions)
         except ValidationError as e:
             logging.error(
                 "Validation failed after replacing variables:\n%s", e
             )
             return ExitCode.Action_Failed
+        write_plan(
+            plan_file,
+            self._root_yaml,
+            dict.fromkeys(self._sources),
+            self._variables,
+            rendered_actions,
+            actions_src,
+            bypass_actions,
+        )
+        logging.info("Compiled plan written to %s", plan_file)
+        return ExitCode.Success
+
+    def build_plan(self):
+        """
+        Load, render and validate the actions of the configuration file,
+        or only validate the ones of the compiled plan if one was given
+
+        Returns:
+            tuple: validated actions, their source files and the
+                bypassed actions
+        """
+        if self._compiled_plan is None:
+            # the actions are rendered while the files are loaded
+            rendered_actions, actions_src, bypass_actions = (
+                self._load_actions()
+            )
+        else:
+            rendered_actions = self._compiled_plan["actions"]
+            actions_src = list(self._compiled_plan["actions_src"])
+            bypass_actions = self._compiled_plan["bypass_actions"]
+        # the actions are validated once, after replacing variables
+        with self._timings.span("validate"):
+            actions = ACTIONS_ADAPTER.validate_python(rendered_actions)
+        if any(action.action == "install_debian" for action in actions):
+            actions.insert(
+                0,
+                SshCommandAction(
+                    action="ssh_command",
+                    command=get_apt_update_command(
+                        self._apt_max_age, self._force_apt_update
+                    ),
+                ),
+            )
+            actions_src.insert(0, f"{AUTO_GENERATED_SOURCE}: sudo apt update")
+            logging.info(
+                (
+                    "install_debian action detected, automatically "
+                    "prepend 'sudo apt update' command to "
+                    "ensure package lists are up to date, "
+                    "it is skipped when they are newer than %ds"
+                ),
+                self._apt_max_age,
+            )
+        return actions, actions_src, bypass_actions
 
-        for idx, action_model in enumerate(actions, start=1):
+    def run(self, plan=None):
+        """
+        Run the actions on the DUT
+
+        Args:
+            plan (tuple): a plan returned by build_plan, the configuration
+                file is loaded when it is not provided
+        """
+        exit_code = ExitCode.Success
+        self._report = {
+            "started_at": datetime.datetime.now(
+                datetime.timezone.utc
+            ).isoformat(),
+            "jobs": self._jobs,
+            "actions": [],
+        }
+        if plan is None:
             try:
-                header = f"\n{'='*30}"
-                logging.info(header)
-                logging.info(" Action %d : %s", idx, action_model.action)
-                logging.info(" source file: %s", actions_src[idx - 1])
-                logging.info("=" * 30)
-                getattr(self, f"_{action_model.action}")(
-                    action_model.model_dump()
+                plan = self.build_plan()
+            except ValidationError as e:
+                logging.error(
+                    "Validation failed after replacing variables:\n%s", e
                 )
-                results[idx] = "Success"
+                return ExitCode.Action_Failed
+        actions, actions_src, bypass_actions = plan
+
+        prelude = 0
+        while prelude < len(actions) and actions_src[prelude].startswith(
+            AUTO_GENERATED_SOURCE
+        ):
+            prelude += 1
+        # the actions excluded by their bypass_condition are not awaited
+        bypassed_ids = {action.get("id") for action in bypass_actions}
+        try:
+            graph = build_action_graph(actions, prelude, bypassed_ids)
+        except ValueError as e:
+            logging.error("Invalid action dependencies: %s", e)
+            return ExitCode.Action_Failed
+
+        # the generated actions depend on the options, not on the plan
+        checkpoint = Checkpoint(
+            self._ssh_session._ip, get_plan_hash(actions[prelude:])
+        )
+        # action index to the reason it is skipped
+        skipped = {}
+        try:
+            if self._resume:
+                for number in checkpoint.load():
+                    skipped[number - 1] = "completed before the checkpoint"
+            for idx in self._get_deselected_actions(actions, prelude):
+                skipped[idx] = "not selected"
+        except ValueError as e:
+            logging.error("Failed to select the actions to run: %s", e)
+            return ExitCode.Action_Failed
+
+        journal = None
+        hashes = {}
+        if self._incremental:
+            journal = ActionJournal(self._ssh_session)
+            journal.load()
+            for idx in range(prelude, len(actions)):
+                try:
+                    hashes[idx] = action_hash(actions[idx])
+                except OSError as e:
+                    logging.debug("Action %d is not journaled: %s", idx + 1, e)
+            for idx in get_unchanged_actions(graph, hashes, journal, prelude):
+                skipped.setdefault(idx, "unchanged since it was applied")
+
+        def _group_actions(action_type):
+            # the skipped actions are left out of the batches
+            return group_chained_actions(actions, graph, action_type, skipped)
+
+        debian_batches = _group_actions("install_debian")
+        service_batches = _group_actions("create_service")
+        # index of the actions done by the batch started by another action
+        batched = {}
+        snap_groups = {}
+        if self._parallel_snaps and self._snap_cache is None:
+            snap_groups = _group_actions("install_snap")
+            self._snap_changes = SnapChangeTracker(self._ssh_session)
+        results = {}
+        timings = {}
+        run_start = time.monotonic()
+
+        def _execute(idx):
+            action_model = actions[idx]
+            number = idx + 1
+            header = f"\n{'='*30}"
+            logging.info(header)
+            logging.info(" Action %d : %s", number, action_model.action)
+            logging.info(" source file: %s", actions_src[idx])
+            logging.info("=" * 30)
+            start = time.monotonic()
+            try:
+                if idx in skipped:
+                    logging.info("# %s, skipped", skipped[idx])
+                    results[number] = "Skipped"
+                    if skipped[idx] != "not selected":
+                        checkpoint.mark_completed(number)
+                    return True
+                if idx in debian_batches and self._install_debian_batch(
+                    [actions[i] for i in debian_batches[idx]]
+                ):
+                    batched.update(dict.fromkeys(debian_batches[idx], idx))
+                if idx in service_batches:
+                    self._create_service_batch(
+                        [actions[i] for i in service_batches[idx]]
+                    )
+                if idx in snap_groups:
+                    self._snap_changes.submit(
+                        {i + 1: actions[i] for i in snap_groups[idx]}
+                    )
+                if idx in batched:
+                    logging.info(
+                        "# %s was installed by the apt transaction of "
+                        "action %d",
+                        action_model.name,
+                        batched[idx] + 1,
+                    )
+                elif self._snap_changes and self._snap_changes.is_submitted(
+                    number
+                ):
+                    self._wait_snap_change(number, action_model)
+                else:
+                    getattr(self, f"_{action_model.action}")(action_model)
+                results[number] = "Success"
+                checkpoint.mark_completed(number)
+                return True
             except Exception as err:
                 logging.error(err)
-                results[idx] = "Failed"
-                if action_model.ignore_error:
-                    continue
-                exit_code = ExitCode.Action_Failed
-                break
+                results[number] = "Failed"
+                return action_model.ignore_error
+            finally:
+                timings[number] = (
+                    start - run_start,
+                    time.monotonic() - start,
+                )
+                if hashes.get(idx) and idx not in skipped:
+                    journal.record(
+                        hashes[idx], action_model.action, results[number]
+                    )
+
+        def _execute_timed(idx):
+            # the spans recorded by the action are attributed to it
+            with self._timings.action(idx + 1):
+                return _execute(idx)
+
+        if not run_action_graph(graph, _execute_timed, self._jobs):
+            exit_code = ExitCode.Action_Failed
+        wall_time = time.monotonic() - run_start
+        if journal and len(skipped) < len(actions):
+            journal.save()
+        if checkpoint.is_complete(len(actions)):
+            checkpoint.clear()
 
         logging.info("\n\n#### Summary ####")
-        for idx, result in results.items():
-            logging.info("Action %d: %s", idx, result)
+        for number in sorted(results):
+            start, duration = timings[number]
+            logging.info(
+                "Action %d: %s (%s, started at +%.2fs, took %.2fs)",
+                number,
+                results[number],
+                actions[number - 1].action,
+                start,
+                duration,
+            )
+        logging.info(
+            "Actions took %.2fs in total, %.2fs wall clock with %d jobs",
+            sum(duration for _, duration in timings.values()),
+            wall_time,
+            self._jobs,
+        )
+
+        for reason in dict.fromkeys(skipped.values()):
+            logging.info(
+                "Skipped %d actions %s",
+                list(skipped.values()).count(reason),
+                reason,
+            )
+        if self._skipped_uploads:
+            logging.info(
+                "Skipped %d uploads identical on the DUT, %d bytes not sent",
+                len(self._skipped_uploads),
+                sum(self._skipped_uploads),
+            )
 
         for action in bypass_actions:
             logging.info(
@@ -311,8 +656,247 @@ class SetupOperator:
                 action,
             )
 
+        stats = self._ssh_session.connection_stats()
+        logging.info(
+            "SSH: %d channels over %d handshakes (%d handshakes saved)",
+            stats["channels"],
+            stats["handshakes"],
+            stats["handshakes_saved"],
+        )
+        phases = self._timings.get_run()["phases"]
+        logging.info(
+            "Time by phase: %s",
+            ", ".join(
+                f"{phase} {stats['seconds']:.2f}s ({stats['count']})"
+                for phase, stats in phases.items()
+            ),
+        )
+
+        self._report["wall_time"] = round(wall_time, 3)
+        self._report["actions"] = [
+            {
+                "number": number,
+                "id": actions[number - 1].id,
+                "action": actions[number - 1].action,
+                "source": actions_src[number - 1],
+                "result": results[number],
+                "skip_reason": skipped.get(number - 1),
+                "started_at": round(timings[number][0], 3),
+                "duration": round(timings[number][1], 3),
+                **self._timings.get_action(number),
+            }
+            for number in sorted(results)
+        ]
+
+        if exit_code != ExitCode.Success:
+            logging.info(
+                "Run again with --resume to continue from the first "
+                "incomplete action"
+            )
+
         return exit_code
 
+    def get_report(self, exit_code):
+        """
+        Return the report of the run written by --report: the phase
+        durations, the bytes sent, the SSH connection statistics and the
+        details of every action
+
+        Args:
+            exit_code (ExitCode): result of the setup of the DUT
+        """
+        return {
+            "host": self._ssh_session._ip,
+            "result": ExitCode(exit_code).name,
+            **self._report,
+            **self._timings.get_run(),
+            "ssh": self._ssh_session.connection_stats(),
+        }
+
+
+def write_report(report_file, reports):
+    """
+    Write the reports of the DUTs to a JSON file
+    """
+    with open(report_file, "w") as fp:
+        json.dump({"version": REPORT_VERSION, "duts": reports}, fp, indent=2)
+    logging.info("Run report written to %s", report_file)
+
+
+def _setup_options(args):
+    """
+    SetupOperator keyword arguments from the setup subcommand arguments
+    """
+    return {
+        "jobs": args.jobs,
+        "apt_max_age": args.apt_max_age,
+        "force_apt_update": args.force_apt_update,
+        "parallel_snaps": args.parallel_snaps,
+        "incremental": args.incremental,
+        "resume": args.resume,
+        "from_action": args.from_action,
+        "only": args.only.split(",") if args.only else None,
+        "snap_cache": (
+            get_snap_cache(
+                args.snap_cache_dir or os.path.join(get_cache_home(), "snaps"),
+                args.snap_cache_max_size * 1024 * 1024,
+                args.snap_channel_max_age,
+            )
+            if args.sideload_snaps
+            else None
+        ),
+    }
+
+
+def _check_plan_variables(compiled_plan, variables):
+    """
+    Return False if variables are given and are not the ones the compiled
+    plan was rendered with
+    """
+    if not variables or (
+        get_variables_hash(variables) == compiled_plan["variables_sha256"]
+    ):
+        return True
+    logging.error(
+        "# the variables differ from the ones the plan was compiled with, "
+        "compile it again with dump --plan"
+    )
+    return False
+
+
+def setup_dut(session, operator, plan=None, apt_proxy=None):
+    """
+    Verify the SSH login and run the operator against the DUT, apt of
+    the DUT downloads through apt_proxy if it is given
+
+    Returns:
+        ExitCode: the result of the setup
+    """
+    try:
+        session.authentication_verification()
+        if apt_proxy is None:
+            return operator.run(plan)
+
+        try:
+            port = session.start_reverse_forward(apt_proxy.port)
+        except paramiko.SSHException as e:
+            logging.warning(
+                "# the DUT refused to forward a port to the apt proxy, "
+                "downloading directly: %s",
+                e,
+            )
+            return operator.run(plan)
+        set_apt_proxy(session, port)
+        try:
+            return operator.run(plan)
+        finally:
+            unset_apt_proxy(session)
+    except paramiko.ssh_exception.PasswordRequiredException:
+        logging.error("# password and passphrase is needed")
+        return ExitCode.SSH_AUTH_REQUIRED_PASSWORD_PASSPHRASE
+    except paramiko.ssh_exception.AuthenticationException:
+        logging.error("# Username or Password is incorrect")
+        return ExitCode.SSH_AUTH_INVALID_USERNAME_PASSWORD
+    finally:
+        session.close()
+
+
+def fleet_setup(
+    args,
+    root_path,
+    env_setup_file,
+    variables,
+    password,
+    apt_proxy=None,
+    compiled_plan=None,
+):
+    """
+    Setup all DUTs listed in the inventory file concurrently.
+    The configuration is rendered once for every distinct set of variables
+    and the resulting plan is shared by the hosts using it.
+    """
+    hosts = load_inventory(Path(_check_file(args.inventory)))
+    missing_username = [
+        host.ip for host in hosts if not (host.username or args.username)
+    ]
+    if missing_username:
+        logging.error(
+            "# username is not defined for %s", ", ".join(missing_username)
+        )
+        return ExitCode.SSH_AUTH_Failed
+
+    plans = {}
+    host_plans = {}
+    host_variables = {}
+    for host in hosts:
+        merged_variables = dict(variables)
+        merged_variables.update(host.variables)
+        _update_variables_with_env(merged_variables)
+        key = json.dumps(merged_variables, sort_keys=True, default=str)
+        if key not in plans:
+            plans[key] = None
+            if compiled_plan is None or _check_plan_variables(
+                compiled_plan, merged_variables
+            ):
+                operator = SetupOperator(
+                    root_path,
+                    env_setup_file,
+                    variables=merged_variables,
+                    compiled_plan=compiled_plan,
+                    **_setup_options(args),
+                )
+                try:
+                    plans[key] = operator.build_plan()
+                except ValidationError as e:
+                    logging.error(
+                        "Validation failed after replacing variables:\n%s",
+                        e,
+                    )
+        host_plans[host.ip] = plans[key]
+        host_variables[host.ip] = merged_variables
+    logging.info(
+        "# %d DUTs share %d rendered configurations", len(hosts), len(plans)
+    )
+
+    reports = {}
+
+    def _worker(host):
+        plan = host_plans[host.ip]
+        if plan is None:
+            return ExitCode.Action_Failed
+
+        session = RemoteSshSession(
+            host.ip,
+            host.username or args.username,
+            host.password or password,
+            host.private_key_file or args.private_key_file,
+        )
+        operator = SetupOperator(
+            root_path,
+            env_setup_file,
+            session,
+            host_variables[host.ip],
+            **_setup_options(args),
+        )
+        ret = setup_dut(session, operator, plan, apt_proxy)
+        reports[host.ip] = operator.get_report(ret)
+        return ret
+
+    ret = run_fleet(hosts, _worker, args.max_workers, args.log_dir)
+    if args.report:
+        write_report(
+            args.report,
+            [reports[host.ip] for host in hosts if host.ip in reports],
+        )
+    return ret
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
 
 def register_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -324,15 +908,33 @@ def register_arguments() -> argparse.Namespace:
     )
     sub_parser = parser.add_subparsers(dest="mode", required=True)
     setup_parser = sub_parser.add_parser("setup")
-    setup_parser.add_argument(
-        "-f", "--file", type=str, required=True, help="configuration file"
+    source_group = setup_parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument(
+        "-f", "--file", type=str, help="configuration file"
+    )
+    source_group.add_argument(
+        "--plan",
+        type=str,
+        help="plan compiled with dump --plan, run instead of a configuration",
     )
     setup_parser.add_argument("-v", "--variables-file", type=str, default=None)
-    setup_parser.add_argument(
-        "--remote-ip", type=str, required=True, help="the IP address of DUT"
+    target_group = setup_parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument(
+        "--remote-ip", type=str, help="the IP address of DUT"
+    )
+    target_group.add_argument(
+        "--inventory",
+        type=str,
+        help=(
+            "inventory file listing the DUTs (ip, username, password, "
+            "private_key_file and variables) to setup concurrently"
+        ),
     )
     setup_parser.add_argument(
-        "--username", type=str, required=True, help="username for login to DUT"
+        "--username",
+        type=str,
+        default=None,
+        help="username for login to DUT, default of the inventory hosts",
     )
     setup_parser.add_argument(
         "--password",
@@ -343,12 +945,164 @@ def register_arguments() -> argparse.Namespace:
     setup_parser.add_argument(
         "--private-key-file", type=str, help="SSH private key file"
     )
+    setup_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help=(
+            "number of actions run concurrently on a DUT, "
+            "actions without depends_on still wait for the previous ones"
+        ),
+    )
+    setup_parser.add_argument(
+        "--apt-max-age",
+        type=int,
+        default=3600,
+        help=(
+            "seconds after which the package lists of the DUT are "
+            "considered outdated and apt update is run"
+        ),
+    )
+    setup_parser.add_argument(
+        "--force-apt-update",
+        action="store_true",
+        default=False,
+        help="always run apt update, even if the package lists are fresh",
+    )
+    setup_parser.add_argument(
+        "--parallel-snaps",
+        action="store_true",
+        default=False,
+        help=(
+            "submit consecutive install_snap actions to snapd at once "
+            "and let it process them concurrently"
+        ),
+    )
+    setup_parser.add_argument(
+        "--sideload-snaps",
+        action="store_true",
+        default=False,
+        help=(
+            "download the snaps once on this host and install them on "
+            "the DUTs from the uploaded files"
+        ),
+    )
+    setup_parser.add_argument(
+        "--snap-cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "cache directory of --sideload-snaps, "
+            "default $XDG_CACHE_HOME/envicorn/snaps"
+        ),
+    )
+    setup_parser.add_argument(
+        "--snap-cache-max-size",
+        type=positive_int,
+        default=16384,
+        help="size in MB above which --sideload-snaps evicts cached snaps",
+    )
+    setup_parser.add_argument(
+        "--snap-channel-max-age",
+        type=int,
+        default=3600,
+        help=(
+            "seconds during which --sideload-snaps installs the revision "
+            "a channel was resolved to, instead of downloading it again"
+        ),
+    )
+    setup_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "skip the actions already applied with the same content, "
+            "according to the journal kept on the DUT"
+        ),
+    )
+    selection_group = setup_parser.add_mutually_exclusive_group()
+    selection_group.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help=(
+            "skip the actions completed by the previous run of the same "
+            "plan on the DUT"
+        ),
+    )
+    selection_group.add_argument(
+        "--from-action",
+        type=positive_int,
+        default=None,
+        help="skip the actions before this action number",
+    )
+    selection_group.add_argument(
+        "--only",
+        type=str,
+        default=None,
+        help="comma separated action numbers or ids to run",
+    )
+    setup_parser.add_argument(
+        "--apt-proxy",
+        action="store_true",
+        default=False,
+        help=(
+            "download the packages of the DUTs through a caching proxy "
+            "on this host, forwarded to the DUTs over SSH"
+        ),
+    )
+    setup_parser.add_argument(
+        "--apt-proxy-cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "cache directory of --apt-proxy, "
+            "default $XDG_CACHE_HOME/envicorn/apt"
+        ),
+    )
+    setup_parser.add_argument(
+        "--apt-proxy-max-size",
+        type=positive_int,
+        default=4096,
+        help="size in MB above which --apt-proxy evicts cached packages",
+    )
+    setup_parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help=(
+            "JSON file to write the durations of the phases and actions, "
+            "the bytes sent and the SSH statistics of the run to"
+        ),
+    )
+    setup_parser.add_argument(
+        "--max-workers",
+        type=positive_int,
+        default=4,
+        help="number of DUTs setup concurrently with --inventory",
+    )
+    setup_parser.add_argument(
+        "--log-dir",
+        type=str,
+        default=".",
+        help="directory of the per-DUT log files with --inventory",
+    )
 
     validate_parser = sub_parser.add_parser("validate")
     validate_parser.add_argument(
         "-f", "--file", type=str, required=True, help="configuration file"
     )
     parser.add_argument("--debug", action="store_true", default=False)
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help=(
+            "cache the validated configuration files in "
+            "$XDG_CACHE_HOME/envicorn to speed up the next runs"
+        ),
+    )
 
     dump_parser = sub_parser.add_parser("dump")
     dump_parser.add_argument(
@@ -358,8 +1112,21 @@ def register_arguments() -> argparse.Namespace:
     dump_parser.add_argument(
         "-o", "--output", type=str, default=None, help="output file"
     )
+    dump_parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help=(
+            "write a compiled plan for setup --plan instead of the "
+            "rendered YAML, default output plan.json"
+        ),
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.mode == "setup" and args.remote_ip and not args.username:
+        setup_parser.error("--username is required with --remote-ip")
+
+    return args
 
 
 def main() -> None:
@@ -388,7 +1155,32 @@ def main() -> None:
     )
     logger.addHandler(file_handler)
 
-    env_setup_file = _check_file(args.file)
+    if getattr(args, "inventory", None):
+        # prefix records with the DUT they belong to
+        console_handler.addFilter(HostLogFilter())
+        console_handler.setFormatter(
+            logging.Formatter("[%(host)s] " + log_format)
+        )
+        file_handler.addFilter(HostLogFilter())
+        file_handler.setFormatter(
+            logging.Formatter(
+                "[%(host)s] %(funcName)s [%(levelname)s] - %(message)s"
+            )
+        )
+
+    if args.cache:
+        enable_cache()
+
+    compiled_plan = None
+    if args.mode == "setup" and args.plan:
+        try:
+            compiled_plan = load_plan(_check_file(args.plan))
+        except ValueError as e:
+            logging.error("# %s", e)
+            sys.exit(ExitCode.Action_Failed)
+        env_setup_file = compiled_plan["config"]
+    else:
+        env_setup_file = _check_file(args.file)
     path = os.path.dirname(env_setup_file)
     root_path = path if path else os.getcwd()
 
@@ -397,33 +1189,65 @@ def main() -> None:
         if args.variables_file:
             conf_file = _check_file(args.variables_file)
             variables = _load_file(Path(conf_file))
-        # update variables
-        _update_variables_with_env(variables)
-
         password = args.password or os.environ.get("ENVICORN_PASSWORD")
-        try:
-            session = RemoteSshSession(
-                args.remote_ip,
-                args.username,
-                password,
-                args.private_key_file,
-            )
-            session.authentication_verification()
-            operator = SetupOperator(
-                root_path, env_setup_file, session, variables
+        apt_proxy = None
+        if args.apt_proxy:
+            apt_proxy = AptCacheProxy(
+                args.apt_proxy_cache_dir
+                or os.path.join(get_cache_home(), "apt"),
+                args.apt_proxy_max_size * 1024 * 1024,
             )
-            sys.exit(operator.run())
-        except paramiko.ssh_exception.PasswordRequiredException as err:
-            logging.error("# password and passphrase is needed")
-            sys.exit(ExitCode.SSH_AUTH_REQUIRED_PASSWORD_PASSPHRASE)
-        except paramiko.ssh_exception.AuthenticationException as err:
-            logging.error("# Username or Password is incorrect")
-            sys.exit(ExitCode.SSH_AUTH_INVALID_USERNAME_PASSWORD)
+            apt_proxy.start()
+
+        try:
+            if args.inventory:
+                ret = fleet_setup(
+                    args,
+                    root_path,
+                    env_setup_file,
+                    variables,
+                    password,
+                    apt_proxy,
+                    compiled_plan,
+                )
+            else:
+                # update variables
+                _update_variables_with_env(variables)
+                if compiled_plan is not None and not _check_plan_variables(
+                    compiled_plan, variables
+                ):
+                    sys.exit(ExitCode.Action_Failed)
+
+                session = RemoteSshSession(
+                    args.remote_ip,
+                    args.username,
+                    password,
+                    args.private_key_file,
+                )
+                operator = SetupOperator(
+                    root_path,
+                    env_setup_file,
+                    session,
+                    variables,
+                    compiled_plan=compiled_plan,
+                    **_setup_options(args),
+                )
+                ret = setup_dut(session, operator, apt_proxy=apt_proxy)
+                if args.report:
+                    write_report(args.report, [operator.get_report(ret)])
+        finally:
+            if apt_proxy is not None:
+                apt_proxy.stop()
+                apt_proxy.log_stats()
+        sys.exit(ret)
     elif args.mode == "dump":
         variables = {}
         if args.variables_file:
             conf_file = _check_file(args.variables_file)
             variables = _load_file(Path(conf_file))
+        if args.plan:
+            # rendered with the environment variables, as setup does
+            _update_variables_with_env(variables)
 
         operator = SetupOperator(
             root_path,
@@ -432,6 +1256,8 @@ def main() -> None:
             variables=variables,
             dump_file=args.output,
         )
+        if args.plan:
+            sys.exit(operator.compile_plan(args.output or "plan.json"))
         sys.exit(operator.dump())
     elif args.mode == "validate":
         validate_file_content(Path(env_setup_file))
@@ -0,0 +1,315 @@
+import hashlib
+import http.server
+import logging
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+# archive files which never change once published, only those are cached
+_IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".ddeb")
+_BY_HASH_DIR = "/by-hash/"
+# the directories of an archive and the index files of a flat repository,
+# the proxy does not fetch anything else
+_ARCHIVE_DIRS = ("/dists/", "/pool/", _BY_HASH_DIR)
+_FLAT_INDEX_FILES = ("InRelease", "Release", "Packages", "Sources")
+_HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+COPY_BUFFER_SIZE = 262144
+UPSTREAM_TIMEOUT = 60
+DEFAULT_MAX_SIZE = 4096 * 1024 * 1024
+
+
+def _is_cacheable(url):
+    """
+    Return whether the file at url is immutable: the packages of the pool
+    and the index files fetched by their hash
+    """
+    path = url.split("?", 1)[0]
+    return path.endswith(_IMMUTABLE_SUFFIXES) or _BY_HASH_DIR in path
+
+
+def _is_archive_file(url):
+    """
+    Return whether url is a file apt fetches from a repository, so the
+    DUTs cannot reach any other URL of the host network
+    """
+    path = urllib.parse.urlsplit(url).path
+    if ".." in path.split("/"):
+        return False
+    if path.endswith(_IMMUTABLE_SUFFIXES):
+        return True
+    if any(directory in path for directory in _ARCHIVE_DIRS):
+        return True
+    name = path.rsplit("/", 1)[-1]
+    return name.split(".", 1)[0] in _FLAT_INDEX_FILES
+
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._proxy()
+
+    def do_HEAD(self):
+        self._proxy()
+
+    def log_message(self, format, *args):
+        logging.debug("apt proxy: " + format, *args)
+
+    def _proxy(self):
+        if not self.path.startswith("http://"):
+            self.send_error(400, "only http:// URLs are proxied")
+            return
+        if not _is_archive_file(self.path):
+            logging.debug("apt proxy: refused %s", self.path)
+            self.send_error(403, "only APT repository files are proxied")
+            return
+
+        cache = self.server.cache
+        if not _is_cacheable(self.path):
+            self._fetch(cacheable=False)
+            return
+
+        cached = cache.open_cached(self.path)
+        if cached is None:
+            # the requests for the same file wait for a single download
+            with cache.get_url_lock(self.path):
+                cached = cache.open_cached(self.path)
+                if cached is None:
+                    self._fetch(cacheable=True)
+                    return
+        with cached:
+            self._send_cached(cached)
+
+    def _fetch(self, cacheable):
+        """
+        Forward the request to the archive, the response is stored in the
+        cache if cacheable
+        """
+        cache = self.server.cache
+        headers = {
+            key: value
+            for key, value in self.headers.items()
+            if key.lower() not in _HOP_BY_HOP_HEADERS | {"host"}
+        }
+        request = urllib.request.Request(
+            self.path, headers=headers, method=self.command
+        )
+        try:
+            response = urllib.request.urlopen(
+                request, timeout=UPSTREAM_TIMEOUT
+            )
+        except urllib.error.HTTPError as e:
+            response = e
+        except (urllib.error.URLError, OSError) as e:
+            logging.debug("apt proxy: failed to fetch %s: %s", self.path, e)
+            self.send_error(502, str(e))
+            return
+
+        with response:
+            status = response.getcode()
+            if cacheable and status == 200 and self.command == "GET":
+                cache.count("misses")
+            else:
+                cacheable = False
+                cache.count("passthrough")
+            self._send_response(response, status, cacheable)
+
+    def _send_cached(self, cached):
+        cache = self.server.cache
+        size = os.fstat(cached.fileno()).st_size
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if self.command == "GET":
+            while data := cached.read(COPY_BUFFER_SIZE):
+                self.wfile.write(data)
+        cache.count("hits")
+        cache.count("bytes_served", size)
+
+    def _send_response(self, response, status, cacheable):
+        cache = self.server.cache
+        self.send_response(status)
+        for key, value in response.headers.items():
+            if key.lower() not in _HOP_BY_HOP_HEADERS:
+                self.send_header(key, value)
+        length = response.headers.get("Content-Length")
+        if length is None:
+            # the end of the body is only told by closing the connection
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        entry = cache.new_entry() if cacheable and length else None
+        received = 0
+        try:
+            while data := response.read(COPY_BUFFER_SIZE):
+                received += len(data)
+                if entry is not None:
+                    entry.write(data)
+                self.wfile.write(data)
+        finally:
+            cache.count("bytes_downloaded", received)
+            if entry is not None:
+                complete = str(received) == length
+                cache.commit_entry(entry, self.path if complete else None)
+
+
+class AptCacheProxy:
+    """
+    HTTP proxy caching the packages downloaded by apt on the host, so
+    every DUT of a run fetches them from the archive only once.
+
+    The cache directory is shared by the runs, the least recently used
+    files are evicted when it grows over max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self._cache_dir = Path(cache_dir)
+        self._max_size = max_size
+        self._server = None
+        self._lock = threading.Lock()
+        # one lock per URL, so the DUTs wait for a single download
+        self._url_locks = {}
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "passthrough": 0,
+            "bytes_served": 0,
+            "bytes_downloaded": 0,
+            "evicted": 0,
+        }
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        """
+        Serve the proxy on an ephemeral port of the host loopback
+        """
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        # partial downloads left by an interrupted run
+        for path in self._cache_dir.glob(".*.tmp"):
+            path.unlink(missing_ok=True)
+
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), _ProxyHandler
+        )
+        self._server.daemon_threads = True
+        self._server.cache = self
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        logging.info(
+            "# apt proxy listening on port %d, caching in %s",
+            self.port,
+            self._cache_dir,
+        )
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def log_stats(self):
+        stats = self.get_stats()
+        logging.info(
+            "# apt proxy: %d hits, %d misses, %d not cacheable, "
+            "%.1f MB served from the cache, %.1f MB downloaded, "
+            "%d files evicted",
+            stats["hits"],
+            stats["misses"],
+            stats["passthrough"],
+            stats["bytes_served"] / 1024 / 1024,
+            stats["bytes_downloaded"] / 1024 / 1024,
+            stats["evicted"],
+        )
+
+    def get_url_lock(self, url):
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _get_path(self, url):
+        return self._cache_dir / hashlib.sha256(url.encode()).hexdigest()
+
+    def open_cached(self, url):
+        """
+        Return the opened cache file of url, or None if it is not cached
+        """
+        path = self._get_path(url)
+        try:
+            cached = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        # the modification time orders the files for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return cached
+
+    def new_entry(self):
+        return tempfile.NamedTemporaryFile(
+            dir=self._cache_dir, prefix=".", suffix=".tmp", delete=False
+        )
+
+    def commit_entry(self, entry, url):
+        """
+        Move a downloaded file into the cache, it is discarded when url
+        is None
+        """
+        entry.close()
+        if url is None:
+            os.unlink(entry.name)
+            return
+        os.replace(entry.name, self._get_path(url))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            total = 0
+            with os.scandir(self._cache_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+            files.sort()
+            for _, size, path in files:
+                if total <= self._max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                self._stats["evicted"] += 1
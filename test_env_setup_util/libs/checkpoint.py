@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+
+
+def get_plan_hash(actions):
+    """
+    Return the hash of the rendered actions of a plan
+    """
+    content = json.dumps([action.model_dump() for action in actions])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _default_checkpoint_dir():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "state"
+    )
+    return os.path.join(state_home, "envicorn", "checkpoints")
+
+
+class Checkpoint:
+    """
+    Local record of the actions completed on a DUT by a plan, written
+    after every successful action so a failed run can be resumed
+    """
+
+    def __init__(self, host, plan_hash, checkpoint_dir=None):
+        filename = re.sub(r"[^A-Za-z0-9_.-]+", "_", host) + ".json"
+        self._file = Path(checkpoint_dir or _default_checkpoint_dir()) / (
+            filename
+        )
+        self._host = host
+        self._plan_hash = plan_hash
+        self._completed = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Return the numbers of the actions completed by the checkpoint
+
+        Raises:
+            ValueError: if the checkpoint is invalid or was written for
+                another plan
+        """
+        try:
+            with open(self._file, "r") as fp:
+                content = json.load(fp)
+        except FileNotFoundError:
+            logging.warning(
+                "No checkpoint for %s, running all the actions", self._host
+            )
+            return set()
+
+        if (
+            not isinstance(content, dict)
+            or not isinstance(content.get("plan_hash"), str)
+            or not isinstance(content.get("completed"), list)
+            or not all(isinstance(n, int) for n in content["completed"])
+        ):
+            raise ValueError(
+                f"invalid checkpoint {self._file}, remove it to run all the "
+                "actions"
+            )
+        if content["plan_hash"] != self._plan_hash:
+            raise ValueError(
+                f"the checkpoint {self._file} was written for another plan, "
+                "the rendered actions changed since then"
+            )
+        self._completed = set(content["completed"])
+        return set(self._completed)
+
+    def mark_completed(self, number):
+        with self._lock:
+            if number not in self._completed:
+                self._completed.add(number)
+                self._write()
+
+    def is_complete(self, count):
+        return len(self._completed) >= count
+
+    def _write(self):
+        content = {
+            "host": self._host,
+            "plan_hash": self._plan_hash,
+            "completed": sorted(self._completed),
+        }
+        try:
+            self._file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self._file.parent, suffix=".tmp", delete=False
+            ) as fp:
+                json.dump(content, fp)
+            os.replace(fp.name, self._file)
+        except OSError as e:
+            logging.warning("Failed to write the checkpoint: %s", e)
+
+    def clear(self):
+        with self._lock:
+            self._file.unlink(missing_ok=True)
@@ -1,12 +1,28 @@
+import copy
+import functools
+import hashlib
+import importlib.metadata
 import json
 import logging
 import os
 import re
+import tempfile
+import threading
 import yaml
 from pathlib import Path
 from pydantic import ValidationError
 
-from test_env_setup_util.libs.model import EnvSetup
+from test_env_setup_util.libs.model import SCHEMA_VERSION, EnvSetup
+
+# validated file contents by content hash, shared by all the templates
+# including the same file
+_validated_contents = {}
+# directory of the validated contents cached across invocations,
+# None when the on-disk cache is disabled
+_cache_dir = None
+# sha256 of the local files by path, size and mtime
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
 
 
 def _check_file(file):
@@ -20,15 +36,18 @@ def _check_file(file):
 
 
 def _load_file(file: Path) -> str:
-    ext = file.suffix
-
     with open(file, "r") as fp:
-        if ext == ".json":
-            content = json.load(fp)
-        elif ext in [".yaml", ".yml"]:
-            content = yaml.safe_load(fp)
-        else:
-            raise SystemExit(f"Unsupported file format: {file}")
+        return _parse_content(file, fp.read())
+
+
+def _parse_content(file: Path, data) -> str:
+    ext = file.suffix
+    if ext == ".json":
+        content = json.loads(data)
+    elif ext in [".yaml", ".yml"]:
+        content = yaml.safe_load(data)
+    else:
+        raise SystemExit(f"Unsupported file format: {file}")
 
     return content
 
@@ -60,33 +79,141 @@ def _update_variables_with_env(variables: dict) -> None:
             variables[key] = _get_env(_find_env_pattern(value))
 
 
-def validate_file_content(file: Path) -> dict:
+def enable_cache(cache_dir=None) -> None:
     """
-    validate the file content with Pydantic models
+    Cache the validated file contents on disk, in $XDG_CACHE_HOME/envicorn
+    unless cache_dir is given
     """
-    if file.suffix not in [".yaml", ".yml", ".json"]:
-        raise ValueError("Unsupported file type")
+    global _cache_dir
+    _cache_dir = Path(cache_dir or get_cache_home())
+
+
+def get_cache_home() -> str:
+    """
+    Return the cache directory of envicorn, $XDG_CACHE_HOME/envicorn
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "envicorn")
+
+
+@functools.lru_cache(maxsize=None)
+def _cache_namespace() -> str:
+    """
+    Return the fingerprint of the validation code, cached contents of
+    other envicorn versions or schemas are never used
+    """
+    try:
+        version = importlib.metadata.version("envicorn")
+    except importlib.metadata.PackageNotFoundError:
+        version = "unknown"
+    schema = json.dumps(EnvSetup.model_json_schema(), sort_keys=True)
+    fingerprint = f"{version}\0{SCHEMA_VERSION}\0{schema}"
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+
+def _read_cache(key: str):
+    if _cache_dir is None:
+        return None
+    cache_file = _cache_dir / f"{_cache_namespace()}-{key}.json"
+    try:
+        with open(cache_file, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(key: str, content: dict) -> None:
+    if _cache_dir is None:
+        return
+    cache_file = _cache_dir / f"{_cache_namespace()}-{key}.json"
+    try:
+        _cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=_cache_dir, suffix=".tmp", delete=False
+        ) as fp:
+            json.dump(content, fp)
+        os.replace(fp.name, cache_file)
+    except OSError as e:
+        logging.debug("Failed to write the cache file %s: %s", cache_file, e)
+
+
+def file_sha256(file) -> str:
+    """
+    Return the sha256 of a local file, cached by path, size and mtime
+    in memory and on disk once enable_cache is called
+    """
+    stat = os.stat(file)
+    path = os.path.abspath(file)
+    key = f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+
+        cache_key = hashlib.sha256(key.encode()).hexdigest()
+        cached = _read_cache(cache_key)
+        if cached is not None:
+            digest = cached["sha256"]
+        else:
+            logging.debug("Computing the sha256 of %s", path)
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            _write_cache(cache_key, {"sha256": digest})
+        _file_hashes[key] = digest
+        return digest
+
+
+def _validate_content(file: Path, data: bytes) -> dict:
+    key = hashlib.sha256(file.suffix.encode() + b"\0" + data).hexdigest()
+    validated_content = _validated_contents.get(key)
+    if validated_content is None:
+        validated_content = _read_cache(key)
+    if validated_content is not None:
+        logging.debug("Using the cached validation of %s", file)
+        _validated_contents[key] = validated_content
+        return validated_content
 
     logging.info(
         "Validating the contents of %s file with Pydantic models",
         file,
     )
-
-    content = _load_file(file)
+    content = _parse_content(file, data)
     try:
-        env_setup_model = EnvSetup.model_validate(content)
-        if "global_templates" in str(file.parent):
-            for action in env_setup_model.actions:
-                if action.bypass_condition:
-                    raise KeyError(
-                        "bypass_condition is not allowed in global_templates"
-                    )
-        validated_content = env_setup_model.model_dump()
+        validated_content = EnvSetup.model_validate(content).model_dump()
     except ValidationError as e:
         logging.error("Validation failed for %s:\n%s", file, e)
         raise
 
+    _validated_contents[key] = validated_content
+    _write_cache(key, validated_content)
+    return validated_content
+
+
+def validate_file_content(file: Path) -> dict:
+    """
+    validate the file content with Pydantic models
+
+    The validated contents are cached by content hash, in memory and on
+    disk once enable_cache is called, so a file is parsed and validated
+    only once whatever the number of templates including it.
+    """
+    if file.suffix not in [".yaml", ".yml", ".json"]:
+        raise ValueError("Unsupported file type")
+
+    validated_content = _validate_content(file, file.read_bytes())
+    if "global_templates" in str(file.parent):
+        for action in validated_content["actions"]:
+            if action["bypass_condition"]:
+                raise KeyError(
+                    "bypass_condition is not allowed in global_templates"
+                )
+
     logging.debug("\tthe contents of %s file as following", file)
     logging.debug(validated_content)
 
-    return validated_content
+    # callers are free to modify the returned contents
+    return copy.deepcopy(validated_content)
@@ -7,8 +7,14 @@ class SnapCommandError(Exception):
 
 
 class SshCommandError(Exception):
-    def __init__(self, command):
-        super().__init__(f"failed to executed '{command}'")
+    def __init__(self, command, exit_code=None, output=None):
+        message = f"failed to executed '{command}'"
+        if exit_code is not None:
+            message += f" (exit code {exit_code})"
+        if output:
+            message += f"\n{output.rstrip()}"
+        super().__init__(message)
+        self.exit_code = exit_code
 
 
 class ExitCode(enum.IntEnum):
@@ -0,0 +1,116 @@
+import contextvars
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from test_env_setup_util.libs.common import _load_file
+from test_env_setup_util.libs.exceptions import ExitCode
+from test_env_setup_util.libs.model import Inventory
+
+current_host = contextvars.ContextVar("envicorn_host", default="-")
+
+
+class HostLogFilter(logging.Filter):
+    """
+    Tag log records with the DUT they belong to.
+    When a host is given, only the records of that host are accepted.
+    """
+
+    def __init__(self, host=None):
+        super().__init__()
+        self._host = host
+
+    def filter(self, record):
+        record.host = current_host.get()
+        return self._host is None or record.host == self._host
+
+
+def load_inventory(file: Path) -> list:
+    """
+    Load the DUTs from an inventory file, which is either a list of hosts
+    or a mapping with a 'hosts' key
+    """
+    content = _load_file(file)
+    if isinstance(content, list):
+        content = {"hosts": content}
+    return Inventory.model_validate(content).hosts
+
+
+def _host_log_file(log_dir, ip):
+    filename = re.sub(r"[^A-Za-z0-9_.-]+", "_", ip)
+    return os.path.join(log_dir, f"envicorn_{filename}.log")
+
+
+def _run_host(host, worker, log_dir):
+    current_host.set(host.ip)
+    handler = logging.FileHandler(_host_log_file(log_dir, host.ip))
+    handler.setLevel(logging.DEBUG)
+    handler.addFilter(HostLogFilter(host.ip))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s [%(levelname)s] - %(message)s")
+    )
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+
+    start = time.monotonic()
+    try:
+        exit_code = worker(host)
+    except Exception as err:
+        logging.error("# failed to setup %s: %s", host.ip, err)
+        exit_code = ExitCode.Action_Failed
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    return exit_code, time.monotonic() - start
+
+
+def run_fleet(hosts, worker, max_workers, log_dir="."):
+    """
+    Run worker(host) against all hosts with at most max_workers at once
+
+    Args:
+        hosts (list): InventoryHost entries
+        worker (callable): setup a single host and return an ExitCode
+        max_workers (int): number of hosts handled concurrently
+        log_dir (str): directory of the per-host log files
+
+    Returns:
+        ExitCode: Success if every host succeeded, otherwise the highest
+            exit code among the hosts
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    logging.info(
+        "# Setting up %d DUTs with %d workers", len(hosts), max_workers
+    )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            host.ip: executor.submit(
+                contextvars.copy_context().run,
+                _run_host,
+                host,
+                worker,
+                log_dir,
+            )
+            for host in hosts
+        }
+        results = {ip: future.result() for ip, future in futures.items()}
+
+    logging.info("\n\n#### Fleet Summary ####")
+    logging.info(
+        "%-20s %-8s %-40s %s", "HOST", "RESULT", "EXIT CODE", "DURATION"
+    )
+    for ip, (exit_code, duration) in results.items():
+        logging.info(
+            "%-20s %-8s %-40s %.1fs",
+            ip,
+            "Success" if exit_code == ExitCode.Success else "Failed",
+            f"{int(exit_code)} ({ExitCode(exit_code).name})",
+            duration,
+        )
+
+    return ExitCode(max(exit_code for exit_code, _ in results.values()))
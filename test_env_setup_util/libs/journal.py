@@ -0,0 +1,141 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from test_env_setup_util.libs.common import file_sha256
+from test_env_setup_util.libs.exceptions import SshCommandError
+from test_env_setup_util.libs.operator.common import expand_sources
+from test_env_setup_util.libs.scheduler import get_topological_order
+
+JOURNAL_FILE = "/var/lib/envicorn/journal.json"
+JOURNAL_VERSION = 1
+# number of entries kept in the journal, the oldest ones are dropped
+MAX_JOURNAL_ENTRIES = 1000
+
+
+def action_hash(action):
+    """
+    Return the content hash of a rendered action, the files uploaded by
+    scp_command actions are part of it
+
+    Args:
+        action: validated action model
+    """
+    data = action.model_dump(exclude={"id", "depends_on"})
+    if action.action == "scp_command":
+        data["source_sha256"] = {
+            path: file_sha256(path)
+            for source in expand_sources(action.source)
+            for path in _list_files(source)
+        }
+    content = json.dumps(data, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _list_files(source):
+    if not os.path.isdir(source):
+        return [source]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        files.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    return files
+
+
+class ActionJournal:
+    """
+    Journal of the actions applied to the DUT, stored on the DUT itself
+    so every machine running envicorn against it shares the same journal
+    """
+
+    def __init__(self, session, path=JOURNAL_FILE):
+        self._session = session
+        self._path = path
+        self._entries = {}
+
+    def load(self):
+        _, stdout, _ = self._session.launch_ssh_command(
+            f"sudo cat {self._path} 2>/dev/null || true",
+            tail_lines=None,
+            log_output=False,
+        )
+        if not stdout.strip():
+            return
+        try:
+            content = json.loads(stdout)
+            if content["version"] == JOURNAL_VERSION:
+                self._entries = content["actions"]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(
+                "Ignoring the invalid journal %s: %s", self._path, e
+            )
+
+    def is_applied(self, digest):
+        entry = self._entries.get(digest)
+        return entry is not None and entry["result"] == "Success"
+
+    def record(self, digest, action, result):
+        self._entries[digest] = {
+            "action": action,
+            "result": result,
+            "applied_at": datetime.datetime.now(
+                datetime.timezone.utc
+            ).isoformat(),
+        }
+
+    def save(self):
+        """
+        Write the journal to the DUT, a failure is only reported since
+        the actions themselves were applied
+        """
+        entries = sorted(
+            self._entries.items(),
+            key=lambda entry: entry[1]["applied_at"],
+        )[-MAX_JOURNAL_ENTRIES:]
+        content = json.dumps(
+            {"version": JOURNAL_VERSION, "actions": dict(entries)}, indent=1
+        )
+        tmp_file = ".envicorn-journal.json"
+        try:
+            self._session.launch_content_upload(
+                {tmp_file: (content.encode("utf-8"), 0o644)}
+            )
+            self._session.launch_ssh_command(
+                f"sudo install -D -m 644 {tmp_file} {self._path}\n"
+                f"rm -f {tmp_file}"
+            )
+        except SshCommandError as e:
+            logging.warning("Failed to save the journal %s: %s", self._path, e)
+
+
+def get_unchanged_actions(graph, hashes, journal, prelude=0):
+    """
+    Return the actions which can be skipped: they were applied with the
+    same content before and so were all the actions they depend on
+
+    Args:
+        graph (dict): graph returned by build_action_graph
+        hashes (dict): action index to its content hash, the actions
+            without one are considered changed
+        journal (ActionJournal): loaded journal of the DUT
+        prelude (int): number of leading actions generated by envicorn,
+            they are never journaled and only skipped with all the others
+
+    Returns:
+        set: indices of the unchanged actions
+    """
+    unchanged = set(range(prelude))
+    for idx in get_topological_order(graph):
+        if (
+            idx >= prelude
+            and idx in hashes
+            and journal.is_applied(hashes[idx])
+            and graph[idx] <= unchanged
+        ):
+            unchanged.add(idx)
+
+    if len(unchanged) < len(graph):
+        unchanged.difference_update(range(prelude))
+    return unchanged
@@ -1,11 +1,14 @@
 import re
 
 from pydantic import (
+    AliasChoices,
     BaseModel,
+    Field,
     model_validator,
     field_validator,
     Discriminator,
     Tag,
+    TypeAdapter,
 )
 from typing import Annotated, Literal, Union
 
@@ -23,6 +26,25 @@ class BaseAction(BaseModel):
 
     ignore_error: bool = False
     bypass_condition: str | None = None
+    id: str | None = None
+    # None keeps the file order, otherwise only the listed actions
+    # have to be completed before this one starts
+    depends_on: list[str] | None = Field(
+        default=None, validation_alias=AliasChoices("depends_on", "after")
+    )
+
+    @field_validator("id")
+    def check_id(cls, id: str | None):
+        if id is None:
+            return id
+        return _ensure_non_empty_str(id, "id")
+
+    @field_validator("depends_on", mode="before")
+    def check_depends_on(cls, depends_on):
+        if depends_on is None or depends_on == []:
+            return depends_on
+        depends_on = _normalize_str_or_list(depends_on, "depends_on")
+        return [depends_on] if isinstance(depends_on, str) else depends_on
 
 
 def _ensure_non_empty_str(value: str, field_name: str) -> str:
@@ -105,8 +127,21 @@ class SshCommandAction(BaseAction):
 
 class ScpCommandAction(BaseAction):
     action: Literal["scp_command"]
-    source: str
+    # directories, glob patterns and lists are uploaded as a tar stream
+    source: str | list[str]
     destination: str
+    skip_if_identical: bool = False
+    compression: str | None = None
+
+    @field_validator("source", mode="before")
+    def check_source(cls, source):
+        return _normalize_str_or_list(source, "source")
+
+    @field_validator("compression")
+    def check_compression(cls, compression: str | None):
+        if compression not in [None, "gzip", "zstd"]:
+            raise ValueError("compression must be one of gzip, zstd")
+        return compression
 
 
 class CreateSystemServiceAction(BaseAction):
@@ -288,5 +323,42 @@ ActionUnion = Annotated[
 ]
 
 
+# bump when a validator changes the validated contents without changing
+# the JSON schema, to invalidate the contents cached on disk
+SCHEMA_VERSION = 1
+
+
 class EnvSetup(BaseModel):
     actions: list[ActionUnion]
+
+
+# validator of the rendered actions, built once for all the plans
+ACTIONS_ADAPTER = TypeAdapter(list[ActionUnion])
+
+
+class InventoryHost(BaseModel):
+    """A DUT entry of the inventory file used by the fleet mode."""
+
+    ip: str
+    username: str | None = None
+    password: str | None = None
+    private_key_file: str | None = None
+    variables: dict = {}
+
+    @field_validator("ip")
+    def check_ip(cls, ip: str):
+        return _ensure_non_empty_str(ip, "ip")
+
+
+class Inventory(BaseModel):
+    hosts: list[InventoryHost]
+
+    @field_validator("hosts")
+    def check_hosts(cls, hosts: list[InventoryHost]):
+        if not hosts:
+            raise ValueError("hosts cannot be an empty list")
+        ips = [host.ip for host in hosts]
+        duplicated = sorted({ip for ip in ips if ips.count(ip) > 1})
+        if duplicated:
+            raise ValueError(f"duplicated hosts: {', '.join(duplicated)}")
+        return hosts
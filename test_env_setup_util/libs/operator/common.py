@@ -1,69 +1,218 @@
+import glob
 import logging
 import os
+import re
 import subprocess
-import tempfile
 from pathlib import Path
+from shlex import quote
 
+from test_env_setup_util.libs.common import file_sha256
+from test_env_setup_util.libs.exceptions import SshCommandError
 
-def ssh_command(session, data):
-    session.launch_ssh_command(
-        data["command"],
-        continue_on_error=data.get("continue_on_error", False),
-    )
+_SHA256_PATTERN = re.compile(r"^([0-9a-f]{64})\s", re.MULTILINE)
+_SERVICE_STATES_MARKER = "envicorn: service states"
+SERVICE_READY_TIMEOUT = 60
+# states of a service which started or ran successfully
+SERVICE_READY_STATES = ["active", "inactive"]
 
 
-def scp_command(session, data):
-    session.launch_scp_upload(data["source"], data["destination"])
+def ssh_command(session, action):
+    session.launch_ssh_command(
+        action.command, continue_on_error=action.continue_on_error
+    )
 
 
-def _gen_file_and_scp(contents, filename, session):
-    with tempfile.NamedTemporaryFile(delete=False) as fp:
-        fp.write(contents)
-        fp.close()
-        session.launch_scp_upload(fp.name, filename)
-    Path(fp.name).unlink()
+def scp_command(session, action):
+    """
+    Upload the source file to the DUT, unless skip_if_identical is set
+    and the DUT already has the same content at the destination.
+    Directories, glob patterns and lists of sources are streamed as a tar
+    archive and extracted in the destination directory.
+
+    Returns:
+        bool: whether the source was uploaded
+    """
+    source = action.source
+    destination = action.destination
+    if (
+        isinstance(source, list)
+        or glob.has_magic(source)
+        or Path(source).is_dir()
+    ):
+        session.launch_tar_upload(
+            expand_sources(source), destination, action.compression
+        )
+        return True
+
+    if action.skip_if_identical and Path(source).is_file():
+        with session.timings.span("checksum"):
+            local_hash = file_sha256(source)
+        if get_remote_sha256(session, source, destination) == local_hash:
+            logging.info(
+                "# %s is identical on the DUT, skip the upload", destination
+            )
+            return False
+
+    session.launch_scp_upload(source, destination)
+    return True
+
+
+def expand_sources(source):
+    sources = []
+    for pattern in source if isinstance(source, list) else [source]:
+        if not glob.has_magic(pattern):
+            sources.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"{pattern} does not match any file")
+        sources.extend(matches)
+    return sources
+
+
+def get_remote_sha256(session, source, destination):
+    """
+    Return the sha256 of the file that uploading source to destination
+    would replace, or None if there is no such file
+    """
+    command = (
+        f"target={quote(destination)}\n"
+        '[ -d "$target" ] && '
+        f'target="$target"/{quote(os.path.basename(source))}\n'
+        'sha256sum -- "$target" 2>/dev/null || true'
+    )
+    _, stdout, _ = session.launch_ssh_command(command)
+    match = _SHA256_PATTERN.search(stdout)
+    return match.group(1) if match else None
 
 
-def create_system_service(session, data):
-    logging.info("Creating the %s service", data["service_name"])
+def create_system_service(session, action):
+    logging.info("Creating the %s service", action.service_name)
 
-    # create script file if needed
-    script_file = data.get("script_file")
-    script_file_dest = data.get("script_file_dest")
+    # upload the service file and the script file if needed
+    service_file = action.service_name
+    contents = {service_file: (action.service_raw.encode("utf-8"), 0o644)}
+    script_file = action.script_file
+    script_file_dest = action.script_file_dest
     if script_file:
-        _gen_file_and_scp(
-            data["script_raw"].encode("utf-8"), script_file, session
-        )
+        contents[script_file] = (action.script_raw.encode("utf-8"), 0o755)
+    session.launch_content_upload(contents)
 
-        session.launch_ssh_command(f"chmod 755 {script_file}")
-        if script_file_dest:
-            session.launch_ssh_command(
-                f"sudo mv {script_file} {script_file_dest}"
-            )
+    steps = []
+    if script_file and script_file_dest:
+        steps.append((f"sudo mv {script_file} {script_file_dest}", [0]))
 
-    # Create service file
-    service_file = data["service_name"]
+    # Install the service file and check the service
     service_file_dest = os.path.join(
-        data["service_file_dest"], data["service_name"]
+        action.service_file_dest, action.service_name
     )
-    _gen_file_and_scp(
-        data["service_raw"].encode("utf-8"), service_file, session
+    steps += [
+        (f"sudo mv {service_file} {service_file_dest}", [0]),
+        ("sudo systemctl daemon-reload", [0]),
+        (f"sudo systemctl enable {action.service_name}", [0]),
+        (f"sudo systemctl start {action.service_name}", [0]),
+        (f"sudo systemctl status {action.service_name}", [0, 3]),
+    ]
+
+    if action.post_commands:
+        steps.append((action.post_commands, [0]))
+
+    session.launch_ssh_steps(steps)
+
+
+def create_system_services(session, service_actions):
+    """
+    Create several services at once, with a single daemon-reload and
+    systemctl enable --now call, which waits for the start jobs of all
+    of them, so a oneshot service is only inactive once it completed
+
+    Args:
+        session: SSH session object
+        service_actions: create_service actions
+
+    Returns:
+        dict: service name to its state reported by systemctl is-active,
+            None if the services have to be created one by one
+    """
+    names = list(dict.fromkeys(a.service_name for a in service_actions))
+    logging.info("Creating the %s services at once", ", ".join(names))
+
+    contents = {}
+    moves = {}
+    for action in service_actions:
+        script_file = action.script_file
+        if script_file:
+            contents[script_file] = (
+                action.script_raw.encode("utf-8"),
+                0o755,
+            )
+            if action.script_file_dest:
+                moves[script_file] = action.script_file_dest
+        service_file = action.service_name
+        contents[service_file] = (action.service_raw.encode("utf-8"), 0o644)
+        moves[service_file] = os.path.join(
+            action.service_file_dest, action.service_name
+        )
+
+    units = " ".join(names)
+    steps = [(f"sudo mv {src} {dest}", [0]) for src, dest in moves.items()]
+    steps += [
+        ("sudo systemctl daemon-reload", [0]),
+        (f"sudo systemctl enable --now {units}", [0]),
+        (_get_wait_services_command(units), [0]),
+        (f"sudo systemctl status {units}", [0, 3]),
+    ]
+    try:
+        session.launch_content_upload(contents)
+        stdout, _ = session.launch_ssh_steps(steps)
+    except SshCommandError as err:
+        logging.warning(
+            "Batched creation failed (%s), "
+            "falling back to create the services one by one",
+            err,
+        )
+        return None
+
+    _, _, output = stdout.partition(_SERVICE_STATES_MARKER)
+    states = [line.strip() for line in output.splitlines() if line.strip()]
+    return dict(zip(names, states))
+
+
+def _get_wait_services_command(units):
+    """
+    Return the command polling the units until none of them is changing
+    state, e.g. restarting, then printing their states
+    """
+    return (
+        f"for i in $(seq {SERVICE_READY_TIMEOUT}); do\n"
+        f"  states=$(systemctl is-active {units} || true)\n"
+        '  case "$states" in\n'
+        "    *activating*|*reloading*) sleep 1 ;;\n"
+        "    *) break ;;\n"
+        "  esac\n"
+        "done\n"
+        f'echo "{_SERVICE_STATES_MARKER}"\n'
+        f"systemctl is-active {units} || true"
     )
 
-    session.launch_ssh_command(f"chmod 644 {service_file}")
-    session.launch_ssh_command(f"sudo mv {service_file} {service_file_dest}")
 
-    # Check service
-    session.launch_ssh_command("sudo systemctl daemon-reload")
-    session.launch_ssh_command(f"sudo systemctl enable {data['service_name']}")
-    session.launch_ssh_command(f"sudo systemctl start {data['service_name']}")
-    session.launch_ssh_command(
-        f"sudo systemctl status {data['service_name']}",
-        [0, 3],
-    )
+def check_system_service(session, action, state):
+    """
+    Report the state of a service created by create_system_services
+    and run its post_commands
+
+    The service was started like by create_system_service, whose
+    systemctl status accepts any state of a loaded unit, so a service
+    which is not ready is only reported
+    """
+    name = action.service_name
+    if state in SERVICE_READY_STATES:
+        logging.info("# %s service is %s", name, state)
+    else:
+        logging.warning("# %s service is %s", name, state)
 
-    if data.get("post_commands"):
-        session.launch_ssh_command(data["post_commands"])
+    if action.post_commands:
+        session.launch_ssh_command(action.post_commands)
 
 
 def run_command(command, shell=False, check=True):
@@ -1,10 +1,13 @@
+import hashlib
 import logging
 import re
 import tempfile
 from pathlib import Path
 from shlex import quote
+from textwrap import indent
 from urllib.parse import urlsplit
 
+from test_env_setup_util.libs.exceptions import SshCommandError
 from test_env_setup_util.libs.operator.common import run_command
 from test_env_setup_util.libs.common import _find_env_pattern, _get_env
 
@@ -13,19 +16,216 @@ _PPA_URL_PATTERN = re.compile(
     r"^ppa:([a-z0-9][a-z0-9.+\-]*)/([a-z0-9][a-z0-9.+\-]*)$"
 )
 
+# touched after every apt update run by envicorn
+_APT_LISTS_STAMP = "/var/lib/apt/lists/partial"
+_APT_LAST_UPDATE_CMD = (
+    "last_update=$(ls -td /var/lib/apt/lists "
+    f"{_APT_LISTS_STAMP} "
+    "/var/lib/apt/periodic/update-success-stamp 2>/dev/null "
+    "| head -n 1)"
+)
+_APT_SOURCE_CURRENT_MARKER = "envicorn: apt source is current"
+_DPKG_QUERY_MARKER = "envicorn: dpkg-query"
+_DPKG_QUERY_CMD = "dpkg-query -W -f='${Package} ${Version} ${Status}\\n'"
+APT_PROXY_CONF = "/etc/apt/apt.conf.d/99envicorn-proxy"
+APT_PROXY_DETECT = "/etc/apt/envicorn-proxy-detect"
+
+
+def get_apt_update_command(max_age, force=False):
+    """
+    Build the command refreshing the package lists of the DUT.
+
+    Unless forced, apt update only runs when the package lists are older
+    than max_age seconds or an APT source was modified after the last
+    update, everything is checked on the DUT within the same command.
+    """
+    update_cmd = (
+        "sudo DEBIAN_FRONTEND=noninteractive apt update\n"
+        f"sudo touch {_APT_LISTS_STAMP}"
+    )
+    if force:
+        return update_cmd
+
+    return (
+        f"{_APT_LAST_UPDATE_CMD}\n"
+        'updated_at=$(stat -c %Y "$last_update" 2>/dev/null || echo 0)\n'
+        "age=$(( $(date +%s) - updated_at ))\n"
+        "changed=$(find /etc/apt/sources.list /etc/apt/sources.list.d "
+        '-newer "$last_update" 2>/dev/null | head -n 1)\n'
+        f'if [ "$age" -lt {int(max_age)} ] && [ -z "$changed" ]; then\n'
+        '    echo "package lists were updated ${age}s ago, skip apt update"\n'
+        "else\n"
+        f"{indent(update_cmd, '    ')}\n"
+        "fi"
+    )
+
+
+def set_apt_proxy(session, port):
+    """
+    Make apt download through the proxy forwarded to the port of the DUT
+    loopback.
+
+    The proxy is set by a Proxy-Auto-Detect command which only returns it
+    while the port is listening, so a configuration left behind by an
+    interrupted run never breaks apt.
+    """
+    detect = (
+        "#!/bin/bash\n"
+        f"if (exec 3<>/dev/tcp/127.0.0.1/{int(port)}) 2>/dev/null; then\n"
+        f"    echo http://127.0.0.1:{int(port)}/\n"
+        "fi\n"
+    )
+    conf = f'Acquire::http::Proxy-Auto-Detect "{APT_PROXY_DETECT}";\n'
+    session.launch_content_upload(
+        {
+            ".envicorn-proxy-detect": (detect.encode("utf-8"), 0o755),
+            ".envicorn-proxy.conf": (conf.encode("utf-8"), 0o644),
+        }
+    )
+    session.launch_ssh_command(
+        f"sudo install -m 755 .envicorn-proxy-detect {APT_PROXY_DETECT}\n"
+        f"sudo install -m 644 .envicorn-proxy.conf {APT_PROXY_CONF}\n"
+        "rm -f .envicorn-proxy-detect .envicorn-proxy.conf"
+    )
+    logging.info("# apt of the DUT downloads through port %s", port)
+
+
+def unset_apt_proxy(session):
+    try:
+        session.launch_ssh_command(
+            f"sudo rm -f {APT_PROXY_CONF} {APT_PROXY_DETECT}"
+        )
+    except Exception as e:
+        logging.warning("Failed to remove the apt proxy configuration: %s", e)
+
+
+def _get_package_spec(debian_action):
+    spec = quote(debian_action.name)
+    if debian_action.revision:
+        spec += f"={quote(debian_action.revision)}"
+    return spec
+
+
+def _is_installed(packages, debian_action):
+    """
+    Whether the DUT already has the package, with the same version
+    if a revision is pinned
+    """
+    version = packages.get(debian_action.name)
+    if version is None:
+        return False
+    return not debian_action.revision or (version == debian_action.revision)
+
+
+def _launch_apt_install(session, debian_actions):
+    """
+    Install the packages and query their versions in the same command
+    to keep the package cache up to date
+    """
+    packages = get_debian_state(session)
+    names = " ".join(quote(action.name) for action in debian_actions)
+    _cmd = (
+        "sudo DEBIAN_FRONTEND=noninteractive apt install -y "
+        + " ".join(_get_package_spec(action) for action in debian_actions)
+        + f'\necho "{_DPKG_QUERY_MARKER}"\n'
+        + f"{_DPKG_QUERY_CMD} {names} || true"
+    )
+    _, stdout, _ = session.launch_ssh_command(_cmd)
+    _, _, query = stdout.partition(_DPKG_QUERY_MARKER)
+    packages.update(parse_dpkg_query(query))
+
+
+def install_debian(session, debian_action):
+    if _is_installed(get_debian_state(session), debian_action):
+        logging.info(
+            "%s debian package has been installed with the requested version",
+            debian_action.name,
+        )
+        return
+
+    logging.info("install %s debian package", debian_action.name)
+    _launch_apt_install(session, [debian_action])
 
-def install_debian(session, debian_data):
-    _cmd = "sudo DEBIAN_FRONTEND=noninteractive apt install -y {pkg}".format(
-        pkg=quote(debian_data["name"])
+
+def install_debian_batch(session, debian_actions):
+    """
+    Install several debian packages within a single apt transaction
+
+    Args:
+        session: SSH session object
+        debian_actions: install_debian actions
+
+    Returns:
+        True if all packages were installed, False if the transaction failed
+        and the packages have to be installed one by one
+    """
+    packages = get_debian_state(session)
+    missing = [
+        debian_action
+        for debian_action in debian_actions
+        if not _is_installed(packages, debian_action)
+    ]
+    if not missing:
+        logging.info(
+            "%s debian packages have been installed with the requested "
+            "versions",
+            ", ".join(action.name for action in debian_actions),
+        )
+        return True
+
+    logging.info(
+        "install %s debian packages in one transaction",
+        ", ".join(action.name for action in missing),
     )
-    if debian_data.get("revision"):
-        _cmd += f"={quote(debian_data['revision'])}"
+    try:
+        _launch_apt_install(session, missing)
+        return True
+    except SshCommandError as err:
+        logging.warning(
+            "Batched installation failed (%s), "
+            "falling back to install the packages one by one",
+            err,
+        )
+        return False
 
-    logging.info("install %s debian package", debian_data["name"])
-    session.launch_ssh_command(_cmd)
 
+def get_debian_state(session):
+    """
+    Return the debian packages installed on the DUT, the DUT is only
+    probed once per session
 
-def add_apt_source(session, ppa_data):
+    Returns:
+        dict: package name to its installed version
+    """
+    return session.get_remote_state("debian", _probe_debian_state)
+
+
+def _probe_debian_state(session):
+    _, stdout, _ = session.launch_ssh_command(
+        _DPKG_QUERY_CMD, tail_lines=None, log_output=False
+    )
+    return parse_dpkg_query(stdout)
+
+
+def parse_dpkg_query(data):
+    """
+    Parse the '${Package} ${Version} ${Status}' lines printed by dpkg-query,
+    only the packages which are fully installed and not selected for
+    removal are returned, held or not
+    """
+    packages = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if (
+            len(fields) == 5
+            and fields[2] in ("install", "hold")
+            and fields[3:] == ["ok", "installed"]
+        ):
+            packages[fields[0]] = fields[1]
+    return packages
+
+
+def add_apt_source(session, source_action, force_update=False):
     """
     Add a single APT source using Deb822 format with optional authentication and GPG signing.
 
@@ -89,18 +289,18 @@ def add_apt_source(session, ppa_data):
         fingerprint: XXXXXXXXXXXXXXXXXXXXXXXXXXXXX
         key_server: keyserver.ubuntu.com
     """
-    ppa_url = ppa_data.get("ppa_url")
-    ppa_name = ppa_data.get("ppa_name")
-    suites = ppa_data.get("suites")
-    deb822_overrides = _extract_deb822_fields(ppa_data)
+    ppa_url = source_action.ppa_url
+    ppa_name = source_action.ppa_name
+    suites = source_action.suites
+    deb822_overrides = _extract_deb822_fields(source_action)
 
     if not ppa_name:
         raise ValueError("ppa_name is required")
     if not ppa_url and not deb822_overrides:
         raise ValueError("Either ppa_url or deb822 fields are required")
 
-    auth_user = ppa_data.get("auth_user")
-    auth_token_key = ppa_data.get("auth_token")
+    auth_user = source_action.auth_user
+    auth_token_key = source_action.auth_token
 
     auth_token = None
     if auth_user and auth_token_key:
@@ -123,10 +323,10 @@ def add_apt_source(session, ppa_data):
         deb822_payload = deb822_overrides
 
     # Setup GPG key if fingerprint is provided
-    fingerprint = ppa_data.get("fingerprint")
+    fingerprint = source_action.fingerprint
     if _find_env_pattern(fingerprint):
         fingerprint = _get_env(_find_env_pattern(fingerprint))
-    key_server = ppa_data.get("key_server") or "keyserver.ubuntu.com"
+    key_server = source_action.key_server or "keyserver.ubuntu.com"
     if fingerprint:
         gpg_key_path = _setup_gpg_key_via_scp(
             session, ppa_name, fingerprint, key_server
@@ -145,7 +345,7 @@ def add_apt_source(session, ppa_data):
 
     if auth_user and auth_token_key:
         # Auto-derive auth_machine from uris if not explicitly provided
-        auth_machine = ppa_data.get("auth_machine")
+        auth_machine = source_action.auth_machine
         if not auth_machine:
             auth_machine = _derive_auth_machine_from_uris(deb822_payload)
         auth_setup = _setup_apt_auth_via_scp(
@@ -167,8 +367,19 @@ def add_apt_source(session, ppa_data):
             ppa_name,
         )
 
+    deb822_content = _render_deb822_source(deb822_payload)
+    if not force_update and _is_apt_source_current(
+        session, ppa_name, deb822_content
+    ):
+        logging.info(
+            "APT source %s is unchanged and its package lists are up to "
+            "date, skip apt update",
+            ppa_name,
+        )
+        return
+
     source_setup = _setup_deb822_source_via_scp(
-        session, ppa_name, _render_deb822_source(deb822_payload)
+        session, ppa_name, deb822_content
     )
     if not source_setup:
         raise ValueError(f"Failed to configure deb822 source for {ppa_name}")
@@ -236,7 +447,7 @@ def _build_deb822_from_ppa_url(ppa_url, suites):
     return _build_deb822_from_ppa(ppa_url, suites)
 
 
-def _extract_deb822_fields(ppa_data):
+def _extract_deb822_fields(source_action):
     field_keys = [
         "types",
         "uris",
@@ -248,9 +459,9 @@ def _extract_deb822_fields(ppa_data):
         "enabled",
     ]
     payload = {
-        key: ppa_data.get(key)
+        key: getattr(source_action, key)
         for key in field_keys
-        if ppa_data.get(key) is not None
+        if getattr(source_action, key) is not None
     }
     return payload or None
 
@@ -375,6 +586,28 @@ def _setup_deb822_source_via_scp(session, ppa_name, deb822_content):
                 logging.warning("Failed to cleanup temp file: %s", str(e))
 
 
+def _is_apt_source_current(session, ppa_name, deb822_content):
+    """
+    Check whether the DUT already has the same Deb822 source and its
+    package lists were updated after the source file was written.
+    Rewriting an identical source would only force another apt update.
+    """
+    source_filename = f"{_sanitize_source_name(ppa_name)}.sources"
+    remote_source_path = quote(f"/etc/apt/sources.list.d/{source_filename}")
+    digest = hashlib.sha256(deb822_content.encode("utf-8")).hexdigest()
+    cmd = (
+        f"{_APT_LAST_UPDATE_CMD}\n"
+        f"source_sum=$(sha256sum {remote_source_path} 2>/dev/null "
+        "| cut -d ' ' -f 1)\n"
+        f'if [ "$source_sum" = "{digest}" ] && '
+        f'[ {remote_source_path} -ot "$last_update" ]; then\n'
+        f'    echo "{_APT_SOURCE_CURRENT_MARKER}"\n'
+        "fi"
+    )
+    _, stdout, _ = session.launch_ssh_command(cmd, continue_on_error=True)
+    return _APT_SOURCE_CURRENT_MARKER in stdout.splitlines()
+
+
 def _validate_apt_source_with_update(session, ppa_name):
     """
     Validate a newly added Deb822 source by running apt update only for that source.
@@ -1,81 +1,343 @@
 import logging
-import re
+import threading
+import time
 
 from shlex import quote
-from test_env_setup_util.libs.exceptions import SnapCommandError
+from test_env_setup_util.libs.exceptions import (
+    SnapCommandError,
+    SshCommandError,
+)
 
+_REFRESH_LIST_MARKER = "envicorn: snap refresh --list"
+_REFRESH_LIST_FAILED = "envicorn: snap refresh --list failed"
+_CHANGE_MARKER = "envicorn: snap change"
 
-def install_snap(session, snap_data):
-    check_snap_utility(session)
 
-    name = snap_data["name"]
-    revision = snap_data.get("revision")
-    track = snap_data.get("track")
-    risk = snap_data.get("risk")
-    branch = snap_data.get("branch")
+def install_snap(session, snap_action):
+    snaps = get_snap_state(session)
+    name = snap_action.name
 
     ret = 0
-    installed_rev, installed_tracks = get_snap_info(session, name)
-    if revision == installed_rev.strip("()"):
+    _cmd = _get_snap_command(snaps, snap_action)
+    if _cmd:
+        # list the snap in the same command to keep the cache up to date
+        ret, stdout, _ = session.launch_ssh_command(
+            f"{_cmd}\nsnap list {quote(name)}"
+        )
+        snaps["installed"].update(parse_snap_list(stdout))
+        if snaps["updates"] is not None:
+            snaps["updates"].discard(name)
+
+    if ret == 0:
+        run_post_commands(session, snap_action)
+
+
+def run_post_commands(session, snap_action):
+    if snap_action.post_commands:
+        command = snap_action.post_commands
+        ret, _, _ = session.launch_ssh_command(command)
+        if ret != 0:
+            raise SnapCommandError(command)
+
+
+def install_snap_from_cache(session, snap_action, snap_cache):
+    """
+    Side-load the snap from the host-side cache: the .snap and .assert
+    files are uploaded to the DUT, then acknowledged and installed from
+    the file, so the DUT does not download it from the store itself
+    """
+    snaps = get_snap_state(session)
+    name = snap_action.name
+    revision = snap_action.revision
+
+    if _get_snap_command(snaps, snap_action) is not None:
+        snap_file, assert_file, revision = snap_cache.get(
+            name,
+            get_architecture(session),
+            revision=revision,
+            channel=_get_channel(snap_action),
+        )
+        installed = snaps["installed"].get(name)
+        if installed and installed["revision"] == revision:
+            logging.info(
+                "%s snap has been installed with the same revision", name
+            )
+        else:
+            _sideload_snap(session, snap_action, snap_file, assert_file)
+
+    run_post_commands(session, snap_action)
+
+
+def _sideload_snap(session, snap_action, snap_file, assert_file):
+    name = snap_action.name
+    upload_dir = ".envicorn-snaps"
+    _cmd = f"sudo snap install {upload_dir}/{quote(snap_file.name)}"
+    if snap_action.mode:
+        _cmd += f" --{snap_action.mode}"
+    if not snap_action.revision:
+        # follow the channel on the next refreshes like a store install
+        _cmd += (
+            f"\nsudo snap switch --channel="
+            f"{quote(_get_channel(snap_action))} {quote(name)}"
+        )
+
+    session.launch_tar_upload([snap_file, assert_file], upload_dir)
+    try:
+        # list the snap in the same command to keep the cache up to date
+        _, stdout, _ = session.launch_ssh_command(
+            f"sudo snap ack {upload_dir}/{quote(assert_file.name)}\n"
+            f"{_cmd}\n"
+            f"snap list {quote(name)}"
+        )
+    except SshCommandError:
+        raise SnapCommandError(_cmd)
+    finally:
+        session.launch_ssh_command(
+            f"rm -rf {upload_dir}", continue_on_error=True
+        )
+
+    snaps = get_snap_state(session)
+    snaps["installed"].update(parse_snap_list(stdout))
+    if snaps["updates"] is not None:
+        snaps["updates"].discard(name)
+
+
+def get_architecture(session):
+    """
+    Return the dpkg architecture of the DUT, probed once per session
+    """
+    return session.get_remote_state("architecture", _probe_architecture)
+
+
+def _probe_architecture(session):
+    _, stdout, _ = session.launch_ssh_command("dpkg --print-architecture")
+    return stdout.strip()
+
+
+def _get_channel(snap_action):
+    channel = f"{snap_action.track}/{snap_action.risk}"
+    if snap_action.branch:
+        channel += f"/{snap_action.branch}"
+    return channel
+
+
+def _get_snap_command(snaps, snap_action, no_wait=False):
+    """
+    Return the snap install or refresh command needed by snap_action,
+    or None when the DUT already has the requested snap
+    """
+    name = snap_action.name
+    revision = snap_action.revision
+    channel = _get_channel(snap_action)
+
+    installed = snaps["installed"].get(name)
+    installed_rev = installed["revision"] if installed else ""
+    updates = snaps["updates"]
+    if revision and revision == installed_rev:
         logging.info("%s snap has been installed with the same revision", name)
-    elif f"{track}/{risk}" in installed_tracks:
+        return None
+    if (
+        not revision
+        and installed
+        and installed["tracking"] == channel
+        and updates is not None
+        and name not in updates
+    ):
         logging.info(
             "%s snap has been installed with the same track and risk", name
         )
+        return None
+
+    _cmd = "sudo snap refresh" if installed_rev else "sudo snap install"
+    if no_wait:
+        _cmd += " --no-wait"
+    _cmd += f" {quote(name)}"
+
+    if revision:
+        _cmd += f" --revision={quote(revision)}"
     else:
-        if installed_rev:
-            _cmd = f"sudo snap refresh {quote(name)}"
-        else:
-            _cmd = f"sudo snap install {quote(name)}"
+        _cmd += f" --channel={quote(channel)}"
 
-        if revision:
-            _cmd += f" --revision={quote(revision)}"
-        else:
-            _arg = f"{track}/{risk}"
-            if branch:
-                _arg += f"/{branch}"
-            _cmd += f" --channel={quote(_arg)}"
+    if snap_action.mode:
+        _cmd += f" --{snap_action.mode}"
 
-        if snap_data.get("mode"):
-            _cmd += f" --{snap_data['mode']}"
+    return _cmd
 
-        ret, _, _ = session.launch_ssh_command(_cmd)
 
-    if snap_data.get("post_commands") and ret == 0:
-        command = snap_data["post_commands"]
-        ret, _, _ = session.launch_ssh_command(command)
-        if ret != 0:
-            raise SnapCommandError(command)
+class SnapChangeTracker:
+    """
+    Submit snap installs and refreshes to snapd without waiting for them,
+    so snapd processes them concurrently, then poll all the changes
+    together with a single command
+    """
 
+    POLL_INTERVAL = 2
+    FAILED_STATUSES = {"Error", "Undone", "Hold"}
 
-def get_snap_info(session, name):
+    def __init__(self, session):
+        self._session = session
+        self._changes = {}
+        self._names = {}
+        self._statuses = {}
+        self._lock = threading.Lock()
 
-    command = f"snap info {quote(name)}"
-    ret, stdout, _ = session.launch_ssh_command(command)
-    if ret != 0:
-        raise SnapCommandError(command)
+    def submit(self, snap_actions):
+        """
+        Submit the snaps which have to be installed or refreshed, the ones
+        refused by snapd are left to the synchronous installation
 
-    rev, tracks = parse_snap_info(stdout)
-    return rev, tracks
+        Args:
+            snap_actions (dict): InstallSnapAction by action number
+        """
+        snaps = get_snap_state(self._session)
+        commands = {}
+        names = set()
+        for number, snap_action in snap_actions.items():
+            # the state of a snap changes with its first action, so the
+            # next actions of the same snap are left to the synchronous
+            # installation
+            if snap_action.name in names:
+                continue
+            names.add(snap_action.name)
+            _cmd = _get_snap_command(snaps, snap_action, no_wait=True)
+            if _cmd:
+                commands[number] = _cmd
+        if not commands:
+            return
 
+        script = "\n".join(
+            f"change=$({_cmd}) && "
+            f'echo "{_CHANGE_MARKER} {number} $change" || '
+            f'echo "{_CHANGE_MARKER} {number} failed"'
+            for number, _cmd in commands.items()
+        )
+        _, stdout, _ = self._session.launch_ssh_command(
+            script, continue_on_error=True
+        )
+        with self._lock:
+            for line in stdout.splitlines():
+                fields = line.split()
+                if line.startswith(_CHANGE_MARKER) and fields[-1].isdigit():
+                    number = int(fields[-2])
+                    self._changes[number] = fields[-1]
+                    self._names[number] = snap_actions[number].name
+        logging.info(
+            "Submitted snapd changes: %s",
+            ", ".join(
+                f"{self._names[k]} ({v})" for k, v in self._changes.items()
+            ),
+        )
 
-def parse_snap_info(data):
-    tracks = []
-    match = re.search(
-        r"installed:[ ]+([a-zA-Z\.0-9-])+[ ]+ (\([0-9]+\))", data
-    )
-    installed_rev = match.group(2).strip("()") if match else ""
+    def is_submitted(self, number):
+        return number in self._changes
 
-    if installed_rev and installed_rev[0] != "x":
-        match = re.findall(rf"  ([\w -\.\/:]*)\({installed_rev}\) ", data)
-        tracks = [m.split(":")[0].strip() for m in match if ":" in m]
+    def wait(self, number):
+        """
+        Wait for the change of the action to be ready, polling the status
+        of all the submitted changes at once
+        """
+        change_id = self._changes[number]
+        name = self._names[number]
+        while True:
+            with self._lock:
+                status = self._statuses.get(change_id)
+                if status != "Done" and status not in self.FAILED_STATUSES:
+                    self._poll()
+                    status = self._statuses.get(change_id)
+            if status == "Done":
+                logging.info(
+                    "# snapd change %s of %s is done", change_id, name
+                )
+                updates = get_snap_state(self._session)["updates"]
+                if updates is not None:
+                    updates.discard(name)
+                return
+            if status in self.FAILED_STATUSES:
+                self._session.launch_ssh_command(
+                    f"snap tasks {change_id}", continue_on_error=True
+                )
+                raise SnapCommandError(f"snap change {change_id} of {name}")
+            time.sleep(self.POLL_INTERVAL)
 
-    return installed_rev, tracks
+    def _poll(self):
+        _, stdout, _ = self._session.launch_ssh_command(
+            f'snap changes\necho "{_CHANGE_MARKER}"\nsnap list',
+            tail_lines=None,
+        )
+        changes, _, snap_list = stdout.partition(_CHANGE_MARKER)
+        for line in changes.splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0] in self._changes.values():
+                self._statuses[fields[0]] = fields[1]
+        get_snap_state(self._session)["installed"].update(
+            parse_snap_list(snap_list)
+        )
+
+
+def get_snap_state(session):
+    """
+    Return the snaps installed on the DUT and the ones with a pending
+    update, the DUT is only probed once per session
 
+    Returns:
+        dict: 'installed' maps the snap names to their version, revision
+            and tracking channel, 'updates' is the set of snaps which can
+            be refreshed or None if the store could not be reached
+    """
+    return session.get_remote_state("snaps", _probe_snap_state)
 
-def check_snap_utility(session):
 
-    command = "which snap"
-    ret, _, _ = session.launch_ssh_command(command)
-    if ret != 0:
+def _probe_snap_state(session):
+    command = (
+        "which snap\n"
+        "snap list --all\n"
+        f'echo "{_REFRESH_LIST_MARKER}"\n'
+        f'snap refresh --list 2>&1 || echo "{_REFRESH_LIST_FAILED}"'
+    )
+    try:
+        _, stdout, _ = session.launch_ssh_command(command, tail_lines=None)
+    except SshCommandError:
         raise SnapCommandError(command)
+
+    snap_list, _, refresh_list = stdout.partition(_REFRESH_LIST_MARKER)
+    updates = None
+    if _REFRESH_LIST_FAILED not in refresh_list:
+        updates = set(parse_snap_list(refresh_list, active_only=False))
+
+    return {"installed": parse_snap_list(snap_list), "updates": updates}
+
+
+def parse_snap_list(data, active_only=True):
+    """
+    Parse the table printed by 'snap list [--all]' in one pass
+
+    Args:
+        data (str): command output, lines before the table header
+            are ignored
+        active_only (bool): skip the disabled revisions
+
+    Returns:
+        dict: snap name to its version, revision and tracking channel
+    """
+    snaps = {}
+    header_found = False
+    for line in data.splitlines():
+        fields = line.split()
+        if not header_found:
+            header_found = fields[:3] == ["Name", "Version", "Rev"]
+            continue
+        if len(fields) < 3:
+            continue
+
+        notes = fields[5].split(",") if len(fields) > 5 else []
+        if active_only and "disabled" in notes:
+            continue
+
+        tracking = fields[3] if len(fields) > 3 else "-"
+        snaps[fields[0]] = {
+            "version": fields[1],
+            "revision": fields[2],
+            "tracking": "" if tracking == "-" else tracking,
+        }
+
+    return snaps
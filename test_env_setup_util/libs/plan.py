@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import os
+
+from test_env_setup_util.libs.common import _cache_namespace, file_sha256
+
+PLAN_VERSION = 1
+
+
+def get_variables_hash(variables):
+    """
+    Return the hash of the variables a plan is rendered with
+    """
+    content = json.dumps(variables, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def write_plan(
+    plan_file,
+    config_file,
+    sources,
+    variables,
+    actions,
+    actions_src,
+    bypass_actions,
+):
+    """
+    Write a compiled plan to a JSON file: the rendered actions of a
+    configuration, with the content hashes of the files it was loaded
+    from and of its variables
+
+    Args:
+        plan_file (str): file to write
+        config_file (str): configuration file the plan is compiled from
+        sources (list): configuration and template files loaded
+        variables (dict): variables the actions were rendered with
+        actions (list): rendered actions
+        actions_src (list): source file of every action
+        bypass_actions (list): actions excluded by their bypass_condition
+    """
+    plan = {
+        "version": PLAN_VERSION,
+        "schema": _cache_namespace(),
+        "config": os.path.abspath(config_file),
+        "sources": {
+            os.path.abspath(source): file_sha256(source) for source in sources
+        },
+        "variables_sha256": get_variables_hash(variables),
+        "actions": actions,
+        "actions_src": [str(source) for source in actions_src],
+        "bypass_actions": bypass_actions,
+    }
+    with open(plan_file, "w") as fp:
+        json.dump(plan, fp)
+
+
+def load_plan(plan_file):
+    """
+    Load a plan written by write_plan, the sources which changed since
+    it was compiled are reported
+
+    Raises:
+        ValueError: if the plan was compiled by another envicorn version
+    """
+    with open(plan_file, "r") as fp:
+        plan = json.load(fp)
+
+    if (
+        plan.get("version") != PLAN_VERSION
+        or plan.get("schema") != _cache_namespace()
+    ):
+        raise ValueError(
+            f"the plan {plan_file} was compiled by another version of "
+            "envicorn, compile it again with dump --plan"
+        )
+    for source, sha256 in plan["sources"].items():
+        if os.path.exists(source) and file_sha256(source) != sha256:
+            logging.warning(
+                "# %s changed since the plan %s was compiled",
+                source,
+                plan_file,
+            )
+    return plan
@@ -0,0 +1,148 @@
+import functools
+import logging
+import jinja2
+import yaml
+
+# the markers starting a Jinja expression, statement or comment
+_JINJA_MARKERS = ("{{", "{%", "{#")
+
+_environment = jinja2.Environment(keep_trailing_newline=True)
+# drops the final newline of a template, as when a YAML document was rendered
+_document_environment = jinja2.Environment()
+
+
+def _strip_trailing_spaces(data):
+    block = "\n".join([line.rstrip() for line in data.splitlines()])
+    if data.endswith("\n"):
+        block += "\n"
+    return block
+
+
+def _str_presenter(dumper, data):
+    """
+    Preserve multiline strings when dumping yaml.
+    https://github.com/yaml/pyyaml/issues/240
+    """
+    if "\n" in data:
+        # Remove trailing spaces messing out the output.
+        return dumper.represent_scalar(
+            "tag:yaml.org,2002:str", _strip_trailing_spaces(data), style="|"
+        )
+    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+
+
+yaml.add_representer(str, _str_presenter)
+yaml.representer.SafeRepresenter.add_representer(str, _str_presenter)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(source):
+    """
+    Return the compiled template of a string and the YAML scalar style
+    it used to be rendered in, which decides how the result is trimmed
+    """
+    style = yaml.dump(source)[0]
+    if style not in "|'\"":
+        style = ""
+    return _environment.from_string(source), style
+
+
+def _render_string(value, variables):
+    if "\n" in value:
+        value = _strip_trailing_spaces(value)
+    if not any(marker in value for marker in _JINJA_MARKERS):
+        return value
+
+    template, style = _compile(value)
+    rendered = template.render(variables)
+    if style == "|":
+        # chomp the trailing line breaks like the block scalar does
+        if not value.endswith("\n"):
+            rendered = rendered.rstrip("\n")
+        elif not value.endswith("\n\n"):
+            rendered = rendered.rstrip("\n")
+            rendered = rendered + "\n" if rendered else rendered
+    elif not style:
+        # surrounding spaces are not part of a plain scalar
+        rendered = rendered.strip(" \t")
+
+    logging.debug("rendered %r as %r", value, rendered)
+    return rendered
+
+
+def render_variables(contents, variables):
+    """
+    Render the Jinja templates found in the strings of contents
+
+    Only the strings are rendered, the keys and the other values are kept
+    as they are. Multiline strings get their trailing spaces removed and
+    the results are trimmed the same way as when the whole contents were
+    dumped to YAML, rendered and loaded back.
+
+    Args:
+        contents: dict, list or scalar to render
+        variables (dict): variables available in the templates
+
+    Returns:
+        a rendered copy of contents
+    """
+    if isinstance(contents, dict):
+        return {
+            key: render_variables(value, variables)
+            for key, value in contents.items()
+        }
+    if isinstance(contents, list):
+        return [render_variables(value, variables) for value in contents]
+    if isinstance(contents, str):
+        return _render_string(contents, variables)
+    return contents
+
+
+def _get_last_scalar_path(contents):
+    """
+    Return the keys leading to the last scalar of the YAML dump of contents,
+    whose mappings are dumped with sorted keys
+    """
+    path = []
+    while isinstance(contents, (dict, list)) and contents:
+        key = max(contents) if isinstance(contents, dict) else -1
+        path.append(key)
+        contents = contents[key]
+    return path
+
+
+def render_document(contents, variables):
+    """
+    Render contents like render_variables, as a single YAML document
+
+    When the YAML dump of contents ends with a block scalar, Jinja used to
+    drop the final newline of the document, so the last string of contents
+    is rendered that way and its trailing line break is chomped.
+
+    Args:
+        contents (dict or list): contents to render
+        variables (dict): variables available in the templates
+
+    Returns:
+        a rendered copy of contents
+    """
+    rendered = render_variables(contents, variables)
+    path = _get_last_scalar_path(contents)
+    if not path:
+        return rendered
+
+    *parents, key = path
+    value = contents
+    target = rendered
+    for parent in parents:
+        value = value[parent]
+        target = target[parent]
+    if not isinstance(value[key], str):
+        return rendered
+
+    source = yaml.dump(value[key])
+    # a scalar followed by the document end marker is not affected
+    if source.startswith("|") and not source.endswith("...\n"):
+        document = _document_environment.from_string(source)
+        target[key] = yaml.safe_load(document.render(variables))
+    return rendered
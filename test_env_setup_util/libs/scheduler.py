@@ -0,0 +1,179 @@
+import contextvars
+import heapq
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def build_action_graph(actions, prelude=0, bypassed_ids=()):
+    """
+    Build the dependency graph of the actions
+
+    An action without depends_on waits for all the actions defined before
+    it, so configurations without dependencies keep running in file order.
+    An action with depends_on only waits for the listed actions and the
+    first `prelude` actions, which are generated by envicorn itself.
+    A dependency on an action excluded by its bypass_condition is
+    satisfied.
+
+    Args:
+        actions (list): validated action models
+        prelude (int): number of leading actions every action depends on
+        bypassed_ids (set): ids of the actions excluded from the plan
+
+    Returns:
+        dict: 0-based action index to the set of indices it depends on
+    """
+    ids = {}
+    for idx, action in enumerate(actions):
+        if action.id is None:
+            continue
+        if action.id in ids:
+            raise ValueError(f"duplicated action id '{action.id}'")
+        ids[action.id] = idx
+
+    graph = {}
+    # actions nobody depends on yet, waiting for them is the same as
+    # waiting for every action defined so far
+    tails = set()
+    for idx, action in enumerate(actions):
+        if action.depends_on is None:
+            deps = set(tails)
+        else:
+            deps = set(range(min(prelude, idx)))
+            for dep_id in action.depends_on:
+                if dep_id not in ids and dep_id in bypassed_ids:
+                    continue
+                if dep_id not in ids:
+                    raise ValueError(
+                        f"action {idx + 1} depends on unknown id '{dep_id}'"
+                    )
+                if ids[dep_id] == idx:
+                    raise ValueError(f"action {idx + 1} depends on itself")
+                deps.add(ids[dep_id])
+        graph[idx] = deps
+        tails -= deps
+        tails.add(idx)
+
+    _check_cycles(graph)
+    return graph
+
+
+def _check_cycles(graph):
+    order = get_topological_order(graph)
+    if len(order) != len(graph):
+        cycle = sorted(set(graph).difference(order))
+        raise ValueError(
+            "circular dependencies between actions "
+            + ", ".join(str(idx + 1) for idx in cycle)
+        )
+
+
+def get_topological_order(graph):
+    """
+    Return the action indices ordered so that every action comes after
+    the ones it depends on, the actions in a cycle are left out
+    """
+    remaining = {idx: len(deps) for idx, deps in graph.items()}
+    dependents = _get_dependents(graph)
+    ready = [idx for idx, count in remaining.items() if count == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        idx = heapq.heappop(ready)
+        order.append(idx)
+        for dependent in dependents[idx]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    return order
+
+
+def _get_dependents(graph):
+    dependents = {idx: [] for idx in graph}
+    for idx, deps in graph.items():
+        for dep in deps:
+            dependents[dep].append(idx)
+    return dependents
+
+
+def run_action_graph(graph, execute, max_workers=1):
+    """
+    Execute the actions of the graph, running independent ones concurrently
+
+    Ready actions are started in index order, hence a single worker runs
+    the actions exactly like a sequential loop. Once an action reports a
+    failure no new action is started and the running ones are awaited.
+
+    Args:
+        graph (dict): graph returned by build_action_graph
+        execute (callable): run an action by its index and return whether
+            its dependents are allowed to run
+        max_workers (int): number of actions running at the same time
+
+    Returns:
+        bool: True if no action stopped the run
+    """
+    dependents = _get_dependents(graph)
+    remaining = {idx: len(deps) for idx, deps in graph.items()}
+    ready = [idx for idx, count in remaining.items() if count == 0]
+    heapq.heapify(ready)
+    running = {}
+    stopped = False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while running or (ready and not stopped):
+            while ready and not stopped and len(running) < max_workers:
+                idx = heapq.heappop(ready)
+                future = executor.submit(
+                    contextvars.copy_context().run, execute, idx
+                )
+                running[future] = idx
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=running.get):
+                idx = running.pop(future)
+                if not future.result():
+                    stopped = True
+                    continue
+                for dependent in dependents[idx]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        heapq.heappush(ready, dependent)
+
+    return not stopped
+
+
+def group_chained_actions(actions, graph, action_type, skipped=()):
+    """
+    Find runs of consecutive actions of the given type where every action
+    only depends on the one right before it, so nothing can run between
+    them and they can be merged into a single operation
+
+    Args:
+        actions (list): validated action models
+        graph (dict): graph returned by build_action_graph
+        action_type (str): type of the actions to group
+        skipped (set): indices of the actions left out of the runs
+
+    Returns:
+        dict: index of the first action of a run to the indices of the
+            run which are not skipped, only runs of at least two of them
+            are returned
+    """
+    groups = {}
+    head = None
+    for idx, action in enumerate(actions):
+        if action.action != action_type:
+            head = None
+            continue
+        if head is not None and graph[idx] == {idx - 1}:
+            groups[head].append(idx)
+        else:
+            head = idx
+            groups[head] = [idx]
+
+    groups = [
+        [idx for idx in group if idx not in skipped]
+        for group in groups.values()
+    ]
+    return {group[0]: group for group in groups if len(group) > 1}
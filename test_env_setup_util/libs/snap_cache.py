@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from test_env_setup_util.libs.exceptions import SnapCommandError
+
+DEFAULT_MAX_SIZE = 16384 * 1024 * 1024
+DEFAULT_CHANNEL_MAX_AGE = 3600
+# channels resolved by the previous runs, with the time they were resolved
+_CHANNELS_FILE = "channels.json"
+_DOWNLOAD_PATTERN = re.compile(r"^(?P<name>.+)_(?P<revision>\d+)\.snap$")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_snap_cache(
+    cache_dir,
+    max_size=DEFAULT_MAX_SIZE,
+    channel_max_age=DEFAULT_CHANNEL_MAX_AGE,
+):
+    """
+    Return the snap cache of cache_dir, shared by all the operators of
+    the run so every snap is only downloaded once
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = SnapCache(
+                cache_dir, max_size, channel_max_age
+            )
+        return _caches[cache_dir]
+
+
+class SnapCache:
+    """
+    Host-side cache of the .snap files and their assertions, downloaded
+    with 'snap download' for the architecture of the DUTs.
+
+    The entries are stored as <name>_<revision>_<arch>.snap and .assert,
+    so a cache can be seeded offline with files named the same way. A
+    channel is resolved to a revision once per run, and the runs within
+    channel_max_age seconds reuse the resolution, while a revision is
+    only downloaded if it is not cached yet. The least recently used
+    entries are evicted when the cache grows over max_size bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        max_size=DEFAULT_MAX_SIZE,
+        channel_max_age=DEFAULT_CHANNEL_MAX_AGE,
+    ):
+        self._cache_dir = Path(cache_dir)
+        self._max_size = max_size
+        self._channel_max_age = channel_max_age
+        self._lock = threading.Lock()
+        # one lock per snap, so the DUTs wait for a single download
+        self._key_locks = {}
+        # name, channel and architecture to the revision resolved this run
+        self._channels = {}
+        # entries used by the run, never evicted
+        self._used = set()
+
+    def get(self, name, arch, revision=None, channel=None):
+        """
+        Return the paths of the .snap and .assert files of a snap, the
+        revision is preferred over the channel
+
+        Returns:
+            tuple: snap file, assertion file and revision
+
+        Raises:
+            SnapCommandError: if the snap could not be downloaded
+        """
+        key = (name, revision or channel, arch)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            resolved = (
+                revision
+                or self._channels.get(key)
+                or self._get_resolved_channel(name, channel, arch)
+            )
+            if resolved:
+                snap_file, assert_file = self._get_paths(name, resolved, arch)
+                if snap_file.exists() and assert_file.exists():
+                    logging.info("# %s revision %s is cached", name, resolved)
+                    self._touch(snap_file.stem)
+                    return snap_file, assert_file, resolved
+
+            resolved = self._download(name, arch, revision, channel)
+            if not revision:
+                self._channels[key] = resolved
+                self._save_resolved_channel(name, channel, arch, resolved)
+
+        self._evict()
+        return (*self._get_paths(name, resolved, arch), resolved)
+
+    def _load_resolved_channels(self):
+        try:
+            with open(self._cache_dir / _CHANNELS_FILE, "r") as fp:
+                channels = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        return channels if isinstance(channels, dict) else {}
+
+    def _get_resolved_channel(self, name, channel, arch):
+        """
+        Return the revision a previous run resolved the channel to, None
+        if it is older than channel_max_age
+        """
+        with self._lock:
+            resolution = self._load_resolved_channels().get(
+                f"{name} {channel} {arch}"
+            )
+        try:
+            revision, resolved_at = resolution
+            age = time.time() - resolved_at
+        except (TypeError, ValueError):
+            return None
+        if age >= self._channel_max_age:
+            return None
+        logging.info(
+            "# %s %s was resolved to revision %s %d seconds ago",
+            name,
+            channel,
+            revision,
+            age,
+        )
+        return revision
+
+    def _save_resolved_channel(self, name, channel, arch, revision):
+        with self._lock:
+            channels = self._load_resolved_channels()
+            channels[f"{name} {channel} {arch}"] = [revision, time.time()]
+            try:
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=self._cache_dir, suffix=".tmp", delete=False
+                ) as fp:
+                    json.dump(channels, fp)
+                os.replace(fp.name, self._cache_dir / _CHANNELS_FILE)
+            except OSError as e:
+                logging.warning("Failed to save the snap channels: %s", e)
+
+    def _get_paths(self, name, revision, arch):
+        stem = f"{name}_{revision}_{arch}"
+        return (
+            self._cache_dir / f"{stem}.snap",
+            self._cache_dir / f"{stem}.assert",
+        )
+
+    def _download(self, name, arch, revision, channel):
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        command = ["snap", "download", name]
+        if revision:
+            command.append(f"--revision={revision}")
+        else:
+            command.append(f"--channel={channel}")
+
+        with tempfile.TemporaryDirectory(dir=self._cache_dir) as tmp_dir:
+            logging.info("# Downloading %s snap for %s", name, arch)
+            try:
+                subprocess.run(
+                    command + [f"--target-directory={tmp_dir}"],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    env=dict(os.environ, UBUNTU_STORE_ARCH=arch),
+                )
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error(
+                    "Failed to download %s: %s",
+                    name,
+                    getattr(e, "stderr", None) or e,
+                )
+                raise SnapCommandError(" ".join(command))
+
+            for filename in os.listdir(tmp_dir):
+                match = _DOWNLOAD_PATTERN.match(filename)
+                if match and match.group("name") == name:
+                    revision = match.group("revision")
+                    break
+            else:
+                raise SnapCommandError(" ".join(command))
+
+            stem = f"{name}_{revision}_{arch}"
+            for suffix in (".assert", ".snap"):
+                shutil.move(
+                    os.path.join(tmp_dir, f"{name}_{revision}{suffix}"),
+                    self._cache_dir / f"{stem}{suffix}",
+                )
+        self._touch(stem)
+        logging.info("# %s revision %s downloaded", name, revision)
+        return revision
+
+    def _touch(self, stem):
+        with self._lock:
+            self._used.add(stem)
+        # the modification time orders the entries for the eviction
+        for suffix in (".snap", ".assert"):
+            try:
+                os.utime(self._cache_dir / f"{stem}{suffix}")
+            except OSError:
+                pass
+
+    def _evict(self):
+        with self._lock:
+            entries = {}
+            total = 0
+            with os.scandir(self._cache_dir) as files:
+                for entry in files:
+                    stem, suffix = os.path.splitext(entry.name)
+                    if suffix not in (".snap", ".assert"):
+                        continue
+                    stat = entry.stat()
+                    mtime, size = entries.get(stem, (0, 0))
+                    entries[stem] = (
+                        max(mtime, stat.st_mtime),
+                        size + stat.st_size,
+                    )
+                    total += stat.st_size
+
+            for stem, (_, size) in sorted(
+                entries.items(), key=lambda entry: entry[1]
+            ):
+                if total <= self._max_size:
+                    break
+                if stem in self._used:
+                    continue
+                logging.info("# Evicting %s from the snap cache", stem)
+                for suffix in (".snap", ".assert"):
+                    (self._cache_dir / f"{stem}{suffix}").unlink(
+                        missing_ok=True
+                    )
+                total -= size
@@ -1,72 +1,392 @@
+import codecs
+import collections
+import io
 import logging
+import os
+import select
+import socket
+import tarfile
+import threading
+import time
 import paramiko
 
 from contextlib import contextmanager
 from test_env_setup_util.libs.exceptions import SshCommandError
+from test_env_setup_util.libs.timing import Timings
 from pathlib import Path
 from scp import SCPClient, SCPException
+from shlex import quote
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+OUTPUT_TAIL_LINES = 1000
+ERROR_TAIL_LINES = 10
+RECV_SIZE = 32768
+MAX_LINE_LENGTH = 65536
+TAR_BUFFER_SIZE = 262144
+STEP_MARKER = "envicorn: step"
+
+
+class _OutputTail:
+    """
+    Split a command output stream into lines, log them and only keep the
+    last ones in memory, the last line starting with marker is kept too
+    """
+
+    def __init__(
+        self,
+        prefix,
+        max_lines=OUTPUT_TAIL_LINES,
+        log_output=True,
+        marker=None,
+    ):
+        self._prefix = prefix
+        self._log_output = log_output
+        self._marker = marker
+        self.last_marker = None
+        self._lines = collections.deque(maxlen=max_lines)
+        self._decoder = codecs.getincrementaldecoder("utf8")("replace")
+        self._partial = ""
+
+    def feed(self, data):
+        text = self._partial + self._decoder.decode(data)
+        *lines, self._partial = text.split("\n")
+        for line in lines:
+            self._add_line(line + "\n")
+        if len(self._partial) > MAX_LINE_LENGTH:
+            self._add_line(self._partial)
+            self._partial = ""
+
+    def close(self):
+        self._partial += self._decoder.decode(b"", final=True)
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ""
+
+    def _add_line(self, line):
+        if self._log_output:
+            logging.info("%s%s", self._prefix, line.rstrip("\n"))
+        if self._marker and line.startswith(self._marker):
+            self.last_marker = line.rstrip("\n")
+        self._lines.append(line)
+
+    def getvalue(self, max_lines=None):
+        lines = list(self._lines)
+        if max_lines is not None:
+            lines = lines[-max_lines:]
+        return "".join(lines)
+
+
+class _ChannelWriter:
+    """
+    File-like object sending the written data to a channel
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.sent = 0
+
+    def write(self, data):
+        self._channel.sendall(data)
+        self.sent += len(data)
+        return len(data)
+
+
+def _pipe_forward(channel, port):
+    """
+    Relay the data of a forwarded channel to port on the host loopback
+    until either side closes
+    """
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+    except OSError as e:
+        logging.debug("Failed to connect the forwarded channel: %s", e)
+        channel.close()
+        return
+
+    try:
+        while True:
+            readable, _, _ = select.select([sock, channel], [], [])
+            if sock in readable:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                channel.sendall(data)
+            if channel in readable:
+                data = channel.recv(RECV_SIZE)
+                if not data:
+                    break
+                sock.sendall(data)
+    except OSError as e:
+        logging.debug("Forwarded connection closed: %s", e)
+    finally:
+        channel.close()
+        sock.close()
 
 
 class RemoteSshSession:
-    def __init__(self, ip, username, password, private_key_file=None):
+    """
+    SSH session to a DUT which keeps one authenticated transport alive
+    and opens a new channel on it for every command or upload.
+    """
+
+    KEEPALIVE_INTERVAL = 30
+
+    def __init__(self, ip, username, password, private_key_file=None, port=22):
         self._ip = ip
+        self._port = port
         self._username = username
         self._password = password
         self._key_file = private_key_file
+        self._client = None
+        self._lock = threading.Lock()
+        self._handshakes = 0
+        self._channels = 0
+        # DUT state probed once and shared by the actions of a run
+        self._remote_state = {}
+        self._state_lock = threading.Lock()
+        # host port reachable from the DUT through the connection
+        self._forward_local_port = None
+        self._forward_remote_port = None
+        self.timings = Timings()
 
     def _init_client_session(self):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            self._ip,
-            username=self._username,
-            password=self._password,
-            key_filename=self._key_file,
-        )
+        with self.timings.span("ssh_connect"):
+            client.connect(
+                self._ip,
+                port=self._port,
+                username=self._username,
+                password=self._password,
+                key_filename=self._key_file,
+            )
+        client.get_transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+        self._handshakes += 1
         return client
 
+    def _get_transport(self):
+        """
+        Return the live transport, connecting or reconnecting if needed
+        """
+        with self._lock:
+            transport = None
+            if self._client is not None:
+                transport = self._client.get_transport()
+            if transport is None or not transport.is_active():
+                if self._client is not None:
+                    logging.info(
+                        "# SSH connection to %s dropped, reconnecting",
+                        self._ip,
+                    )
+                    self._client.close()
+                    self._client = None
+                self._client = self._init_client_session()
+                transport = self._client.get_transport()
+                if self._forward_local_port is not None:
+                    try:
+                        self._request_forward(transport)
+                    except paramiko.SSHException as e:
+                        logging.warning(
+                            "Failed to forward the DUT port %s again: %s",
+                            self._forward_remote_port,
+                            e,
+                        )
+            return transport
+
+    def _request_forward(self, transport):
+        self._forward_remote_port = transport.request_port_forward(
+            "127.0.0.1",
+            self._forward_remote_port or 0,
+            handler=self._accept_forward,
+        )
+
+    def _accept_forward(self, channel, origin, server):
+        # called by the transport thread, which must not be blocked
+        threading.Thread(
+            target=_pipe_forward,
+            args=(channel, self._forward_local_port),
+            daemon=True,
+        ).start()
+
+    def start_reverse_forward(self, local_port):
+        """
+        Forward the connections to a port of the DUT loopback to local_port
+        of the host loopback, the same DUT port is forwarded again when the
+        connection is reestablished
+
+        Returns:
+            int: the DUT port
+
+        Raises:
+            paramiko.SSHException: if the DUT refused the forward
+        """
+        transport = self._get_transport()
+        with self._lock:
+            self._forward_local_port = local_port
+            try:
+                self._request_forward(transport)
+            except paramiko.SSHException:
+                self._forward_local_port = None
+                raise
+            return self._forward_remote_port
+
+    def _reset_transport(self, transport):
+        with self._lock:
+            if (
+                self._client is not None
+                and self._client.get_transport() is transport
+            ):
+                self._client.close()
+                self._client = None
+
+    def _open_channel(self):
+        transport = self._get_transport()
+        try:
+            channel = transport.open_session()
+        except (paramiko.SSHException, EOFError, OSError) as err:
+            # the connection may drop between the liveness check and the
+            # channel request, nothing has been sent yet so retry once
+            logging.debug("Failed to open channel: %s, reconnecting", err)
+            self._reset_transport(transport)
+            channel = self._get_transport().open_session()
+        self._count_channel()
+        return channel
+
+    def _count_channel(self):
+        with self._lock:
+            self._channels += 1
+
     def authentication_verification(self):
         with self._create_client() as client:
-            client.invoke_shell()
+            client.invoke_shell().close()
+            self._count_channel()
 
     @contextmanager
     def _create_client(self):
-        client = None
-        try:
-            client = self._init_client_session()
-            yield client
-        finally:
-            if client is not None:
-                client.close()
+        self._get_transport()
+        yield self._client
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def get_remote_state(self, key, probe):
+        """
+        Return the DUT state cached under key, calling probe(session) to
+        collect it the first time
+        """
+        with self._state_lock:
+            if key not in self._remote_state:
+                self._remote_state[key] = probe(self)
+            return self._remote_state[key]
+
+    def connection_stats(self):
+        """
+        Return the number of SSH handshakes and channels used so far
+        """
+        return {
+            "handshakes": self._handshakes,
+            "channels": self._channels,
+            "handshakes_saved": max(self._channels - self._handshakes, 0),
+        }
 
     def launch_ssh_command(
-        self, command, accepted_exit_codes=[0], continue_on_error=False
+        self,
+        command,
+        accepted_exit_codes=[0],
+        continue_on_error=False,
+        tail_lines=OUTPUT_TAIL_LINES,
+        log_output=True,
     ):
-        exit_code = None
-        log_stdout = log_stderr = ""
+        """
+        Run a command on the DUT, its output is logged line by line while
+        the command is running
+
+        Args:
+            command (str): shell commands to run
+            accepted_exit_codes (list): exit codes considered successful
+            continue_on_error (bool): do not stop on the first failing
+                command and do not raise for unaccepted exit codes
+            tail_lines (int): number of the last stdout and stderr lines
+                returned, None to keep the whole output
+            log_output (bool): log the output of the command
 
+        Returns:
+            tuple: exit code, stdout and stderr tails
+        """
+        exit_code, stdout, stderr = self._run_command(
+            command, continue_on_error, tail_lines, log_output
+        )
+        if exit_code not in accepted_exit_codes and not continue_on_error:
+            raise SshCommandError(
+                command, exit_code, stderr.getvalue(ERROR_TAIL_LINES)
+            )
+
+        return exit_code, stdout.getvalue(), stderr.getvalue()
+
+    def _run_command(
+        self,
+        command,
+        continue_on_error=False,
+        tail_lines=OUTPUT_TAIL_LINES,
+        log_output=True,
+        marker=None,
+    ):
+        """
+        Run a command on the DUT, see launch_ssh_command
+
+        Returns:
+            tuple: exit code, stdout and stderr _OutputTail, the last
+                stdout line starting with marker is tracked
+        """
         if not continue_on_error:
             exec_command = "set -ex\n" + command
         else:
             exec_command = "set -x\n" + command
 
-        with self._create_client() as client:
-            _, stdout, stderr = client.exec_command(exec_command)
-            log_stdout = stdout.read().decode("utf8")
-            log_stderr = stderr.read().decode("utf8")
-            exit_code = stdout.channel.recv_exit_status()
-            logging.info("## command output:")
-            logging.info("$ %s", exec_command)
-            logging.info("> response: \n%s", log_stdout)
-            logging.info("> exit code: %s", exit_code)
-
-            if log_stderr:
-                logging.info("> stderr: \n%s", log_stderr)
+        logging.info("## command output:")
+        logging.info("$ %s", exec_command)
+        stdout = _OutputTail("> ", tail_lines, log_output, marker)
+        stderr = _OutputTail("2> ", tail_lines, log_output)
+        with self.timings.span("ssh_command"):
+            channel = self._open_channel()
+            try:
+                channel.exec_command(exec_command)
+                exit_code = self._stream_output(channel, stdout, stderr)
+            finally:
+                channel.close()
+        self.timings.add_exit_code(exit_code)
+        logging.info("> exit code: %s", exit_code)
+        return exit_code, stdout, stderr
 
-            if exit_code not in accepted_exit_codes and not continue_on_error:
-                raise SshCommandError(command)
+    @staticmethod
+    def _stream_output(channel, stdout, stderr):
+        """
+        Read stdout and stderr as they arrive, so the command never stalls
+        on a full stderr window while stdout is being read
+        """
+        while True:
+            while channel.recv_ready():
+                stdout.feed(channel.recv(RECV_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(RECV_SIZE))
+            if (
+                channel.exit_status_ready()
+                and not channel.recv_ready()
+                and not channel.recv_stderr_ready()
+            ):
+                break
+            select.select([channel], [], [], 1)
 
-        return exit_code, log_stdout, log_stderr
+        stdout.close()
+        stderr.close()
+        return channel.recv_exit_status()
 
     def launch_scp_upload(self, src, dest):
         source_path = Path(src)
@@ -74,9 +394,180 @@ class RemoteSshSession:
             raise FileNotFoundError(f"{source_path} is not available")
 
         try:
-            with self._create_client() as client:
-                with SCPClient(client.get_transport()) as scp:
+            with self.timings.span("upload"):
+                with SCPClient(self._get_transport()) as scp:
                     scp.put(src, dest)
+                    self._count_channel()
+            self.timings.add_bytes(source_path.stat().st_size)
         except SCPException as e:
             logging.error("SCP transfer failed: %s", str(e))
             raise
+
+    def launch_tar_upload(self, sources, dest, compression=None):
+        """
+        Stream the sources as a tar archive into tar on the DUT over a
+        single channel, without any local archive file
+
+        Args:
+            sources (list): local files and directories, extracted under
+                their base name in dest with their modes
+            dest (str): directory on the DUT, created if needed
+            compression (str): None, 'gzip' or 'zstd'
+
+        Returns:
+            tuple: number of files, their size and the bytes sent
+        """
+        for src in sources:
+            if not Path(src).exists():
+                raise FileNotFoundError(f"{src} is not available")
+
+        def _add_sources(tar, count):
+            for src in sources:
+                tar.add(
+                    src,
+                    arcname=os.path.basename(os.path.abspath(src)),
+                    filter=count,
+                )
+
+        return self._launch_tar_stream(_add_sources, dest, compression)
+
+    def launch_content_upload(self, contents, dest="."):
+        """
+        Upload files from memory in a single tar stream, the files are
+        written with the given modes and absolute names are kept
+
+        Args:
+            contents (dict): remote file name to its bytes and mode
+            dest (str): directory of the relative file names
+
+        Returns:
+            tuple: number of files, their size and the bytes sent
+        """
+
+        def _add_contents(tar, count):
+            for name, (data, mode) in contents.items():
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tarinfo.mode = mode
+                tarinfo.mtime = int(time.time())
+                tar.addfile(count(tarinfo), io.BytesIO(data))
+
+        return self._launch_tar_stream(
+            _add_contents, dest, absolute_names=True
+        )
+
+    def _launch_tar_stream(
+        self, add_members, dest, compression=None, absolute_names=False
+    ):
+        if compression == "zstd" and zstandard is None:
+            raise ModuleNotFoundError(
+                "zstd compression requires the zstandard Python module"
+            )
+
+        options = "-x -p"
+        if compression == "gzip":
+            options += " -z"
+        if absolute_names:
+            options += " -P"
+        extract = f"tar {options} -C {quote(dest)} -f -"
+        if compression == "zstd":
+            extract = f"zstd -d -c | {extract}"
+        command = f"mkdir -p -- {quote(dest)}\n{extract}"
+        exec_command = "set -ex\n" + command
+
+        logging.info("## command output:")
+        logging.info("$ %s", exec_command)
+        stdout = _OutputTail("> ")
+        stderr = _OutputTail("2> ")
+        files = []
+        start = time.monotonic()
+        channel = self._open_channel()
+        try:
+            channel.exec_command(exec_command)
+            writer = _ChannelWriter(channel)
+            self._write_tar(writer, add_members, compression, files)
+            channel.shutdown_write()
+            exit_code = self._stream_output(channel, stdout, stderr)
+        finally:
+            channel.close()
+        duration = time.monotonic() - start
+        self.timings.add("upload", duration)
+        self.timings.add_bytes(writer.sent)
+
+        logging.info("> exit code: %s", exit_code)
+        if exit_code != 0:
+            raise SshCommandError(
+                command, exit_code, stderr.getvalue(ERROR_TAIL_LINES)
+            )
+
+        size = sum(files)
+        logging.info(
+            "# Uploaded %d files, %d bytes (%d bytes sent) in %.2fs, "
+            "%.1f MB/s",
+            len(files),
+            size,
+            writer.sent,
+            duration,
+            size / duration / 1000000 if duration else 0,
+        )
+        return len(files), size, writer.sent
+
+    @staticmethod
+    def _write_tar(writer, add_members, compression, files):
+        def _count(tarinfo):
+            if tarinfo.isfile():
+                files.append(tarinfo.size)
+            return tarinfo
+
+        stream = writer
+        if compression == "zstd":
+            stream = zstandard.ZstdCompressor().stream_writer(
+                writer, closefd=False
+            )
+        mode = "w|gz" if compression == "gzip" else "w|"
+        with tarfile.open(
+            fileobj=stream, mode=mode, bufsize=TAR_BUFFER_SIZE
+        ) as tar:
+            add_members(tar, _count)
+        if stream is not writer:
+            stream.close()
+
+    def launch_ssh_steps(self, steps):
+        """
+        Run several commands as one remote script, every step runs in its
+        own subshell and the script stops at the first failing one
+
+        Args:
+            steps (list): commands and their accepted exit codes
+
+        Returns:
+            tuple: stdout and stderr tails
+
+        Raises:
+            SshCommandError: pointing at the command of the failing step
+        """
+        script = ["set -e"]
+        for number, (command, accepted_exit_codes) in enumerate(steps):
+            script.append(f'echo "{STEP_MARKER} {number}"')
+            if accepted_exit_codes == [0]:
+                script.append(f"(\n{command}\n)")
+            else:
+                codes = "|".join(str(code) for code in accepted_exit_codes)
+                script.append(
+                    f"(\n{command}\n) || {{ ret=$?; "
+                    f'case "$ret" in {codes}) ;; *) exit "$ret" ;; esac; }}'
+                )
+
+        script = "\n".join(script)
+        # the marker of the failing step may be out of the stdout tail
+        exit_code, stdout, stderr = self._run_command(
+            script, continue_on_error=True, marker=STEP_MARKER
+        )
+        if exit_code != 0:
+            marker = stdout.last_marker
+            command = steps[int(marker.split()[-1])][0] if marker else script
+            raise SshCommandError(
+                command, exit_code, stderr.getvalue(ERROR_TAIL_LINES)
+            )
+
+        return stdout.getvalue(), stderr.getvalue()
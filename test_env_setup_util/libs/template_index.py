@@ -0,0 +1,146 @@
+import glob
+import logging
+import os
+import re
+import threading
+
+_GLOB_MAGIC = re.compile(r"[*?[]")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_template_index(root_path):
+    """
+    Return the template index of root_path, shared by all the operators
+    working on the same configuration tree
+    """
+    root_path = os.path.abspath(root_path)
+    with _indexes_lock:
+        if root_path not in _indexes:
+            _indexes[root_path] = TemplateIndex(root_path)
+        return _indexes[root_path]
+
+
+class TemplateIndex:
+    """
+    Index of the files below a configuration root directory, used to
+    resolve load_template names with a single walk of the tree.
+
+    A template is looked up below the root directory first, the shallowest
+    match wins and ties are broken alphabetically. Otherwise it is looked
+    up in the global_templates directory of the root directory and of its
+    parents, the closest one wins.
+    """
+
+    def __init__(self, root_path):
+        self._root_path = root_path
+        self._lock = threading.Lock()
+        self._files = None
+        self._dir_mtimes = {}
+        self._lookups = {}
+
+    def refresh(self):
+        """
+        Drop the index if a directory it depends on was modified,
+        the tree is walked again on the next lookup
+        """
+        with self._lock:
+            if self._files is None:
+                return
+            for path, mtime in self._dir_mtimes.items():
+                if _get_mtime(path) != mtime:
+                    logging.debug("%s was modified, reindexing", path)
+                    self._files = None
+                    self._dir_mtimes = {}
+                    self._lookups = {}
+                    return
+
+    def lookup(self, file):
+        """
+        Return the path of the template file, or None if it is not found
+        """
+        with self._lock:
+            if self._files is None:
+                self._build()
+            if file not in self._lookups:
+                self._lookups[file] = self._lookup(file)
+            return self._lookups[file]
+
+    def _build(self):
+        files = {}
+        visited = set()
+        for dirpath, dirnames, filenames in os.walk(
+            self._root_path, followlinks=True
+        ):
+            realpath = os.path.realpath(dirpath)
+            if realpath in visited:
+                dirnames[:] = []
+                continue
+            visited.add(realpath)
+            self._dir_mtimes[dirpath] = _get_mtime(dirpath)
+            # hidden entries are skipped like glob does
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+
+            rel_dir = os.path.relpath(dirpath, self._root_path)
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                relpath = os.path.normpath(os.path.join(rel_dir, filename))
+                files.setdefault(filename, []).append(relpath)
+
+        for paths in files.values():
+            paths.sort(key=lambda path: (path.count(os.sep), path))
+        self._files = files
+        logging.debug(
+            "indexed %d template names below %s", len(files), self._root_path
+        )
+
+    def _lookup(self, file):
+        if _GLOB_MAGIC.search(file):
+            return self._glob_lookup(file)
+
+        # looking for file from base directory
+        file = os.path.normpath(file)
+        for relpath in self._files.get(os.path.basename(file), []):
+            if relpath == file or relpath.endswith(os.sep + file):
+                return os.path.join(self._root_path, relpath)
+
+        # looking for file from global_templates directory
+        lookup_path = os.path.dirname(self._root_path)
+        while lookup_path:
+            self._dir_mtimes[lookup_path] = _get_mtime(lookup_path)
+            template_dir = os.path.join(lookup_path, "global_templates")
+            if os.path.isdir(template_dir):
+                self._dir_mtimes[template_dir] = _get_mtime(template_dir)
+                path = os.path.join(template_dir, file)
+                if os.path.exists(path):
+                    return path
+            if lookup_path == "/":
+                break
+            lookup_path = os.path.dirname(lookup_path)
+
+    def _glob_lookup(self, file):
+        pattern = os.path.join(self._root_path, "**", file)
+        logging.debug("looking pattern string is %s", pattern)
+        files = sorted(glob.glob(pattern, recursive=True))
+        if files:
+            return files[0]
+
+        lookup_path = self._root_path
+        while lookup_path:
+            pattern = os.path.join(lookup_path, "global_templates", file)
+            logging.debug("looking pattern string is %s", pattern)
+            files = sorted(glob.glob(pattern, recursive=True))
+            if files:
+                return files[0]
+            if lookup_path == "/":
+                break
+            lookup_path = os.path.dirname(lookup_path)
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
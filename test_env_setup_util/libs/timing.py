@@ -0,0 +1,95 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+def _new_stats(exit_codes=True):
+    stats = {"phases": {}, "bytes_sent": 0}
+    if exit_codes:
+        stats["exit_codes"] = []
+    return stats
+
+
+def _export(stats):
+    exported = {
+        "phases": {
+            phase: {"count": count, "seconds": round(total, 3)}
+            for phase, (count, total) in stats["phases"].items()
+        },
+        "bytes_sent": stats["bytes_sent"],
+    }
+    if "exit_codes" in stats:
+        exported["exit_codes"] = list(stats["exit_codes"])
+    return exported
+
+
+class Timings:
+    """
+    Durations of the phases of a run and bytes sent, in total and for
+    each action, and the exit codes of the commands of each action.
+
+    The records made while an action is running are attributed to it,
+    the action is tracked per thread so concurrent actions keep their
+    records apart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._run = _new_stats(exit_codes=False)
+        self._actions = {}
+
+    @contextmanager
+    def action(self, number):
+        """
+        Attribute the records of the current thread to the action
+        """
+        self._local.action = number
+        try:
+            yield
+        finally:
+            self._local.action = None
+
+    @contextmanager
+    def span(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
+
+    def _get_stats(self):
+        """
+        Return the stats of the run and of the current action, if any
+        """
+        stats = [self._run]
+        number = getattr(self._local, "action", None)
+        if number is not None:
+            stats.append(self._actions.setdefault(number, _new_stats()))
+        return stats
+
+    def add(self, phase, duration):
+        with self._lock:
+            for stats in self._get_stats():
+                count, total = stats["phases"].get(phase, (0, 0.0))
+                stats["phases"][phase] = (count + 1, total + duration)
+
+    def add_bytes(self, size):
+        with self._lock:
+            for stats in self._get_stats():
+                stats["bytes_sent"] += size
+
+    def add_exit_code(self, exit_code):
+        with self._lock:
+            for stats in self._get_stats():
+                if "exit_codes" in stats:
+                    stats["exit_codes"].append(exit_code)
+
+    def get_run(self):
+        with self._lock:
+            return _export(self._run)
+
+    def get_action(self, number):
+        with self._lock:
+            return _export(self._actions.get(number, _new_stats()))
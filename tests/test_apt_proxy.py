@@ -0,0 +1,90 @@
+import http.client
+import http.server
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from test_env_setup_util.libs.apt_proxy import AptCacheProxy
+
+
+class _UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        # slow enough for the concurrent requests to overlap
+        time.sleep(0.2)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AptCacheProxyTest(unittest.TestCase):
+    def setUp(self):
+        self._upstream = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), _UpstreamHandler
+        )
+        self._upstream.requests = []
+        threading.Thread(
+            target=self._upstream.serve_forever, daemon=True
+        ).start()
+        self.addCleanup(self._upstream.server_close)
+        self.addCleanup(self._upstream.shutdown)
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self._proxy = AptCacheProxy(cache_dir.name)
+        self._proxy.start()
+        self.addCleanup(self._proxy.stop)
+
+    def _get(self, path):
+        url = f"http://127.0.0.1:{self._upstream.server_address[1]}{path}"
+        connection = http.client.HTTPConnection("127.0.0.1", self._proxy.port)
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def test_repository_files(self):
+        for path in [
+            "/ubuntu/dists/noble/InRelease",
+            "/ubuntu/dists/noble/main/binary-amd64/by-hash/SHA256/abc",
+            "/ubuntu/pool/main/h/hello/hello_2.10-3_amd64.deb",
+            "/repo/./Packages.gz",
+            "/repo/Release.gpg",
+            "/repo/tool_1.0_amd64.deb",
+        ]:
+            with self.subTest(path=path):
+                self.assertEqual(self._get(path), (200, path.encode()))
+
+    def test_other_urls_are_refused(self):
+        for path in [
+            "/",
+            "/admin",
+            "/latest/meta-data/iam/security-credentials",
+            "/ubuntu/dists/../admin",
+            "/pool.html",
+        ]:
+            with self.subTest(path=path):
+                self.assertEqual(self._get(path)[0], 403)
+
+    def test_concurrent_requests_download_once(self):
+        path = "/ubuntu/pool/main/h/hello/hello_2.10-3_amd64.deb"
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(self._get, [path] * 4))
+
+        self.assertEqual(results, [(200, path.encode())] * 4)
+        self.assertEqual(self._upstream.requests, [path])
+        stats = self._proxy.get_stats()
+        self.assertEqual((stats["misses"], stats["hits"]), (1, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from benchmarks.fake_dut import FakeDut
+from test_env_setup_util.env_setup import SetupOperator, setup_dut
+from test_env_setup_util.libs.checkpoint import Checkpoint
+from test_env_setup_util.libs.exceptions import ExitCode
+from test_env_setup_util.libs.ssh_handler import RemoteSshSession
+
+
+class CheckpointLoadTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+        self._checkpoint = Checkpoint("10.0.0.1", "abc", self._workdir.name)
+
+    def _write(self, content):
+        path = os.path.join(self._workdir.name, "10.0.0.1.json")
+        with open(path, "w") as fp:
+            fp.write(content)
+
+    def test_missing(self):
+        self.assertEqual(self._checkpoint.load(), set())
+
+    def test_completed(self):
+        self._checkpoint.mark_completed(2)
+        self._checkpoint.mark_completed(1)
+        checkpoint = Checkpoint("10.0.0.1", "abc", self._workdir.name)
+        self.assertEqual(checkpoint.load(), {1, 2})
+        self.assertTrue(checkpoint.is_complete(2))
+
+    def test_another_plan(self):
+        self._write(json.dumps({"plan_hash": "def", "completed": [1]}))
+        with self.assertRaisesRegex(ValueError, "another plan"):
+            self._checkpoint.load()
+
+    def test_invalid(self):
+        for content in [
+            "",
+            "{",
+            "[]",
+            "null",
+            json.dumps({"completed": [1]}),
+            json.dumps({"plan_hash": "abc"}),
+            json.dumps({"plan_hash": None, "completed": [1]}),
+            json.dumps({"plan_hash": "abc", "completed": {"1": True}}),
+            json.dumps({"plan_hash": "abc", "completed": ["1"]}),
+        ]:
+            with self.subTest(content=content):
+                self._write(content)
+                with self.assertRaises(ValueError):
+                    self._checkpoint.load()
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+        state_home = mock.patch.dict(
+            os.environ, {"XDG_STATE_HOME": self._workdir.name}
+        )
+        state_home.start()
+        self.addCleanup(state_home.stop)
+        self._dut = FakeDut()
+        self._port = self._dut.start()
+        self.addCleanup(self._dut.stop)
+
+    def _setup(self, config, **kwargs):
+        session = RemoteSshSession(
+            "127.0.0.1", "test", "test", port=self._port
+        )
+        operator = SetupOperator(
+            self._workdir.name, config, session, {}, **kwargs
+        )
+        return setup_dut(session, operator)
+
+    def test_resume_with_other_apt_options(self):
+        ready = os.path.join(self._workdir.name, "ready")
+        config = os.path.join(self._workdir.name, "env_setup.yaml")
+        with open(config, "w") as fp:
+            yaml.safe_dump(
+                {
+                    "actions": [
+                        {"action": "install_debian", "name": "hello"},
+                        {
+                            "action": "ssh_command",
+                            "command": f"test -e {ready}",
+                        },
+                    ]
+                },
+                fp,
+            )
+
+        self.assertEqual(self._setup(config), ExitCode.Action_Failed)
+        open(ready, "w").close()
+        # the apt update command changes, the configuration does not
+        self.assertEqual(
+            self._setup(
+                config, resume=True, apt_max_age=0, force_apt_update=True
+            ),
+            ExitCode.Success,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
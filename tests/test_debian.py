@@ -0,0 +1,33 @@
+import unittest
+
+from test_env_setup_util.libs.operator.debian import parse_dpkg_query
+
+DPKG_QUERY = """hello 2.10-3build1 install ok installed
+vim 2:9.1.0016-1ubuntu7.2 hold ok installed
+oldpkg 1.0-1 deinstall ok config-files
+purged  unknown ok not-installed
+broken 1.2-1 install reinstreq half-installed
+unpacked 3.0-1 install ok unpacked
+removing 4.0-1 deinstall ok installed
+"""
+
+
+class ParseDpkgQueryTest(unittest.TestCase):
+    def test_parse(self):
+        for data, packages in [
+            (
+                DPKG_QUERY,
+                {
+                    "hello": "2.10-3build1",
+                    "vim": "2:9.1.0016-1ubuntu7.2",
+                },
+            ),
+            ("dpkg-query: no packages found matching missing\n", {}),
+            ("", {}),
+        ]:
+            with self.subTest(data=data):
+                self.assertEqual(parse_dpkg_query(data), packages)
+
+
+if __name__ == "__main__":
+    unittest.main()
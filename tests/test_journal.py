@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from benchmarks.fake_dut import FakeDut
+from test_env_setup_util.env_setup import SetupOperator, setup_dut
+from test_env_setup_util.libs.exceptions import ExitCode
+from test_env_setup_util.libs.journal import get_unchanged_actions
+from test_env_setup_util.libs.ssh_handler import RemoteSshSession
+
+
+class _Journal:
+    def __init__(self, applied):
+        self._applied = applied
+
+    def is_applied(self, digest):
+        return digest in self._applied
+
+
+class GetUnchangedActionsTest(unittest.TestCase):
+    def test_unchanged_chain(self):
+        graph = {0: set(), 1: {0}, 2: {1}}
+        hashes = {1: "b", 2: "c"}
+        self.assertEqual(
+            get_unchanged_actions(graph, hashes, _Journal({"b"}), 1), {1}
+        )
+
+    def test_all_unchanged_skips_prelude(self):
+        graph = {0: set(), 1: {0}}
+        self.assertEqual(
+            get_unchanged_actions(graph, {1: "b"}, _Journal({"b"}), 1),
+            {0, 1},
+        )
+
+    def test_unhashed_action_is_changed(self):
+        # the hash of an scp_command fails when its source is missing
+        graph = {0: set(), 1: {0}, 2: {1}}
+        hashes = {0: "a", 2: "c"}
+        journal = _Journal({"a", "c"})
+        self.assertEqual(get_unchanged_actions(graph, hashes, journal), {0})
+
+
+class IncrementalRunTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+        state_home = mock.patch.dict(
+            os.environ, {"XDG_STATE_HOME": self._workdir.name}
+        )
+        state_home.start()
+        self.addCleanup(state_home.stop)
+        self._dut = FakeDut()
+        self._port = self._dut.start()
+        self.addCleanup(self._dut.stop)
+
+    def _setup(self, config, incremental):
+        session = RemoteSshSession(
+            "127.0.0.1", "test", "test", port=self._port
+        )
+        operator = SetupOperator(
+            self._workdir.name, config, session, {}, incremental=incremental
+        )
+        return setup_dut(session, operator)
+
+    def test_missing_upload_source(self):
+        config = os.path.join(self._workdir.name, "env_setup.yaml")
+        with open(config, "w") as fp:
+            yaml.safe_dump(
+                {
+                    "actions": [
+                        {
+                            "action": "scp_command",
+                            "source": os.path.join(
+                                self._workdir.name, "missing.bin"
+                            ),
+                            "destination": "missing.bin",
+                            "ignore_error": True,
+                        },
+                        {"action": "ssh_command", "command": "echo done"},
+                    ]
+                },
+                fp,
+            )
+
+        self.assertEqual(self._setup(config, False), ExitCode.Success)
+        # the upload is not journaled and must not break the incremental run
+        self.assertEqual(self._setup(config, True), ExitCode.Success)
+
+
+if __name__ == "__main__":
+    unittest.main()
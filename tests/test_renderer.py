@@ -0,0 +1,166 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import jinja2
+import yaml
+
+from test_env_setup_util.env_setup import SetupOperator
+from test_env_setup_util.libs.renderer import render_document, render_variables
+
+DEMO_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "test_env_setup_util",
+    "demo",
+)
+
+VARIABLES = {
+    "user": "ubuntu",
+    "items": ["a", "b"],
+    "empty": "",
+    "none": None,
+    "port": 8080,
+    "services": {"enabled": True},
+}
+
+VALUES = [
+    # plain scalars
+    "plain",
+    "echo {{ user }}",
+    "  {{ user }}  ",
+    "{{ port }}",
+    # quoted scalars
+    "{{ user }}",
+    "'{{ user }}'",
+    '"{{ user }}"',
+    "key: {{ user }}",
+    # block scalars
+    "line {{ user }}\nnext",
+    "line {{ user }}  \nnext   \n",
+    "{{ user }}\n",
+    "{{ user }}\n\n",
+    "a\n\n\n",
+    "\n",
+    "  indented {{ user }}\nb\n",
+    # loops and conditions
+    "{% for item in items %}{{ item }}\n{% endfor %}",
+    "{% for item in items %}{{ item }}\n{% endfor %}\n",
+    "{% for item in items %}\n- {{ item }}\n{% endfor %}\n",
+    "{% if services.enabled %}enabled{% endif %}\n",
+    "{% if not services.enabled %}disabled{% endif %}",
+    # empty values
+    "",
+    "{{ empty }}",
+    "{{ empty }}\n",
+    "{{ user }}\n{{ empty }}\n",
+    "{{ none }}",
+]
+
+
+def _render_yaml_round_trip(contents, variables):
+    """
+    The previous implementation: the contents dumped to YAML, rendered
+    as a whole Jinja template and loaded back
+    """
+    content = jinja2.Environment().from_string(yaml.dump(contents))
+    return yaml.safe_load(content.render(variables))
+
+
+def _action(value):
+    return {"action": "ssh_command", "command": value, "timeout": 10}
+
+
+class RenderVariablesTest(unittest.TestCase):
+    def test_strings_inside_the_document(self):
+        for value in VALUES:
+            with self.subTest(value=value):
+                # an action follows, the string is not the last one
+                contents = [_action(value), {"action": "ssh_command"}]
+                self.assertEqual(
+                    render_variables(contents, VARIABLES),
+                    _render_yaml_round_trip(contents, VARIABLES),
+                )
+
+    def test_strings_at_the_end_of_the_document(self):
+        for value in VALUES:
+            with self.subTest(value=value):
+                contents = [{"action": "ssh_command", "post": value}]
+                self.assertEqual(
+                    render_document(contents, VARIABLES),
+                    _render_yaml_round_trip(contents, VARIABLES),
+                )
+
+    def test_nested_structures(self):
+        contents = [
+            {
+                "action": "install_snap",
+                "args": ["--{{ user }}", 1, None, True, {"x": "{{ port }}"}],
+                "post_commands": "{% for item in items %}{{ item }}\n"
+                "{% endfor %}\n",
+                "empty": {},
+            },
+            {"action": "create_service", "raw": [{}, "a\n{{ user }}\n"]},
+        ]
+        self.assertEqual(
+            render_document(contents, VARIABLES),
+            _render_yaml_round_trip(contents, VARIABLES),
+        )
+
+    def test_keys_and_other_values_are_kept(self):
+        contents = {"{{ user }}": [1, 2.5, None, False]}
+        self.assertEqual(render_variables(contents, VARIABLES), contents)
+
+    def test_contents_are_not_modified(self):
+        contents = [_action("{{ user }}\n")]
+        render_document(contents, VARIABLES)
+        self.assertEqual(contents, [_action("{{ user }}\n")])
+
+    def test_last_block_scalar_loses_its_line_break(self):
+        contents = [{"action": "create_service", "service_raw": "[Unit]\n"}]
+        self.assertEqual(
+            render_variables(contents, VARIABLES)[0]["service_raw"],
+            "[Unit]\n",
+        )
+        self.assertEqual(
+            render_document(contents, VARIABLES)[0]["service_raw"], "[Unit]"
+        )
+
+    def test_quoted_jinja_strings(self):
+        # intended difference: YAML escaped the quotes of the Jinja
+        # expressions of single quoted scalars, which failed to render
+        contents = [_action("{{ missing | default('d') }}")]
+        with self.assertRaises(jinja2.TemplateSyntaxError):
+            _render_yaml_round_trip(contents, VARIABLES)
+        self.assertEqual(render_variables(contents, VARIABLES), [_action("d")])
+
+
+class DemoPlanTest(unittest.TestCase):
+    def _get_operator(self):
+        config = os.path.join(DEMO_DIR, "example_env_setup.yaml")
+        return SetupOperator(DEMO_DIR, config, variables=VARIABLES)
+
+    def test_demo_plan(self):
+        with mock.patch.object(
+            SetupOperator, "_replace_variables", lambda self, c: c
+        ):
+            raw_actions, _, _ = self._get_operator()._load_actions()
+        actions, _, _ = self._get_operator()._load_actions()
+        self.assertEqual(
+            actions, _render_yaml_round_trip(raw_actions, VARIABLES)
+        )
+
+    def test_demo_dump(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            dump_file = os.path.join(workdir, "dump.yaml")
+            operator = self._get_operator()
+            operator._dump_file = dump_file
+            operator.dump()
+            with open(dump_file) as fp:
+                dumped = fp.read()
+        # the last service file of the plan has no trailing newline
+        self.assertIn("service_raw: |-\n", dumped.split("- action:")[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,270 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import yaml
+
+from benchmarks.fake_dut import FakeDut
+from test_env_setup_util.env_setup import SetupOperator, setup_dut
+from test_env_setup_util.libs.exceptions import ExitCode
+from test_env_setup_util.libs.model import ACTIONS_ADAPTER
+from test_env_setup_util.libs.scheduler import (
+    build_action_graph,
+    group_chained_actions,
+    run_action_graph,
+)
+from test_env_setup_util.libs.ssh_handler import RemoteSshSession
+
+
+def _actions(*specs):
+    """
+    Return ssh_command actions, a spec is an id and a depends_on list
+    """
+    return ACTIONS_ADAPTER.validate_python(
+        [
+            {
+                "action": "ssh_command",
+                "command": "true",
+                "id": action_id,
+                "depends_on": depends_on,
+            }
+            for action_id, depends_on in specs
+        ]
+    )
+
+
+class BuildActionGraphTest(unittest.TestCase):
+    def test_graphs(self):
+        for specs, prelude, graph in [
+            # file order without depends_on
+            ([(None, None)] * 3, 0, {0: set(), 1: {0}, 2: {1}}),
+            # an action nobody depends on is still awaited
+            (
+                [("a", None), ("b", []), (None, None)],
+                0,
+                {0: set(), 1: set(), 2: {0, 1}},
+            ),
+            (
+                [("a", None), ("b", ["a"]), (None, None)],
+                0,
+                {0: set(), 1: {0}, 2: {1}},
+            ),
+            # the generated actions are always awaited
+            (
+                [(None, None), ("a", []), ("b", ["a"])],
+                1,
+                {0: set(), 1: {0}, 2: {0, 1}},
+            ),
+            # a later action can be a dependency
+            (
+                [("a", ["b"]), ("b", [])],
+                0,
+                {0: {1}, 1: set()},
+            ),
+        ]:
+            with self.subTest(specs=specs, prelude=prelude):
+                self.assertEqual(
+                    build_action_graph(_actions(*specs), prelude), graph
+                )
+
+    def test_invalid_dependencies(self):
+        for specs, message in [
+            ([("a", None), (None, ["b"])], "action 2 depends on unknown id"),
+            ([("a", ["a"])], "action 1 depends on itself"),
+            ([("a", None), ("a", None)], "duplicated action id 'a'"),
+            (
+                [("a", ["c"]), ("b", ["a"]), ("c", ["b"]), (None, [])],
+                "circular dependencies between actions 1, 2, 3",
+            ),
+        ]:
+            with self.subTest(specs=specs):
+                with self.assertRaisesRegex(ValueError, message):
+                    build_action_graph(_actions(*specs))
+
+    def test_bypassed_dependencies(self):
+        actions = _actions(("a", None), (None, ["a", "arm64-driver"]))
+        self.assertEqual(
+            build_action_graph(actions, bypassed_ids={"arm64-driver"}),
+            {0: set(), 1: {0}},
+        )
+        with self.assertRaisesRegex(ValueError, "unknown id 'b'"):
+            build_action_graph(
+                _actions((None, ["b"])), bypassed_ids={"arm64-driver"}
+            )
+
+
+class RunActionGraphTest(unittest.TestCase):
+    def _run(self, graph, failing=(), max_workers=1):
+        executed = []
+
+        def _execute(idx):
+            executed.append(idx)
+            return idx not in failing
+
+        result = run_action_graph(graph, _execute, max_workers)
+        return result, executed
+
+    def test_file_order(self):
+        graph = {0: set(), 1: set(), 2: {0}, 3: {1, 2}}
+        self.assertEqual(self._run(graph), (True, [0, 1, 2, 3]))
+
+    def test_stop_on_failure(self):
+        graph = {0: set(), 1: {0}, 2: set(), 3: {1, 2}}
+        # the independent action 2 is not started after the failure
+        self.assertEqual(self._run(graph, failing={1}), (False, [0, 1]))
+
+    def test_running_actions_are_awaited(self):
+        graph = {0: set(), 1: set(), 2: {0, 1}}
+        started = threading.Barrier(2, timeout=5)
+
+        def _execute(idx):
+            if idx < 2:
+                # both actions run at the same time
+                started.wait()
+            return idx != 0
+
+        self.assertFalse(run_action_graph(graph, _execute, 2))
+        self.assertFalse(started.broken)
+
+
+class GroupChainedActionsTest(unittest.TestCase):
+    def _actions(self, types, specs=None):
+        specs = specs or [(None, None)] * len(types)
+        actions = _actions(*specs)
+        for action, action_type in zip(actions, types):
+            action.action = action_type
+        return actions
+
+    def test_groups(self):
+        debian, ssh = "install_debian", "ssh_command"
+        for types, specs, skipped, groups in [
+            ([debian] * 3, None, (), {0: [0, 1, 2]}),
+            ([debian, ssh, debian], None, (), {}),
+            (
+                [debian, debian, ssh, debian, debian],
+                None,
+                (),
+                {0: [0, 1], 3: [3, 4]},
+            ),
+            # an action with depends_on may run before the previous one,
+            # the next action then waits for both
+            (
+                [debian] * 3,
+                [(None, None), (None, []), (None, None)],
+                (),
+                {},
+            ),
+            (
+                [debian] * 3,
+                [(None, None), ("b", []), (None, ["b"])],
+                (),
+                {1: [1, 2]},
+            ),
+            # the skipped actions are left out
+            ([debian] * 3, None, {1}, {0: [0, 2]}),
+            ([debian] * 3, None, {0}, {1: [1, 2]}),
+            ([debian] * 3, None, {0, 1}, {}),
+        ]:
+            with self.subTest(types=types, specs=specs, skipped=skipped):
+                actions = self._actions(types, specs)
+                graph = build_action_graph(actions)
+                self.assertEqual(
+                    group_chained_actions(actions, graph, debian, skipped),
+                    groups,
+                )
+
+
+class ErrorHandlingRunTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+        self._dut = FakeDut()
+        self._port = self._dut.start()
+        self.addCleanup(self._dut.stop)
+
+    def test_ignore_error(self):
+        done = os.path.join(self._workdir.name, "done")
+        config = os.path.join(self._workdir.name, "env_setup.yaml")
+        session = RemoteSshSession(
+            "127.0.0.1", "test", "test", port=self._port
+        )
+        for ignore_error, result in [
+            (False, ExitCode.Action_Failed),
+            (True, ExitCode.Success),
+        ]:
+            with self.subTest(ignore_error=ignore_error):
+                with open(config, "w") as fp:
+                    yaml.safe_dump(
+                        {
+                            "actions": [
+                                {
+                                    "action": "ssh_command",
+                                    "command": "false",
+                                    "ignore_error": ignore_error,
+                                },
+                                {
+                                    "action": "ssh_command",
+                                    "command": f"touch {done}",
+                                },
+                            ]
+                        },
+                        fp,
+                    )
+                operator = SetupOperator(
+                    self._workdir.name, config, session, {}
+                )
+                self.assertEqual(setup_dut(session, operator), result)
+                self.assertEqual(os.path.exists(done), ignore_error)
+
+
+class BypassedDependencyRunTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+        self._dut = FakeDut()
+        self._port = self._dut.start()
+        self.addCleanup(self._dut.stop)
+
+    def test_run(self):
+        config = os.path.join(self._workdir.name, "env_setup.yaml")
+        with open(config, "w") as fp:
+            yaml.safe_dump(
+                {
+                    "actions": [
+                        {
+                            "action": "ssh_command",
+                            "id": "driver",
+                            "command": "echo arm64",
+                            "bypass_condition": "'{{ arch }}' != 'arm64'",
+                        },
+                        {
+                            "action": "ssh_command",
+                            "id": "driver",
+                            "command": "echo amd64",
+                            "bypass_condition": "'{{ arch }}' != 'amd64'",
+                        },
+                        {
+                            "action": "ssh_command",
+                            "command": "echo done",
+                            "depends_on": ["driver"],
+                        },
+                    ]
+                },
+                fp,
+            )
+        session = RemoteSshSession(
+            "127.0.0.1", "test", "test", port=self._port
+        )
+        for arch in ["amd64", "riscv64"]:
+            with self.subTest(arch=arch):
+                operator = SetupOperator(
+                    self._workdir.name, config, session, {"arch": arch}
+                )
+                self.assertEqual(
+                    setup_dut(session, operator), ExitCode.Success
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
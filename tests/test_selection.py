@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+
+from test_env_setup_util.env_setup import SetupOperator
+from test_env_setup_util.libs.model import ACTIONS_ADAPTER
+
+
+def _actions(*ids):
+    return ACTIONS_ADAPTER.validate_python(
+        [
+            {"action": "ssh_command", "command": "true", "id": action_id}
+            for action_id in ids
+        ]
+    )
+
+
+class GetDeselectedActionsTest(unittest.TestCase):
+    def setUp(self):
+        self._workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._workdir.cleanup)
+
+    def _deselect(self, actions, prelude=0, **kwargs):
+        operator = SetupOperator(
+            self._workdir.name, "env_setup.yaml", **kwargs
+        )
+        return operator._get_deselected_actions(actions, prelude)
+
+    def test_selection(self):
+        actions = _actions(None, "tools", None, "driver")
+        for kwargs, prelude, deselected in [
+            ({}, 0, set()),
+            ({"from_action": 1}, 0, set()),
+            ({"from_action": 3}, 0, {0, 1}),
+            ({"from_action": 4}, 0, {0, 1, 2}),
+            # the generated actions are always selected
+            ({"from_action": 4}, 1, {1, 2}),
+            ({"only": ["2"]}, 0, {0, 2, 3}),
+            ({"only": ["tools", "4"]}, 0, {0, 2}),
+            ({"only": ["driver"]}, 1, {1, 2}),
+            ({"only": ["1", "2", "3", "4"]}, 0, set()),
+        ]:
+            with self.subTest(kwargs=kwargs, prelude=prelude):
+                self.assertEqual(
+                    self._deselect(actions, prelude, **kwargs), deselected
+                )
+
+    def test_invalid_selection(self):
+        actions = _actions(None, "tools")
+        for kwargs, message in [
+            ({"from_action": 3}, "the plan only has 2 actions"),
+            ({"only": ["3"]}, "unknown action '3'"),
+            ({"only": ["0"]}, "unknown action '0'"),
+            ({"only": ["driver"]}, "unknown action 'driver'"),
+        ]:
+            with self.subTest(kwargs=kwargs):
+                with self.assertRaisesRegex(ValueError, message):
+                    self._deselect(actions, **kwargs)
+
+
+if __name__ == "__main__":
+    unittest.main()
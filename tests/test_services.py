@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+from test_env_setup_util.libs.model import CreateSystemServiceAction
+from test_env_setup_util.libs.operator.common import (
+    check_system_service,
+    create_system_service,
+    create_system_services,
+)
+
+
+def _service(name, post_commands=None):
+    return CreateSystemServiceAction(
+        action="create_service",
+        service_name=name,
+        service_raw="[Service]\nType=oneshot\nExecStart=/bin/true\n",
+        post_commands=post_commands,
+    )
+
+
+class CreateSystemServicesTest(unittest.TestCase):
+    def test_enable_waits_for_the_start_jobs(self):
+        session = mock.Mock()
+        session.launch_ssh_steps.return_value = (
+            "envicorn: service states\nactive\ninactive\n",
+            "",
+        )
+        states = create_system_services(
+            session, [_service("a.service"), _service("b.service")]
+        )
+
+        commands = [cmd for cmd, _ in session.launch_ssh_steps.call_args[0][0]]
+        self.assertIn(
+            "sudo systemctl enable --now a.service b.service", commands
+        )
+        self.assertFalse(any("--no-block" in cmd for cmd in commands))
+        self.assertEqual(
+            states, {"a.service": "active", "b.service": "inactive"}
+        )
+
+    def test_same_rule_as_a_single_service(self):
+        session = mock.Mock()
+        create_system_service(session, _service("a.service"))
+        steps = dict(session.launch_ssh_steps.call_args[0][0])
+        # systemctl status accepts the services which are not running
+        self.assertEqual(steps["sudo systemctl status a.service"], [0, 3])
+
+        for state in ["active", "inactive", "failed", "activating"]:
+            with self.subTest(state=state):
+                session = mock.Mock()
+                check_system_service(
+                    session, _service("a.service", "echo ready"), state
+                )
+                session.launch_ssh_command.assert_called_once_with(
+                    "echo ready"
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
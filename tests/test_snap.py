@@ -0,0 +1,132 @@
+import re
+import unittest
+
+from test_env_setup_util.libs.model import InstallSnapAction
+from test_env_setup_util.libs.operator.snap import (
+    SnapChangeTracker,
+    parse_snap_list,
+)
+
+SNAP_LIST = """/usr/bin/snap
+Name      Version         Rev    Tracking       Publisher   Notes
+bare      1.0             5      latest/stable  canonical✓  base
+checkbox  2.9.1           x1     -              -           classic
+core22    20240111        1122   latest/stable  canonical✓  base,disabled
+core22    20240408        1380   latest/stable  canonical✓  base
+lxd       5.21.1-2d13beb  28460  5.21/stable/…  canonical✓  -
+snapd     2.62            21465  latest/stable  canonical✓  snapd,disabled
+snapd     2.63            21759  latest/stable  canonical✓  snapd
+"""
+
+REFRESH_LIST = """Name    Version   Rev    Size   Publisher   Notes
+core22  20240809  1586   77MB   canonical✓  base
+lxd     5.21.2    29619  109MB  canonical✓  -
+"""
+
+
+class ParseSnapListTest(unittest.TestCase):
+    def test_parse(self):
+        for data, active_only, snaps in [
+            (
+                SNAP_LIST,
+                True,
+                {
+                    "bare": ("1.0", "5", "latest/stable"),
+                    # sideloaded without a channel
+                    "checkbox": ("2.9.1", "x1", ""),
+                    "core22": ("20240408", "1380", "latest/stable"),
+                    "lxd": ("5.21.1-2d13beb", "28460", "5.21/stable/…"),
+                    "snapd": ("2.63", "21759", "latest/stable"),
+                },
+            ),
+            (REFRESH_LIST, False, {"core22", "lxd"}),
+            ("All snaps up to date.\n", False, {}),
+            ("error: cannot list snaps\n", True, {}),
+            ("", True, {}),
+        ]:
+            with self.subTest(data=data, active_only=active_only):
+                parsed = parse_snap_list(data, active_only)
+                if isinstance(snaps, set):
+                    self.assertEqual(set(parsed), snaps)
+                    continue
+                self.assertEqual(
+                    {
+                        name: (
+                            snap["version"],
+                            snap["revision"],
+                            snap["tracking"],
+                        )
+                        for name, snap in parsed.items()
+                    },
+                    snaps,
+                )
+
+    def test_disabled_revisions(self):
+        snaps = parse_snap_list(SNAP_LIST, active_only=False)
+        # the last revision listed is kept
+        self.assertEqual(snaps["core22"]["revision"], "1380")
+        self.assertEqual(len(snaps), 5)
+
+
+class FakeSnapSession:
+    """Answer the commands of SnapChangeTracker like snapd would"""
+
+    def __init__(self):
+        self.commands = []
+        self.state = {"installed": {}, "updates": set()}
+        self.change_ids = iter(range(10, 100))
+        self.changes = {}
+
+    def get_remote_state(self, key, probe):
+        return self.state
+
+    def launch_ssh_command(self, command, **kwargs):
+        self.commands.append(command)
+        if command.startswith("snap changes"):
+            changes = "".join(
+                f"{change_id}  Done  today  today  {summary}\n"
+                for change_id, summary in self.changes.items()
+            )
+            return 0, f"ID  Status  Spawn  Ready  Summary\n{changes}", ""
+        stdout = ""
+        for line in command.splitlines():
+            match = re.match(r"change=\$\((.*)\) && echo \"(.*) \$", line)
+            change_id = str(next(self.change_ids))
+            self.changes[change_id] = match.group(1)
+            stdout += f"{match.group(2)} {change_id}\n"
+        return 0, stdout, ""
+
+
+class SnapChangeTrackerTest(unittest.TestCase):
+    def test_same_snap_in_a_group(self):
+        session = FakeSnapSession()
+        tracker = SnapChangeTracker(session)
+        tracker.submit(
+            {
+                1: InstallSnapAction(action="install_snap", name="lxd"),
+                2: InstallSnapAction(action="install_snap", name="hello"),
+                3: InstallSnapAction(
+                    action="install_snap", name="lxd", risk="edge"
+                ),
+            }
+        )
+        self.assertEqual(len(session.commands), 1)
+        self.assertEqual(
+            list(session.changes.values()),
+            [
+                "sudo snap install --no-wait lxd --channel=latest/stable",
+                "sudo snap install --no-wait hello --channel=latest/stable",
+            ],
+        )
+        # the second lxd action is left to the synchronous installation
+        self.assertTrue(tracker.is_submitted(1))
+        self.assertTrue(tracker.is_submitted(2))
+        self.assertFalse(tracker.is_submitted(3))
+
+        tracker.wait(1)
+        tracker.wait(2)
+        self.assertEqual(len(session.commands), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from test_env_setup_util.libs.snap_cache import SnapCache
+
+
+class SnapCacheTest(unittest.TestCase):
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self._cache_dir = workdir.name
+        self._downloads = []
+        self._revision = "1380"
+        run = mock.patch(
+            "test_env_setup_util.libs.snap_cache.subprocess.run",
+            side_effect=self._snap_download,
+        )
+        run.start()
+        self.addCleanup(run.stop)
+
+    def _snap_download(self, command, **kwargs):
+        self._downloads.append(command)
+        name = command[2]
+        target = command[-1].partition("=")[2]
+        for suffix in (".snap", ".assert"):
+            path = os.path.join(target, f"{name}_{self._revision}{suffix}")
+            open(path, "w").close()
+
+    def _get(self, channel_max_age=3600):
+        # every run has its own cache object
+        cache = SnapCache(self._cache_dir, channel_max_age=channel_max_age)
+        return cache.get("core22", "amd64", channel="latest/stable")[2]
+
+    def test_channel_resolved_by_a_previous_run(self):
+        self.assertEqual(self._get(), "1380")
+        self._revision = "1400"
+        self.assertEqual(self._get(), "1380")
+        self.assertEqual(len(self._downloads), 1)
+
+    def test_expired_resolution(self):
+        self._get()
+        self._revision = "1400"
+        self.assertEqual(self._get(channel_max_age=0), "1400")
+        self.assertEqual(len(self._downloads), 2)
+
+        with mock.patch(
+            "test_env_setup_util.libs.snap_cache.time.time",
+            return_value=time.time() + 3600,
+        ):
+            self._revision = "1500"
+            self.assertEqual(self._get(), "1500")
+
+    def test_evicted_revision(self):
+        self._get()
+        os.unlink(os.path.join(self._cache_dir, "core22_1380_amd64.snap"))
+        self._get()
+        self.assertEqual(len(self._downloads), 2)
+
+    def test_invalid_channels_file(self):
+        self._get()
+        for content in ["{", "[]", '{"core22 latest/stable amd64": 1}']:
+            with self.subTest(content=content):
+                path = os.path.join(self._cache_dir, "channels.json")
+                with open(path, "w") as fp:
+                    fp.write(content)
+                downloads = len(self._downloads)
+                self.assertEqual(self._get(), "1380")
+                self.assertEqual(len(self._downloads), downloads + 1)
+
+    def test_revision(self):
+        cache = SnapCache(self._cache_dir)
+        cache.get("core22", "amd64", revision="1380")
+        cache.get("core22", "amd64", revision="1380")
+        self.assertEqual(len(self._downloads), 1)
+        self.assertIn("--revision=1380", self._downloads[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from benchmarks.fake_dut import FakeDut
+from test_env_setup_util.libs.exceptions import SshCommandError
+from test_env_setup_util.libs.ssh_handler import (
+    OUTPUT_TAIL_LINES,
+    RemoteSshSession,
+)
+
+
+class LaunchSshStepsTest(unittest.TestCase):
+    def setUp(self):
+        self._dut = FakeDut()
+        port = self._dut.start()
+        self.addCleanup(self._dut.stop)
+        self._session = RemoteSshSession(
+            "127.0.0.1", "test", "test", port=port
+        )
+
+    def test_steps(self):
+        stdout, _ = self._session.launch_ssh_steps(
+            [("echo first", [0]), ("exit 3", [0, 3]), ("echo last", [0])]
+        )
+        self.assertIn("first\n", stdout)
+        self.assertIn("last\n", stdout)
+
+    def test_failing_step(self):
+        with self.assertRaises(SshCommandError) as context:
+            self._session.launch_ssh_steps(
+                [("echo first", [0]), ("exit 3", [0]), ("echo last", [0])]
+            )
+        self.assertIn("'exit 3' (exit code 3)", str(context.exception))
+
+    def test_failing_step_after_a_long_output(self):
+        # the marker of the failing step is out of the stdout tail
+        chatty = f"seq {OUTPUT_TAIL_LINES * 2}; false"
+        with self.assertRaises(SshCommandError) as context:
+            self._session.launch_ssh_steps(
+                [("echo first", [0]), (chatty, [0]), ("echo last", [0])]
+            )
+        self.assertIn(f"'{chatty}' (exit code 1)", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from test_env_setup_util.libs.template_index import TemplateIndex
+
+
+class TemplateIndexTest(unittest.TestCase):
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self._top = os.path.realpath(workdir.name)
+        self._root = os.path.join(self._top, "level", "project")
+        for path in [
+            "global_templates/common.yaml",
+            "global_templates/top.yaml",
+            "level/global_templates/common.yaml",
+            "level/project/templates/x.yaml",
+            "level/project/deep/templates/x.yaml",
+            "level/project/c/y.yaml",
+            "level/project/b/y.yaml",
+            "level/project/sub/z.yaml",
+            "level/project/.hidden/h.yaml",
+        ]:
+            self._write(path)
+        # a loop back to the configuration directory
+        os.symlink(self._root, os.path.join(self._root, "sub", "loop"))
+
+    def _write(self, path):
+        path = os.path.join(self._top, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+    def test_lookup(self):
+        index = TemplateIndex(self._root)
+        for name, path in [
+            # the shallowest file below the configuration directory wins
+            ("x.yaml", "level/project/templates/x.yaml"),
+            ("deep/templates/x.yaml", "level/project/deep/templates/x.yaml"),
+            # then the alphabetical order
+            ("y.yaml", "level/project/b/y.yaml"),
+            ("c/y.yaml", "level/project/c/y.yaml"),
+            ("sub/z.yaml", "level/project/sub/z.yaml"),
+            # the nearest global_templates directory wins
+            ("common.yaml", "level/global_templates/common.yaml"),
+            ("top.yaml", "global_templates/top.yaml"),
+            ("y*.yaml", "level/project/b/y.yaml"),
+            ("t*.yaml", "global_templates/top.yaml"),
+            ("h.yaml", None),
+            ("missing.yaml", None),
+            ("other/z.yaml", None),
+        ]:
+            with self.subTest(name=name):
+                found = index.lookup(name)
+                if path is None:
+                    self.assertIsNone(found)
+                else:
+                    self.assertEqual(found, os.path.join(self._top, path))
+
+    def test_refresh(self):
+        index = TemplateIndex(self._root)
+        self.assertIsNone(index.lookup("new.yaml"))
+        self._write("level/project/templates/new.yaml")
+        index.refresh()
+        self.assertEqual(
+            index.lookup("new.yaml"),
+            os.path.join(self._root, "templates", "new.yaml"),
+        )
+
+        # the lookups are cached until a directory is modified
+        self.assertIsNone(index.lookup("new-global.yaml"))
+        self._write("level/global_templates/new-global.yaml")
+        self.assertIsNone(index.lookup("new-global.yaml"))
+        index.refresh()
+        self.assertEqual(
+            index.lookup("new-global.yaml"),
+            os.path.join(self._top, "level/global_templates/new-global.yaml"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+from test_env_setup_util.libs.timing import Timings
+
+
+class TimingsTest(unittest.TestCase):
+    def test_records(self):
+        timings = Timings()
+        timings.add("connect", 0.5)
+        with timings.action(1):
+            timings.add("ssh_command", 1.0)
+            timings.add("ssh_command", 0.25)
+            timings.add_bytes(10)
+            timings.add_exit_code(0)
+            timings.add_exit_code(3)
+
+        self.assertEqual(
+            timings.get_run(),
+            {
+                "phases": {
+                    "connect": {"count": 1, "seconds": 0.5},
+                    "ssh_command": {"count": 2, "seconds": 1.25},
+                },
+                "bytes_sent": 10,
+            },
+        )
+        self.assertEqual(
+            timings.get_action(1),
+            {
+                "phases": {"ssh_command": {"count": 2, "seconds": 1.25}},
+                "bytes_sent": 10,
+                "exit_codes": [0, 3],
+            },
+        )
+        self.assertEqual(
+            timings.get_action(2),
+            {"phases": {}, "bytes_sent": 0, "exit_codes": []},
+        )
+
+    def test_concurrent_actions(self):
+        timings = Timings()
+
+        def _run(number):
+            with timings.action(number):
+                timings.add_exit_code(number)
+
+        threads = [
+            threading.Thread(target=_run, args=(number,)) for number in (1, 2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        timings.add_exit_code(5)
+
+        self.assertEqual(timings.get_action(1)["exit_codes"], [1])
+        self.assertEqual(timings.get_action(2)["exit_codes"], [2])
+
+
+if __name__ == "__main__":
+    unittest.main()